@@ -15,6 +15,227 @@ import getpass
 import os
 import glob
 import pickle
+import hashlib
+import json
+import time
+import tempfile
+import importlib.util
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+#version of the parsed record layout format, bump when layout fields change
+LAYOUT_VERSION = 1
+
+#census record layouts keyed by the first data month (yyyymm) they apply to,
+#paths are relative to newpath
+LAYOUT_SCHEDULE = [
+    (201501, '/cps_16/January_2015_Record_Layout.txt'),
+    (201701, '/cps_17/January_2017_Record_Layout.txt'),
+    (202001, '/cps_20/2020_Basic_CPS_Public_Use_Record_Layout_plus_IO_Code_list.txt')
+    ]
+
+#regular expressions finding rows with variable location details, the 2016
+#certification extract layout separates descriptions with spaces, not tabs
+LAYOUT_PATTERN = r'\n(\w+)\s+(\d+)\s+(.*?)\t+.*?(\d\d*).*?(\d\d+)'
+CERT_2016_PATTERN = r'\n(\w+)\s+(\d+)\s+(.*?)\s+.*?(\d\d*).*?(\d\d+)'
+
+#parsed layouts held in memory for the session, keyed by layout hash
+_layouts = {}
+
+#version of the columnar clean data store, bump when the partition format changes
+STORE_VERSION = 1
+
+#version of the monthly partials of aggregate tables, see update_partials
+PARTIALS_VERSION = 2
+
+#manifest of downloaded files kept in outpath, file -> url, sha1 and size, see fetch_raw
+PIPELINE_MANIFEST = 'cps_pipeline.json'
+
+#census file server, replaced by a local server when testing the downloader
+CENSUS_URL = 'https://www2.census.gov'
+
+#concurrent transfers, bytes read per chunk and seconds to wait for a response
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_CHUNK = 2**20
+DOWNLOAD_TIMEOUT = 60
+
+#bytes of fixed-width records decoded at a time when parsing raw files
+RECORD_BLOCK = 2**26
+
+#derived variables added to each month by apply_recodes. a recode reads one
+#source column and either cuts it into half open 'bins' ([lo, hi) per label) or
+#maps inclusive integer 'ranges' and single 'values' to labels. values not
+#covered get 'default' (nan if absent), rows failing a 'where' range are nan
+RECODES = [
+    #full and part time employment
+    {'name':'EMP_STATUS', 'source':'PRFTLF', 'values':{2:'Part-time', 1:'Full-time'}, 'where':{'PREMPNOT':(1, 1)}},
+    #age recodes
+    {'name':'age', 'source':'PRTAGE', 'bins':[16, 25, 55, np.inf], 'labels':['16 to 24','25 to 54','55 and older']},
+    {'name':'age2', 'source':'PRTAGE', 'bins':[16, 25, 35, 45, 55, 65],
+     'labels':['16 to 24','25 to 34','35 to 44','45 to 54','55 to 64'], 'default':'65 and older'},
+    #educational attainment, persons 25 and older
+    {'name':'EDUC', 'source':'PEEDUCA', 'where':{'PRTAGE':(25, None)},
+     'ranges':[(31, 38, 'NO HIGH SCHOOL DIPLOMA'), (39, 39, 'HS GRADUATE, NO COLLEGE'), (40, 40, 'SOME COLLEGE, NO DEGREE'),
+               (41, 42, 'ASSOCIATES DEGREE'), (43, 43, 'BACHELORS DEGREE'), (44, 46, 'ADVANCED DEGREE')]},
+    {'name':'EDUC2', 'source':'PEEDUCA', 'where':{'PRTAGE':(25, None)},
+     'ranges':[(40, 42, 'SOME COLLEGE OR ASSOCIATES'), (43, 46, 'BACHELORS OR HIGHER')]},
+    #changed mid skilled classification for most recent update (henry's words)
+    {'name':'EDUC3', 'source':'PEEDUCA', 'where':{'PRTAGE':(25, None)},
+     'ranges':[(31, 38, 'NO HIGH SCHOOL DIPLOMA'), (39, 39, 'HS GRADUATE OR GED'), (40, 42, 'MID-SKILLED'), (43, 46, 'BACHELORS OR HIGHER')]},
+    #occupations recode
+    {'name':'OCC4', 'source':'PRMJOCGR', 'ranges':[(4, 5, 'Farming and Construction')]},
+    #race recode. 3 is native american/native alaskan, may have impact on states like oklahoma.
+    #5 is hawaiian/pacific islander, likely to have a large impact in hawaii, may want to break these two apart
+    {'name':'RACE', 'source':'PTDTRACE', 'values':{1:'WHITE', 2:'BLACK', 4:'ASIAN', 3:'INDIGENOUS', 5:'INDIGENOUS'}, 'default':'MULTI-RACIAL'}
+    ]
+
+#base populations tables are tabulated over, label -> inclusive 'where' ranges
+#a person must fall in, as in RECODES. populations overlap, a person 25 and up
+#counts in both
+BASE_POPULATIONS = {
+    'Civilian Population 16 and up':{},
+    'Civilian Population 25 and up':{'PRTAGE':(25, None)}
+    }
+
+#certification segments of the cert column built by get_microdata. PECERT2 is
+#only asked of certificate holders, so holders are split on their answer to it
+CERT_SEGMENTS = {
+    0:'PECERT1 not answered',
+    1:'PECERT1 NO',
+    2:'PECERT1 YES, PECERT2 YES',
+    3:'PECERT1 YES, PECERT2 NO',
+    4:'PECERT1 YES, PECERT2 not answered'
+    }
+
+#certification output columns, flag -> segments whose totals it sums, ex.
+#PWSSWGT_PECERT1_y is the PWSSWGT total of segments 2, 3 and 4
+CERT_COLUMNS = {
+    'PECERT1_y':[2, 3, 4],
+    'PECERT1_n':[1],
+    'PECERT2_y':[2],
+    'PECERT2_n':[3]
+    }
+
+#text columns of the microdata table, stored as integer codes in encoded databases
+MICRODATA_TEXT = ['GESTFIPS', 'PESEX', 'RACE', 'PEHSPNON', 'age2', 'EDUC', 'PEMLR', 'PRCOW1',
+                  'PRMJIND1', 'PRDTOCC1', 'PECERT1', 'PECERT2', 'PECERT3', 'labforce',
+                  'PRCIVLF', 'EDUC2', 'emp_stat']
+
+#user friendly names of the microdata columns read by get_microdata
+MICRODATA_FIELDS = {
+    'state':'GESTFIPS',
+    'labforce':'labforce',
+    'emp_type':'PRCOW1',
+    'emp_stat':'emp_stat',
+    'education':'EDUC',
+    'EDUC2':'EDUC2',
+    'sex':'PESEX',
+    'race':'race',
+    'age':'age2',
+    'hispanic':'PEHSPNON',
+    'industry':'PRMJIND1',
+    'occupation':'PRDTOCC1',#'soc_2dig',
+    'PRTAGE':'PRTAGE',
+    'HRMONTH2':'HRMONTH2',
+    'PWSSWGT':'PWSSWGT',
+    'PWORWGT':'PWORWGT',
+    'individual':'individual',
+    'PRERNWA':'PRERNWA',
+    'PRERELG':'PRERELG',
+    'PECERT1':'PECERT1',
+    'PECERT2':'PECERT2',
+    'month':'HRMIS'
+    }
+
+#microdata columns indexed by build_database for filtered reads in get_microdata
+MICRODATA_INDEXES = ['HRMONTH2', 'GESTFIPS', 'labforce']
+
+#memory budget of the cache generate_tables shares between tables, see agg_cache
+AGG_CACHE_MB = 512
+
+#batches per worker process the tables are split into, restrictions whose tables
+#cost more than a batch are built in several, see table_batches
+TABLE_BATCH_SPLIT = 4
+
+#label columns cross-tabs can group on or restrict, every table spec column
+#besides base_pop, which the histogram store tabulates as the aggregation engine does
+QUERY_DIMENSIONS = ['state', 'labforce', 'emp_type', 'emp_stat', 'education', 'EDUC2', 'sex',
+                    'race', 'age', 'hispanic', 'industry', 'occupation']
+
+#dimension groupings the histogram store keeps, a cross-tab is answered from the
+#smallest grouping holding all of its group and restriction columns. base_pop is
+#part of every grouping
+QUERY_GROUPINGS = [
+    ['state', 'labforce', 'emp_stat', 'sex'],
+    ['state', 'labforce', 'education'],
+    ['state', 'labforce', 'age'],
+    ['state', 'labforce', 'race', 'hispanic'],
+    ['labforce', 'emp_type', 'emp_stat', 'education', 'EDUC2', 'age'],
+    ['labforce', 'emp_stat', 'sex', 'race', 'hispanic', 'age'],
+    ['labforce', 'emp_stat', 'sex', 'education', 'EDUC2', 'race'],
+    ['labforce', 'emp_type', 'emp_stat', 'industry', 'sex'],
+    ['labforce', 'emp_type', 'emp_stat', 'occupation', 'sex'],
+    ['labforce', 'industry', 'occupation']
+    ]
+
+#width in dollars of the weekly earnings buckets of the histograms, see update_histograms
+QUERY_EARNINGS_BUCKET = 25
+
+#memory budget of the cross-tab cache and port of its http endpoint, see serve_crosstab
+QUERY_CACHE_MB = 256
+QUERY_PORT = 8050
+
+#columns of the aggregate output written by generate_tables, in file order
+AGGREGATE_COLUMNS = [
+    'state', 
+    'base_pop', 
+    'labforce',
+    'emp_type', 
+    'emp_stat',
+    'education', 
+    'sex', 
+    'race',
+    'age', 
+    'industry', 
+    'occupation',
+    'population_total',
+    'population_PECERT1_y',
+    'population_PECERT1_n', 
+    'population_PECERT2_y', 
+    'population_PECERT2_n',
+    'population_observed_total',
+    'population_observed_PECERT1_y', 
+    'population_observed_PECERT1_n',
+    'population_observed_PECERT2_y', 
+    'population_observed_PECERT2_n',
+    'median_earnings_total',
+    'median_earnings_PECERT1_y', 
+    'median_earnings_PECERT1_n',
+    'median_earnings_PECERT2_y', 
+    'median_earnings_PECERT2_n',
+    'earnings_observed_total',
+    'earnings_observed_PECERT1_y', 
+    'earnings_observed_PECERT1_n',
+    'earnings_observed_PECERT2_y', 
+    'earnings_observed_PECERT2_n'
+    ]
+
+#labels identifying an output row, the remaining columns are measures
+OUTPUT_KEYS = AGGREGATE_COLUMNS[:11]
+
+#columns of the final output, the aggregate columns followed by the smoothed populations
+OUTPUT_COLUMNS = AGGREGATE_COLUMNS + [
+    'population_PECERT1_y_sm',
+    'population_PECERT1_n_sm',
+    'population_PECERT2_y_sm',
+    'population_PECERT2_n_sm'
+    ]
+
+#microdata and cache budget of a table worker process, see share_microdata
+_table_data = None
+_table_cache_mb = AGG_CACHE_MB
 
 def month_switch(mo):
     '''
@@ -38,98 +259,289 @@ def month_switch(mo):
         }
     return(switcher.get(mo))
 
-def get_raw_data(start_year_4_dig,end_year_4_dig):
+def file_hash(fname, chunk_size=2**20):
+    '''
+    sha1 of a file's contents, read in chunks
+    
+    :param fname: string file path
+    :param chunk_size: int default 1MB, bytes read at a time
+    '''
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    
+    return(h.hexdigest())
+
+def input_signature(files, *values):
+    '''
+    hash of the contents of files and of any extra values, a stage whose
+    input signature is unchanged has nothing new to process. missing files
+    are part of the signature, so a file appearing changes it
+    
+    :param files: list of file paths
+    :param values: extra values the output depends on, ex. selected variables
+    '''
+    h = hashlib.sha1()
+    for f in files:
+        h.update(file_hash(f).encode() if os.path.exists(f) else b'missing')
+    h.update(repr(values).encode())
+    
+    return(h.hexdigest())
+
+def read_pipeline(fname=None):
     '''
-    grabs zip files from census, stores them in file on desktop and unzips them
-    to secondary file as .dat files. also grabs data dictionary for current year
-    and stores that with files.
+    reads the manifest of downloaded files, empty if none has been written
+    
+    :param fname: string default None, manifest path, PIPELINE_MANIFEST in outpath by default
+    '''
+    fname = outpath + PIPELINE_MANIFEST if fname is None else fname
+    if not os.path.exists(fname):
+        return({'version':STORE_VERSION, 'raw':{}})
+    
+    with open(fname) as f:
+        return(json.load(f))
+
+def write_pipeline(manifest, fname=None):
+    '''
+    writes the manifest of downloaded files through a temporary file
+    
+    :param manifest: dict returned by read_pipeline
+    :param fname: string default None, manifest path, PIPELINE_MANIFEST in outpath by default
+    '''
+    fname = outpath + PIPELINE_MANIFEST if fname is None else fname
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(fname + '.tmp', fname)
+
+def download_session(workers=DOWNLOAD_WORKERS):
+    '''
+    requests session whose connection pool holds one connection per transfer,
+    so concurrent downloads reuse connections instead of opening new ones
+    
+    :param workers: int default DOWNLOAD_WORKERS, concurrent transfers
+    '''
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    
+    return(session)
+
+def download_file(url, fname, session=None, entry=None, chunk_size=DOWNLOAD_CHUNK):
+    '''
+    streams url to fname through fname.part, which is moved into place once
+    complete. a .part file left by an interrupted transfer is resumed with a
+    Range request if the server still has the file whose ETag was saved next
+    to it in fname.part.etag, a range the server rejects (416, ex. a .part
+    that was complete but never moved) starts the transfer over. when fname exists and entry holds its ETag or
+    Last-Modified the request is conditional, and an unchanged file is not
+    transferred
+    
+    :param url: string url of the file
+    :param fname: string destination file path
+    :param session: requests Session default None, a new session is used if None
+    :param entry: dict default None, manifest entry of a previous download of fname
+    :param chunk_size: int default DOWNLOAD_CHUNK, bytes written at a time
+    :return: dict of url, file, status ('downloaded', 'resumed', 'not modified',
+        'unavailable' or 'failed'), bytes transferred, etag, last_modified and error
+    '''
+    session = requests.Session() if session is None else session
+    entry = {} if entry is None else entry
+    out = {'url':url, 'file':fname, 'status':'failed', 'bytes':0,
+           'etag':entry.get('etag'), 'last_modified':entry.get('last_modified'), 'error':None}
+    
+    headers = {}
+    if os.path.exists(fname):
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    
+    #resume a partial transfer, only if the server still has the same file
+    part = fname + '.part'
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    if offset > 0 and os.path.exists(part + '.etag'):
+        with open(part + '.etag') as f:
+            headers['Range'] = 'bytes={}-'.format(offset)
+            headers['If-Range'] = f.read()
+    
+    try:
+        r = session.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT)
+        if r.status_code == 416 and 'Range' in headers:
+            #the partial file cannot be resumed, drop it and request the whole file once
+            r.close()
+            for f in [part, part + '.etag']:
+                if os.path.exists(f):
+                    os.remove(f)
+            del headers['Range'], headers['If-Range']
+            r = session.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT)
+        
+        with r:
+            if r.status_code == 304:
+                out['status'] = 'not modified'
+                return(out)
+            if r.status_code == 404:
+                out['status'] = 'unavailable'
+                return(out)
+            r.raise_for_status()
+            
+            out['etag'] = r.headers.get('ETag')
+            out['last_modified'] = r.headers.get('Last-Modified')
+            
+            resumed = r.status_code == 206
+            if not resumed and out['etag'] is not None:
+                with open(part + '.etag', 'w') as f:
+                    f.write(out['etag'])
+            with open(part, 'ab' if resumed else 'wb') as fd:
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    fd.write(chunk)
+                    out['bytes'] += len(chunk)
+    except (requests.RequestException, OSError) as e:
+        out['error'] = str(e)
+        return(out)
+    
+    os.replace(part, fname)
+    if os.path.exists(part + '.etag'):
+        os.remove(part + '.etag')
+    out['status'] = 'resumed' if resumed else 'downloaded'
+    
+    return(out)
+
+def fetch_raw(url, fname, manifest, refresh=False, session=None):
+    '''
+    downloads url to fname unless the file is already there with the hash the
+    manifest recorded for it, and records the hash, size and validators of
+    what was downloaded. with refresh the server is asked whether a present
+    file changed, so only revised files are transferred again. the manifest
+    is only read, so downloads can run on threads while it is being written
+    
+    :param url: string url of the file
+    :param fname: string destination file path
+    :param manifest: dict returned by read_pipeline
+    :param refresh: bool default False, check files already downloaded for revisions
+    :param session: requests Session default None, shared by concurrent downloads
+    :return: dict outcome from download_file, status 'skipped' when no request
+        was made, changed True when fname is new or its contents changed and
+        entry, the manifest entry for fname or None if it has none
+    '''
+    entry = manifest['raw'].get(fname)
+    verified = entry is not None and os.path.exists(fname) and file_hash(fname) == entry['sha1']
+    if verified and not refresh:
+        return({'url':url, 'file':fname, 'status':'skipped', 'bytes':0, 'error':None, 'changed':False, 'entry':entry})
+    
+    #validators only apply to the file they were sent with
+    out = download_file(url, fname, session, entry if verified else None)
+    out['changed'] = False
+    out['entry'] = entry if verified else None
+    if out['status'] in ['downloaded','resumed']:
+        digest = file_hash(fname)
+        out['changed'] = entry is None or entry['sha1'] != digest
+        out['entry'] = {'url':url, 'sha1':digest, 'bytes':os.path.getsize(fname),
+                        'etag':out['etag'], 'last_modified':out['last_modified']}
+    
+    return(out)
+
+def extract_zip(zname, outdir, force=False):
+    '''
+    extracts a zip file unless every member is already in outdir, .cps members
+    count as present once renamed to .dat
+    
+    :param zname: string file path to zip
+    :param outdir: string directory to extract to
+    :param force: bool default False, extract even if the members are present
+    '''
+    with zipfile.ZipFile(zname,'r') as zip_ref:
+        present = [os.path.exists(os.path.join(outdir, n)) or os.path.exists(os.path.join(outdir, n[:-4] + '.dat'))
+                   for n in zip_ref.namelist()]
+        if force or not all(present):
+            zip_ref.extractall(outdir)
+
+def get_raw_data(start_year_4_dig,end_year_4_dig,refresh=False,workers=DOWNLOAD_WORKERS,base_url=CENSUS_URL,extract=False):
+    '''
+    grabs zip files from census and stores them in file on desktop, records
+    are parsed straight from the zips so they are only unzipped to secondary
+    file as .dat files when asked. also grabs data dictionary for current year
+    and stores that with files. files are downloaded concurrently over one
+    session, files already downloaded with the hash recorded in the pipeline
+    manifest are not downloaded or extracted again
     
     :param start_year_4_dig: starting year for range observed (int)
     :param end_year_4_dig: ending year for range observed (int)
+    :param refresh: bool default False, ask census whether downloaded files were revised
+    :param workers: int default DOWNLOAD_WORKERS, concurrent transfers
+    :param base_url: string default CENSUS_URL, server the files are requested from
+    :param extract: bool default False, also unzip the data files, ex. for debugging
+    :return: DataFrame with the outcome of each file
     '''
+    manifest = read_pipeline()
+    
+    #list of months
+    list_test = ["jan","feb","mar","apr","may","jun","jul","aug","sep","oct","nov","dec"]
+    
+    #most recent data dictionary, kept where LAYOUT_SCHEDULE expects it
+    jobs = []
+    dat_dict = base_url + '/programs-surveys/cps/datasets/2020/basic/2020_Basic_CPS_Public_Use_Record_Layout_plus_IO_Code_list.txt'
+    jobs.append((dat_dict, newpath + '/cps_20/' + dat_dict.split('/')[-1], None))
     
     for year in range(int(start_year_4_dig),int(end_year_4_dig)+1):
         yr = int(str(year)[2:4])
         
         yearpath_uz = newpath + '/cps_' + str(yr)
-        if not os.path.exists(yearpath_uz):
-            os.makedirs(yearpath_uz)
         yearpath_z = outpath + 'cps_' + str(yr) + '_ziped/'
-        if not os.path.exists(yearpath_z):
-            os.makedirs(yearpath_z)
-        
         
-        #check year, define extension
-        #list of months
-        list_test = ["jan","feb","mar","apr","may","jun","jul","aug","sep","oct","nov","dec"]
-        
-        #loop that takes data from CPS and dowloads to computer
         for mo in range(1,len(list_test)+1):
-            #most recent data dictionary
-            dat_dict = 'https://www2.census.gov/programs-surveys/cps/datasets/2020/basic/2020_Basic_CPS_Public_Use_Record_Layout_plus_IO_Code_list.txt'
-            
             month = month_switch(mo)
-            url = "https://www2.census.gov/programs-surveys/cps/datasets/{}/basic/{}{}pub.zip".format(year,month,yr)
-            outfname = yearpath_z + url.split('/')[-1]
-            out_text_name = yearpath_uz + '/' + dat_dict.split('/')[-1]
-
-            try:
-                r = requests.get(url, stream=True)
-                if(r.status_code == requests.codes.ok):
-                    with open(outfname,"wb") as fd:
-                        for chunk in r.iter_content(chunk_size=1024):
-                            if chunk:
-                                fd.write(chunk)
-                        fd.close()
-                with zipfile.ZipFile('{}{}{}pub.zip'.format(yearpath_z,month,yr),'r') as zip_ref:
-                    zip_ref.extractall(yearpath_uz)
-            except:
-                print(month + " " + str(year) + " data is unavaiable at this time")
-            try:
-                r = requests.get(dat_dict, stream=True)
-                if(r.status_code == requests.codes.ok):
-                    with open(out_text_name,"wb") as fd:
-                        for chunk in r.iter_content(chunk_size=1024):
-                            if chunk:
-                                fd.write(chunk)
-                        fd.close()
-            except:
-                np.nan
+            url = base_url + "/programs-surveys/cps/datasets/{}/basic/{}{}pub.zip".format(year,month,yr)
+            jobs.append((url, yearpath_z + url.split('/')[-1], yearpath_uz if extract else None))
         
         #add in extract files for cert and lic for 2015 and 2016
         if year in [2015,2016]:
-            dat_dict2 = 'https://www2.census.gov/programs-surveys/cps/datasets/2015/supp/Certification_extract_file_{}_rec_layout.txt'.format(year)
-            url2 = 'https://www2.census.gov/programs-surveys/cps/datasets/2015/supp/jan{}-dec{}cert_ext.zip'.format(yr,yr)
-            outfname2 = yearpath_z + url2.split('/')[-1]
-            out_text_name2 = yearpath_uz + '/' + dat_dict2.split('/')[-1]
-            
-            try:
-                r = requests.get(url2, stream=True)
-                if(r.status_code == requests.codes.ok):
-                    with open(outfname2,"wb") as fd:
-                        for chunk in r.iter_content(chunk_size=1024):
-                            if chunk:
-                                fd.write(chunk)
-                        fd.close()
-                with zipfile.ZipFile(outfname2,'r') as zip_ref:
-                    zip_ref.extractall(yearpath_uz)
-            except:
-                print("{} data is unavaiable at this time".format(url2.split('/')[-1]))
-            try:
-                r = requests.get(dat_dict2, stream=True)
-                if(r.status_code == requests.codes.ok):
-                    with open(out_text_name2,"wb") as fd:
-                        for chunk in r.iter_content(chunk_size=1024):
-                            if chunk:
-                                fd.write(chunk)
-                        fd.close()
-            except:
-                np.nan
-
-        print("{} data has been exported to your desktop in the cpsData folder".format(year))
-
-    for filename in glob.iglob(os.path.join(yearpath_uz, '*.cps')):
-        os.rename(filename, filename[:-4] + '.dat')
+            dat_dict2 = base_url + '/programs-surveys/cps/datasets/2015/supp/Certification_extract_file_{}_rec_layout.txt'.format(year)
+            url2 = base_url + '/programs-surveys/cps/datasets/2015/supp/jan{}-dec{}cert_ext.zip'.format(yr,yr)
+            jobs.append((url2, yearpath_z + url2.split('/')[-1], yearpath_uz if extract else None))
+            jobs.append((dat_dict2, yearpath_uz + '/' + dat_dict2.split('/')[-1], None))
+    
+    for url, fname, outdir in jobs:
+        for d in [os.path.dirname(fname), outdir]:
+            if d is not None and not os.path.exists(d):
+                os.makedirs(d)
+    
+    #transfers run on threads, archives are extracted and the manifest written
+    #here as each finishes so an interrupted run resumes where it stopped
+    results = []
+    session = download_session(workers)
+    with ThreadPoolExecutor(workers) as executor:
+        futures = {executor.submit(fetch_raw, url, fname, manifest, refresh, session):(fname, outdir) for url, fname, outdir in jobs}
+        for future in as_completed(futures):
+            fname, outdir = futures[future]
+            out = future.result()
+            entry = out.pop('entry')
+            if entry is None:
+                manifest['raw'].pop(fname, None)
+            else:
+                manifest['raw'][fname] = entry
+            if outdir is not None and os.path.exists(fname):
+                try:
+                    extract_zip(fname, outdir, force=out['changed'])
+                except zipfile.BadZipFile as e:
+                    out['status'] = 'failed'
+                    out['error'] = str(e)
+            if out['status'] in ['unavailable','failed']:
+                print("{} is {} at this time".format(fname.split('/')[-1], 'unavaiable' if out['status'] == 'unavailable' else 'failed'))
+            results.append(out)
+            write_pipeline(manifest)
+    session.close()
+    
+    for year in range(int(start_year_4_dig),int(end_year_4_dig)+1):
+        for filename in glob.iglob(os.path.join(newpath + '/cps_' + str(year)[2:4], '*.cps')):
+            os.rename(filename, filename[:-4] + '.dat')
+    
+    results = pd.DataFrame(results).set_index('file').loc[[fname for url, fname, outdir in jobs]]
+    print(results['status'].value_counts().to_string())
+    print("{} through {} data has been exported to your desktop in the cpsData folder".format(start_year_4_dig, end_year_4_dig))
+    
+    return(results)
 
 def get_dict(file):
     '''
@@ -150,7 +562,813 @@ def get_dict(file):
     
     return(d)
 
-def clean_data(var_int, start_year_4_dig,end_year_4_dig,dfile):
+def decode_fixed_width(buf, dd_sel_var):
+    '''
+    decodes selected columns from a buffer of fixed-width census records using
+    numpy, the buffer is viewed as a fixed-stride record matrix and each field
+    is converted with ascii digit arithmetic instead of int() per field per line
+    
+    :param buf: bytes containing whole records, each terminated by a newline
+    :param dd_sel_var: list of (name, start, end) tuples from the data dictionary
+    :return: dict of column name to typed numpy array
+    '''
+    if len(buf) == 0:
+        return({v[0]:np.zeros(0, dtype=np.int64) for v in dd_sel_var})
+    if not buf.endswith(b'\n'):
+        buf = buf + b'\n'
+    raw = np.frombuffer(buf, dtype=np.uint8)
+    
+    #record length is taken from the first line, census files are fixed width
+    reclen = buf.find(b'\n') + 1
+    nrec = len(raw) // reclen
+    
+    if nrec * reclen == len(raw) and (raw[reclen-1::reclen] == 10).all():
+        rec = raw.reshape(nrec, reclen)
+    else:
+        #ragged lines, pad each line out to the longest record
+        lines = buf.split(b'\n')[:-1]
+        nrec = len(lines)
+        width = max([len(i) for i in lines] + [1])
+        rec = np.array(lines, dtype='S{}'.format(width)).view(np.uint8).reshape(nrec, width)
+    
+    #gather the bytes of every selected field once, one contiguous row per byte position
+    idx = np.concatenate([np.arange(a, b) for _, a, b in dd_sel_var] + [np.zeros(0, dtype=int)])
+    cols = np.ascontiguousarray(rec[:, idx].T)
+    dig = cols - 48
+    isdig = dig <= 9
+    
+    #anything other than digits, signs, whitespace or padding fails like int()
+    valid = isdig | (cols == 45) | (cols == 43) | (cols == 32) | (cols == 9) | (cols == 13) | (cols == 0)
+    
+    out = {}
+    pos = 0
+    for name, a, b in dd_sel_var:
+        w = b - a
+        seen = isdig[pos:pos+w].any(axis=0)
+        if not (seen.all() and valid[pos:pos+w].all()):
+            row = int(np.argmin(seen & valid[pos:pos+w].all(axis=0)))
+            raise ValueError("invalid literal for int() with base 10: {!r}".format(bytes(rec[row, a:b])))
+        
+        #horner's rule down the field, skipping padding so values match int()
+        val = np.zeros(nrec, dtype=np.int64)
+        for k in range(pos, pos + w):
+            np.multiply(val, 10, out=val, where=isdig[k])
+            np.add(val, dig[k], out=val, where=isdig[k])
+        neg = (cols[pos:pos+w] == 45).any(axis=0)
+        val[neg] *= -1
+        pos += w
+        
+        #fields of up to 9 digits fit in 32 bits, weights and ids need 64
+        out[name] = val.astype(np.int32) if w <= 9 else val
+    
+    return(out)
+
+def raw_file(inputdir, zipdir, stem):
+    '''
+    locates a raw census file, the downloaded zip when there is one or else
+    a .dat file extracted into inputdir
+    
+    :param inputdir: string directory of extracted files, ex. newpath/cps_16
+    :param zipdir: string directory of downloaded zips, ex. outpath/cps_16_ziped/
+    :param stem: string file name without extension, ex. jan16pub
+    :return: string file path, None if neither exists
+    '''
+    for f in [zipdir + stem + '.zip', inputdir + '/' + stem + '.dat']:
+        if os.path.exists(f):
+            return(f)
+    
+    return(None)
+
+def open_records(fname):
+    '''
+    opens a raw census file for reading as a binary stream. zips are read
+    through their data member (.dat or .cps) without extracting it
+    
+    :param fname: string file path to .dat or .zip file
+    '''
+    if not fname.lower().endswith('.zip'):
+        return(open(fname, 'rb'))
+    
+    zf = zipfile.ZipFile(fname, 'r')
+    members = [i for i in zf.namelist() if i.lower().endswith(('.dat','.cps'))]
+    if len(members) != 1:
+        zf.close()
+        raise ValueError("{} holds {} data files, expected one".format(fname, len(members)))
+    
+    #the member stream keeps its own handle, the archive closes with it
+    stream = zf.open(members[0])
+    zf.close()
+    
+    return(stream)
+
+def read_fixed_width(fname, dd_sel_var, block_size=RECORD_BLOCK):
+    '''
+    streams a fixed-width census file, or the data file inside a census zip,
+    in blocks of whole records and returns the selected columns as a typed
+    DataFrame. only one block of raw bytes is held at a time
+    
+    :param fname: string file path to .dat or .zip file
+    :param dd_sel_var: list of (name, start, end) tuples from the data dictionary
+    :param block_size: int default RECORD_BLOCK, bytes read per block
+    '''
+    blocks = []
+    rest = b''
+    with open_records(fname) as f:
+        while True:
+            chunk = f.read(block_size)
+            if not chunk:
+                break
+            
+            #decode up to the last full record, carry the partial one over
+            buf = rest + chunk
+            end = buf.rfind(b'\n') + 1
+            rest = buf[end:]
+            if end > 0:
+                blocks.append(decode_fixed_width(buf[:end], dd_sel_var))
+    
+    if len(rest) > 0 or len(blocks) == 0:
+        blocks.append(decode_fixed_width(rest, dd_sel_var))
+    
+    if len(blocks) == 1:
+        return(pd.DataFrame(blocks[0]))
+    
+    return(pd.DataFrame({v[0]:np.concatenate([b[v[0]] for b in blocks]) for v in dd_sel_var}))
+
+def layout_file(year, mo):
+    '''
+    selects the record layout that applies to a given data month
+
+    :param year: 4 digit year of the data (int)
+    :param mo: month number (int)
+    :return: string path to the record layout, relative to newpath
+    '''
+    month = 100*int(year) + int(mo)
+
+    dict_loc = LAYOUT_SCHEDULE[0][1]
+    for start, loc in LAYOUT_SCHEDULE:
+        if month >= start:
+            dict_loc = loc
+
+    return(dict_loc)
+
+def get_layout(dd_file, pattern=LAYOUT_PATTERN, cache_dir=None):
+    '''
+    parses a census record layout once into a compact layout dict. parsed
+    layouts are kept in memory and persisted to cps_layouts.pkl in newpath,
+    keyed by a hash of the layout file, so an edited file is parsed again
+
+    layout dicts hold the format version, source file name, hash and an
+    ordered columns dict of name -> (start, end, width, dtype), start is zero
+    based so columns can be sliced directly from a record
+
+    :param dd_file: string file path to record layout text file
+    :param pattern: string regular expression locating variable rows
+    :param cache_dir: optional directory for cps_layouts.pkl, defaults to newpath
+    '''
+    with open(dd_file, 'rb') as f:
+        raw = f.read()
+
+    h = hashlib.sha1(raw + pattern.encode() + str(LAYOUT_VERSION).encode()).hexdigest()
+    if h in _layouts:
+        return(_layouts[h])
+
+    #check for layouts parsed in a previous session
+    cache_file = os.path.join(newpath if cache_dir is None else cache_dir, 'cps_layouts.pkl')
+    cache = {}
+    if os.path.exists(cache_file):
+        try:
+            cache = get_dict(cache_file)
+        except Exception:
+            cache = {}
+
+    if h not in cache:
+        dd_full = raw.decode('iso-8859-1').replace('\r\n', '\n')
+
+        columns = {}
+        for i in re.findall(pattern, dd_full):
+            start, end = int(i[3])-1, int(i[4])
+            width = end - start
+            if i[0] not in columns:
+                columns[i[0]] = (start, end, width, 'int32' if width <= 9 else 'int64')
+
+        cache[h] = {
+            'version':LAYOUT_VERSION,
+            'source':os.path.basename(dd_file),
+            'hash':h,
+            'columns':columns
+            }
+
+        #write through a temporary file so parallel workers never see a partial cache
+        tmp_file = '{}.{}'.format(cache_file, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(cache, f)
+        os.replace(tmp_file, cache_file)
+
+    _layouts[h] = cache[h]
+
+    return(_layouts[h])
+
+def layout_columns(layout, include=None, exclude=()):
+    '''
+    selects (name, start, end) tuples from a layout, in record order, for use
+    with the fixed-width parser
+
+    :param layout: layout dict from get_layout
+    :param include: optional list of variable names to keep, default all
+    :param exclude: optional list of variable names to drop
+    '''
+    return([(name, v[0], v[1]) for name, v in layout['columns'].items()
+            if (include is None or name in include) and name not in exclude])
+
+def compile_recode(recode):
+    '''
+    turns a RECODES entry into sorted, non overlapping intervals so the recode
+    can be looked up with a single searchsorted
+    
+    :param recode: dict, see RECODES
+    :return: dict of interval starts, ends, category codes and categories
+    '''
+    if 'bins' in recode:
+        edges = recode['bins']
+        intervals = list(zip(edges[:-1], edges[1:], recode['labels']))
+    else:
+        ranges = list(recode.get('ranges', [])) + [(v, v, label) for v, label in recode.get('values', {}).items()]
+        intervals = [(lo, hi + 1, label) for lo, hi, label in ranges]
+    intervals = sorted(intervals, key=lambda i: i[0])
+    
+    for a, b in zip(intervals[:-1], intervals[1:]):
+        if b[0] < a[1]:
+            raise ValueError('overlapping recode intervals in {}: {} and {}'.format(recode['name'], a, b))
+    
+    #categories in order of first appearance in the definition
+    labels = [i[2] for i in intervals] + [recode.get('default')]
+    categories = []
+    for label in labels:
+        if label is not None and label not in categories:
+            categories.append(label)
+    ordered = recode['labels'] if 'bins' in recode else [i[2] for i in recode.get('ranges', [])] + list(recode.get('values', {}).values())
+    categories = sorted(categories, key=lambda c: ordered.index(c) if c in ordered else len(ordered))
+    
+    default = recode.get('default')
+    
+    return({
+        'discrete':'bins' not in recode,
+        'starts':np.array([i[0] for i in intervals], dtype=np.float64),
+        'ends':np.array([i[1] for i in intervals], dtype=np.float64),
+        'codes':np.array([categories.index(i[2]) for i in intervals], dtype=np.int32),
+        'default':-1 if default is None else categories.index(default),
+        'categories':pd.Index(categories, dtype=object)
+        })
+
+def interval_codes(lut, x):
+    '''
+    category codes of values looked up in a compiled recode
+    
+    :param lut: dict returned by compile_recode
+    :param x: np.ndarray of float64 values
+    '''
+    #interval each value falls in, if any
+    pos = np.searchsorted(lut['starts'], x, side='right') - 1
+    inside = (pos >= 0) & (x < lut['ends'][np.maximum(pos, 0)])
+    if lut['discrete']:
+        #ranges and values only cover whole numbers
+        inside &= x == np.floor(x)
+    
+    return(np.where(inside, lut['codes'][np.maximum(pos, 0)] if len(lut['codes']) > 0 else -1, lut['default']))
+
+def lookup_codes(lut, x):
+    '''
+    category codes of a column looked up in a compiled recode, integer columns
+    that span a small range resolve each distinct value once and gather
+    
+    :param lut: dict returned by compile_recode
+    :param x: np.ndarray of values
+    '''
+    if x.dtype.kind in 'iu' and len(x) > 0 and int(x.max()) - int(x.min()) < len(x):
+        lo = int(x.min())
+        return(interval_codes(lut, np.arange(lo, int(x.max()) + 1, dtype=np.float64))[x - lo])
+    
+    return(interval_codes(lut, x.astype(np.float64)))
+
+def where_mask(df, where):
+    '''
+    rows of df inside every inclusive (lo, hi) range of where, either bound may
+    be None. missing values are outside every range
+    
+    :param df: DataFrame holding the range columns
+    :param where: dict of column -> (lo, hi)
+    :return: boolean np.ndarray
+    '''
+    keep = np.ones(len(df), dtype=bool)
+    for col, (lo, hi) in where.items():
+        v = df[col].to_numpy(dtype=np.float64)
+        keep &= ~np.isnan(v)
+        if lo is not None:
+            keep &= v >= lo
+        if hi is not None:
+            keep &= v <= hi
+    
+    return(keep)
+
+def apply_recodes(df, recodes=RECODES):
+    '''
+    evaluates derived variables in one vectorized pass each, values are binned
+    with searchsorted against the compiled intervals (integer columns through a
+    lookup table over their range) and returned as pd.Categorical
+    
+    :param df: DataFrame holding the source columns
+    :param recodes: list default RECODES, recode definitions
+    :return: dict of recode name -> pd.Categorical
+    '''
+    out = {}
+    for recode in recodes:
+        lut = compile_recode(recode)
+        codes = lookup_codes(lut, df[recode['source']].to_numpy())
+        codes[~where_mask(df, recode.get('where', {}))] = -1
+        
+        out[recode['name']] = pd.Categorical.from_codes(codes, categories=lut['categories'])
+    
+    return(out)
+
+def compile_encoding(nums_to_names):
+    '''
+    compiles each variable of the census encoding into a lookup table, see compile_recode
+    
+    :param nums_to_names: dict of variable -> {code: label}, see get_dict
+    '''
+    return({v:compile_recode({'name':v, 'source':v, 'values':nums_to_names[v]}) for v in nums_to_names})
+
+def decode_column(lut, col):
+    '''
+    decodes a numeric census column into labels. codes missing from the
+    encoding keep their numeric value as a category of their own, as
+    DataFrame.replace left them
+    
+    :param lut: compiled encoding of the variable, see compile_encoding
+    :param col: pd.Series of census codes
+    :return: pd.Categorical
+    '''
+    x = col.to_numpy()
+    codes = lookup_codes(lut, x)
+    categories = lut['categories']
+    
+    unmapped = (codes == -1) & ~pd.isna(x)
+    if unmapped.any():
+        extra, inverse = np.unique(x[unmapped], return_inverse=True)
+        codes[unmapped] = len(categories) + inverse
+        categories = categories.append(pd.Index(extra.tolist(), dtype=object))
+    
+    return(pd.Categorical.from_codes(codes, categories=categories))
+
+def map_categories(col, mapping):
+    '''
+    relabels a categorical column through a label -> label map by remapping its
+    codes, categories missing from the map are kept
+    
+    :param col: pd.Series, converted to categorical if it is not one
+    :param mapping: dict of old label -> new label
+    :return: pd.Categorical
+    '''
+    col = col.array if isinstance(col.dtype, pd.CategoricalDtype) else pd.Categorical(col)
+    
+    #categories of the result in order of first appearance
+    new = [mapping.get(c, c) for c in col.categories]
+    categories = list(dict.fromkeys(new))
+    remap = np.array([categories.index(c) for c in new] + [-1], dtype=np.int64)
+    
+    return(pd.Categorical.from_codes(remap[col.codes], categories=pd.Index(categories, dtype=object)))
+
+def load_month(fname, dd_sel_var, year, mo):
+    '''
+    parses, filters and recodes a single month of cps microdata, runs in a
+    worker process when months are ingested in parallel so it only depends
+    on its arguments
+    
+    :param fname: string file path to month .dat or .zip file
+    :param dd_sel_var: list of (name, start, end) tuples from the record layout
+    :param year: 4 digit year of the data (int)
+    :param mo: month number (int)
+    :return: dict of column name to numpy array, None if the month could not be loaded
+    '''
+    try:
+        # Decode selected columns straight into a typed dataframe
+        df = read_fixed_width(fname, dd_sel_var)
+        
+        #restrict to the civilian noninstitutional labor force
+        df = df[df['PRTAGE'] >= 16]
+        df = df[df['PRPERTYP'] == 2] #adults only, no military
+
+        #eliminate non-responses from vacant housing units
+        df = df[df['HWHHWGT'] > 0]
+
+        #convert weights, census implies 4 decimal places
+        df['PWSSWGT']=df['PWSSWGT']/10000
+        df['PWORWGT']=df['PWORWGT']/10000
+        df['PWVETWGT']=df['PWVETWGT']/10000
+
+        #pretty sure the avg weekly earnings variable has implied 2 decimal places
+        df['PRERNWA']=df['PRERNWA']/100
+
+        #add individual weight in order to calculate number of observations
+        df['individual']=1;
+
+        #derived variables, defined in RECODES
+        for name, col in apply_recodes(df).items():
+            df[name] = col
+
+        #new variable for combined datasets
+        df['HRMONTH2'] = 100*year+mo
+        
+        #hand back compact columns rather than a pickled dataframe
+        return({c:df[c].array if isinstance(df[c].dtype, pd.CategoricalDtype) else df[c].to_numpy() for c in df.columns})
+    
+    except:
+        return(None)
+
+def concat_columns(parts):
+    '''
+    stacks columnar results (dicts of column name to numpy array or
+    pd.Categorical) into one DataFrame. each output column is preallocated at its final length and
+    filled part by part, instead of repeatedly copying a growing frame.
+    columns missing from a part are filled with nan, as DataFrame.append did
+    
+    :param parts: list of dicts of column name to numpy array
+    '''
+    if len(parts) == 0:
+        return(pd.DataFrame())
+    
+    sizes = [len(next(iter(p.values()))) if len(p) > 0 else 0 for p in parts]
+    total = sum(sizes)
+    
+    #union of columns in order of first appearance
+    columns = []
+    for p in parts:
+        columns += [c for c in p if c not in columns]
+    
+    out = {}
+    for c in columns:
+        #text columns arrive as categoricals, merge their categories once
+        if any(isinstance(p[c], pd.Categorical) for p in parts if c in p):
+            cats = [p[c] if c in p else pd.Categorical.from_codes(np.full(n, -1), categories=pd.Index([], dtype=object))
+                    for p, n in zip(parts, sizes)]
+            out[c] = pd.api.types.union_categoricals(cats)
+            continue
+        
+        dtypes = [p[c].dtype for p in parts if c in p]
+        dtype = np.result_type(*dtypes)
+        if any(c not in p for p, n in zip(parts, sizes) if n > 0):
+            dtype = np.result_type(dtype, np.float64) if dtype != object else dtype
+        
+        buf = np.empty(total, dtype=dtype)
+        pos = 0
+        for p, n in zip(parts, sizes):
+            buf[pos:pos+n] = p[c] if c in p else np.nan
+            pos += n
+        out[c] = buf
+    
+    #copy=False hands the buffers to pandas without consolidating them again
+    return(pd.DataFrame(out, copy=False))
+
+def clean_year(var_int, year, dfile, inputroot, outputdir, workers=1, export_csv=False, force=False, ziproot=None):
+    '''
+    pulls in and cleans a single year of data, combining months and exporting
+    the year to the compiled data folder. months whose raw file, layout,
+    dictionary and variables match the inputs their partition was written
+    from are skipped
+    
+    :param var_int: list containing variables of interest to be retained through cleaning
+    :param year: 4 digit year to be cleaned (int)
+    :param dfile: string file path to nums_to_names data cleaning dictionary
+    :param inputroot: string directory holding the unzipped cps_{yy} folders (newpath)
+    :param outputdir: string directory cleaned files are written to
+    :param workers: int default 1, number of processes months are parsed on
+    :param export_csv: bool default False, also write the year to cps_{yy}.csv,
+        every month is cleaned again
+    :param force: bool default False, clean every month even if its inputs are unchanged
+    :param ziproot: string default None, directory holding the downloaded cps_{yy}_ziped
+        folders (outpath), raw files are read from the zips when present
+    '''
+    #check year, define extension
+    yr = int(str(year)[2:4])
+    
+    inputdir = inputroot + '/cps_' + str(yr)
+    zipdir = (outpath if ziproot is None else ziproot) + 'cps_' + str(yr) + '_ziped/'
+    
+    #list of months
+    mo_list = ["jan","feb","mar","apr","may","jun","jul","aug","sep","oct","nov","dec"]
+    
+    #certification extracts merged into 2015 and 2016
+    extracts = []
+    cert_file = raw_file(inputdir, zipdir, 'jan{0}-dec{0}cert_ext'.format(yr))
+    if year in [2015,2016]:
+        extracts = [inputdir + '/Certification_extract_file_{}_rec_layout.txt'.format(year),
+                    inputdir + '/jan{0}-dec{0}cert_ext.dat'.format(yr) if cert_file is None else cert_file]
+    
+    #months cleaned from the same inputs as their partition are up to date
+    written = {m['month']:m.get('inputs') for m in read_manifest(outputdir).values() if m['year'] == year}
+    raw = {}
+    signatures = {}
+    for mo in range(1,len(mo_list)+1):
+        raw[mo] = raw_file(inputdir, zipdir, month_switch(mo) + str(yr) + "pub")
+        if raw[mo] is not None:
+            signatures[mo] = input_signature([raw[mo], inputroot + layout_file(year, mo), dfile] + extracts,
+                                             sorted(var_int), STORE_VERSION)
+    months = [mo for mo in signatures if force or export_csv or written.get(mo) != signatures[mo]]
+    
+    if len(months) == 0:
+        print(str(year) + " is up to date")
+        return
+    
+    #resolve month files and layouts up front so workers only parse
+    fnames = []
+    layouts = []
+    for mo in months:
+        fnames.append(raw[mo])
+        try:
+            layout = get_layout(inputroot + layout_file(year, mo), cache_dir=inputroot)
+            layouts.append(layout_columns(layout, include=var_int))
+        except:
+            layouts.append(None)
+    years = [year]*len(months)
+    
+    print("loading " + str(year) + " data [",end="")
+    
+    #map keeps month order, so the parallel merge matches the serial one
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(load_month, fnames, layouts, years, months))
+    else:
+        results = map(load_month, fnames, layouts, years, months)
+    
+    parts = []
+    for res in results:
+        if res is not None:
+            parts.append(res)
+        print("==", end ="")
+    
+    print("]")
+    
+    #stack months once, each column is allocated at its final size
+    dataframe = concat_columns(parts)
+    del parts
+    
+    #load data dictionary
+    nums_to_names = get_dict(dfile)
+
+    #load in extract files for cert and lic
+    if year == 2015:
+        dict_loc = '/Certification_extract_file_{}_rec_layout.txt'.format(year)
+        dd_file = inputdir + dict_loc
+        layout = get_layout(dd_file, LAYOUT_PATTERN, cache_dir=inputroot)
+        
+        # Keep adjusted results for series of interest
+        dd_sel_var = layout_columns(layout, exclude=['HRYEAR4','PXCERT1','PXCERT2'])
+        
+        # Decode selected columns straight into a typed dataframe
+        df = read_fixed_width(cert_file, dd_sel_var)
+        df.rename(columns={'MONTH':'HRMONTH'}, inplace=True)
+        
+        #add PECERT3 placeholder (not available in 2015)
+        df['PECERT3'] = np.nan
+        
+        #merge with total dataframe
+        dataframe = dataframe.merge(df, left_on=['QSTNUM','PULINENO','HRMONTH'], right_on=['QSTNUM','PULINENO','HRMONTH'], how='left')
+    if year == 2016:
+        dict_loc = '/Certification_extract_file_{}_rec_layout.txt'.format(year)
+        dd_file = inputdir + dict_loc
+        layout = get_layout(dd_file, CERT_2016_PATTERN, cache_dir=inputroot)
+        
+        # Keep adjusted results for series of interest
+        dd_sel_var = layout_columns(layout, exclude=['HRYEAR4','PXCERT1','PXCERT2','PXCERT3'])
+        
+        # Decode selected columns straight into a typed dataframe
+        df = read_fixed_width(cert_file, dd_sel_var)
+        df.rename(columns={'MONTH':'HRMONTH'}, inplace=True)
+                    
+        #merge with total dataframe
+        dataframe = dataframe.merge(df, left_on=['QSTNUM','PULINENO','HRMONTH'], right_on=['QSTNUM','PULINENO','HRMONTH'], how='left')
+    
+    #mask rather than assign so integer columns can be upcast to hold nan
+    dataframe['PRCIVLF'] = dataframe['PRCIVLF'].mask(dataframe['PRCIVLF'] == -1)
+    dataframe['PWSSWGT'] = dataframe['PWSSWGT'].mask(dataframe['PWSSWGT'] < 0)
+    dataframe['PECERT1'] = dataframe['PECERT1'].mask(dataframe['PECERT1'] < 0)
+    dataframe['PECERT2'] = dataframe['PECERT2'].mask(dataframe['PECERT2'] < 0)
+    
+    #finish clean, decode census codes into labels
+    encoding = compile_encoding(nums_to_names)
+    for c in [i for i in encoding if i in dataframe.columns]:
+        dataframe[c] = decode_column(encoding[c], dataframe[c])
+
+    #industry recode
+    ind = {
+        'Agriculture':'Agriculture and related industries',
+        'Forestry, logging, fishing, and hunting':'Agriculture and related industries',
+        'Mining, quarrying, and oil and gas extraction':'Mining, quarrying, and oil and gas extraction',
+        'Construction':'Construction',
+        'Nonmetallic mineral product manufacturing':'Manufacturing',
+        'Primary metals and fabricated metal products':'Manufacturing',
+        'Machinery manufacturing':'Manufacturing',
+        'Computer and electronic product manufacturing':'Manufacturing',
+        'Electrical equipment, appliance manufacturing':'Manufacturing',
+        'Transportation equipment manufacturing':'Manufacturing',
+        'Wood products':'Manufacturing',
+        'Furniture and fixtures manufacturing':'Manufacturing',
+        'Miscellaneous and not specified manufacturing':'Manufacturing',
+        'Food manufacturing':'Manufacturing',
+        'Beverage and tobacco products':'Manufacturing',
+        'Textile, apparel, and leather manufacturing':'Manufacturing',
+        'Paper and printing':'Manufacturing',
+        'Petroleum and coal products manufacturing':'Manufacturing',
+        'Chemical manufacturing':'Manufacturing',
+        'Plastics and rubber products':'Manufacturing',
+        'Wholesale trade':'Wholesale trade',
+        'Retail trade':'Retail trade',
+        'Transportation and warehousing':'Transportation and utilities',
+        'Utilities':'Transportation and utilities',
+        'Publishing industries (except internet)':'Information',
+        'Motion picture and sound recording industries':'Information',
+        'Broadcasting (except internet)':'Information',
+        'Internet publishing and broadcasting':'Information',
+        'Telecommunications':'Information',
+        'Internet service providers and data processing services':'Information',
+        'Other information services':'Information',
+        'Finance':'Financial activities',
+        'Insurance':'Financial activities',
+        'Real estate':'Financial activities',
+        'Rental and leasing services':'Financial activities',		
+        'Professional, scientific, and technical services':'Professional and business services',
+        'Management of companies and enterprises':'Professional and business services',
+        'Administrative and support services':'Professional and business services',
+        'Waste management and remediation services':'Professional and business services',
+        'Educational services':'Education and health services',
+        'Hospitals':'Education and health services',
+        'Health care services, except hospitals':'Education and health services',
+        'Social assistance services':'Education and health services',
+        'Arts, entertainment, and recreation':'Leisure and hospitality',
+        'Accommodation':'Leisure and hospitality',
+        'Food services and drinking places':'Leisure and hospitality',
+        'Repair and maintenance':'Other services',
+        'Personal and laundry services':'Other services',
+        'Membership associations and organizations':'Other services',
+        'Private households':'Other services',
+        'Public administration':'Public administration',
+        'Armed forces':'Public administration'
+        }
+
+    #replace industry variable with more complex industry taxonomy
+    dataframe['PRMJIND1'] = map_categories(dataframe['PRDTIND1'], ind)
+    
+    #add labor force participation variable
+    dataframe['labforce'] = 'NOT IN LABOR FORCE'
+    dataframe.loc[dataframe['PREXPLF'] == 'EMPLOYED','labforce'] = 'EMPLOYED'
+    dataframe.loc[dataframe['PREXPLF'] == 'UNEMPLOYED','labforce'] = 'UNEMPLOYED'
+    #dataframe.loc[dataframe['PEMLR'].isin(['NOT IN LABOR FORCE-RETIRED','NOT IN LABOR FORCE-DISABLED','NOT IN LABOR FORCE-OTHER']), 'labforce'] = 'NOT IN LABOR FORCE'
+
+    #full time / part time lf stat
+    dataframe['emp_stat'] = dataframe['labforce'].copy()
+    dataframe.loc[(dataframe['emp_stat'] == 'EMPLOYED') & (dataframe['PRFTLF']=='PART TIME LABOR FORCE'),'emp_stat'] = 'PART_TIME'
+    dataframe.loc[(dataframe['emp_stat'] == 'EMPLOYED') & (dataframe['PRFTLF']=='FULL TIME LABOR FORCE'),'emp_stat'] = 'FULL_TIME'
+
+    #change non responses to nan for PECERT3
+    dataframe['PECERT3'] = dataframe['PECERT3'].mask(dataframe['PECERT3'] == -1)
+   
+    #export to the columnar store, one partition per month
+    for month, df in dataframe.groupby('HRMONTH2', sort=True):
+        write_partition(df, outputdir, year, int(month) % 100, signatures.get(int(month) % 100))
+    
+    #export to .csv
+    if export_csv:
+        dataframe.to_csv(outputdir + r'/cps_' + str(yr) + '.csv', index = None, header=True)
+    
+    print(str(year) + " export completed")
+
+def _json_scalar(v):
+    '''
+    converts numpy scalars to plain python values so they can be written to json
+    '''
+    return(v.item() if isinstance(v, np.generic) else v)
+
+def write_partition(df, storedir, year, mo, inputs=None):
+    '''
+    writes one month of cleaned data to the columnar store. each column is saved
+    as its own .npy file in {storedir}/{year}/{mm}/ so later stages can memory
+    map only the columns they need. text columns are stored as small integer
+    codes (-1 for missing) with their categories kept in the partition's
+    manifest.json alongside every column's dtype, a hash of the contents and
+    the signature of the inputs the month was cleaned from
+    
+    :param df: DataFrame holding a single month of cleaned data
+    :param storedir: string directory of the columnar store
+    :param year: 4 digit year of the data (int)
+    :param mo: month number (int)
+    :param inputs: string default None, input_signature of the raw files the month came from
+    '''
+    partdir = os.path.join(storedir, str(year), '{:02d}'.format(mo))
+    if not os.path.exists(partdir):
+        os.makedirs(partdir)
+    
+    columns = {}
+    h = hashlib.sha1()
+    for c in df.columns:
+        col = df[c]
+        if isinstance(col.dtype, np.dtype) and col.dtype.kind in 'biuf':
+            values = col.to_numpy()
+            columns[c] = {'dtype':str(values.dtype), 'categories':None}
+        else:
+            if isinstance(col.dtype, pd.CategoricalDtype):
+                codes, cats = col.cat.codes.to_numpy(), col.cat.categories
+            else:
+                codes, cats = pd.factorize(col, use_na_sentinel=True)
+            values = codes.astype(np.int8 if len(cats) < 127 else np.int16 if len(cats) < 32767 else np.int32)
+            columns[c] = {'dtype':'category', 'categories':[_json_scalar(v) for v in cats]}
+        np.save(os.path.join(partdir, c + '.npy'), values)
+        h.update(json.dumps([c, columns[c]]).encode())
+        h.update(np.ascontiguousarray(values).tobytes())
+    
+    manifest = {
+        'version':STORE_VERSION,
+        'year':int(year),
+        'month':int(mo),
+        'rows':len(df),
+        'hash':h.hexdigest(),
+        'inputs':inputs,
+        'columns':columns
+        }
+    
+    #partitions keep their own manifest so parallel years never share a file
+    tmp_file = os.path.join(partdir, 'manifest.json.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_file, os.path.join(partdir, 'manifest.json'))
+
+def read_manifest(storedir):
+    '''
+    collects partition manifests from the columnar store
+    
+    :param storedir: string directory of the columnar store
+    :return: dict of yyyymm string -> partition manifest, in month order
+    '''
+    manifest = {}
+    for f in glob.glob(os.path.join(storedir, '*', '*', 'manifest.json')):
+        with open(f) as fh:
+            m = json.load(fh)
+        if m.get('version') == STORE_VERSION:
+            m['path'] = os.path.dirname(f)
+            manifest['{}{:02d}'.format(m['year'], m['month'])] = m
+    
+    return({k:manifest[k] for k in sorted(manifest)})
+
+def read_partitions(storedir, years=None, months=None, columns=None, mmap=True):
+    '''
+    reads cleaned data from the columnar store, only the requested partitions
+    and columns are opened. text columns come back as pd.Categorical, columns
+    missing from a partition are filled with nan
+    
+    :param storedir: string directory of the columnar store
+    :param years: optional list of 4 digit years to read, default all
+    :param months: optional list of month numbers to read, default all
+    :param columns: optional list of columns to read, default all
+    :param mmap: bool default True, memory map numeric columns of a single partition
+    '''
+    parts = [m for m in read_manifest(storedir).values()
+             if (years is None or m['year'] in years) and (months is None or m['month'] in months)]
+    
+    if columns is None:
+        columns = []
+        for m in parts:
+            columns += [c for c in m['columns'] if c not in columns]
+    if len(parts) == 0:
+        return(pd.DataFrame(columns=columns))
+    
+    out = {}
+    for c in columns:
+        metas = [m['columns'].get(c) for m in parts]
+        if any(meta is not None and meta['dtype'] == 'category' for meta in metas):
+            cats = []
+            for m, meta in zip(parts, metas):
+                if meta is None:
+                    cats.append(pd.Categorical.from_codes(np.full(m['rows'], -1), categories=pd.Index([], dtype=object)))
+                elif meta['dtype'] != 'category':
+                    #numeric in this partition, ex. a month where the column is all nan
+                    values = pd.Series(np.load(os.path.join(m['path'], c + '.npy')))
+                    cats.append(pd.Categorical(values.astype(object).where(values.notna(), None),
+                                               categories=pd.Index(values.dropna().unique(), dtype=object)))
+                else:
+                    codes = np.load(os.path.join(m['path'], c + '.npy'))
+                    cats.append(pd.Categorical.from_codes(codes, categories=pd.Index(meta['categories'], dtype=object)))
+            out[c] = cats[0] if len(cats) == 1 else pd.api.types.union_categoricals(cats)
+        else:
+            arrays = []
+            for m, meta in zip(parts, metas):
+                if meta is None:
+                    arrays.append(np.full(m['rows'], np.nan))
+                else:
+                    arrays.append(np.load(os.path.join(m['path'], c + '.npy'), mmap_mode='r' if mmap else None))
+            out[c] = arrays[0] if len(arrays) == 1 else np.concatenate(arrays)
+    
+    return(pd.DataFrame(out, copy=False))
+
+def clean_data(var_int, start_year_4_dig,end_year_4_dig,dfile,workers=1,parallel_years=False,export_csv=False,force=False):
     '''
     pulls in and cleans all data, combining months within a year and exporting
     them to a specific compiled data folder
@@ -159,277 +1377,28 @@ def clean_data(var_int, start_year_4_dig,end_year_4_dig,dfile):
     :param start_year_4_dig: starting year for range observed (int)
     :param end_year_4_dig: ending year for range observed (int)
     :param dfile: string file path to nums_to_names data cleaning dictionary
+    :param workers: int default 1, number of worker processes used for ingestion
+    :param parallel_years: bool default False, fan whole years out to the workers
+        instead of the months within each year
+    :param export_csv: bool default False, also export each year as cps_{yy}.csv
+    :param force: bool default False, clean months again even if their inputs are unchanged
     '''
     #create path for output
     outputdir = outpath + 'cps_clean_data'
     if not os.path.exists(outputdir):
         os.makedirs(outputdir)
     
-    for year in range(int(start_year_4_dig),int(end_year_4_dig)+1):
-        #check year, define extension
-        yr = int(str(year)[2:4])            
-        
-        inputdir = newpath + '/cps_' + str(yr)
-        
-        #list of months
-        mo_list = ["jan","feb","mar","apr","may","jun","jul","aug","sep","oct","nov","dec"]
-                
-        dataframe = pd.DataFrame()
-        
-        print("loading " + str(year) + " data [",end="")
-        
-        #loop through month .dat files
-        for mo in range(1,len(mo_list)+1):
-            try:
-                #set variable name to be used to locate .dat files
-                month = month_switch(mo)
-                varnam = '/' + month + str(yr)
-                
-                # Data dictionary location of most recent data dictionary
-                if year == 2020:
-                    dict_loc = '/cps_20/2020_Basic_CPS_Public_Use_Record_Layout_plus_IO_Code_list.txt'
-                elif year in [2015,2016]:
-                    dict_loc = '/cps_16/January_2015_Record_Layout.txt'
-                else:
-                    dict_loc = '/cps_17/January_2017_Record_Layout.txt'
-                    
-                dd_file = newpath + dict_loc
-                dd_full = open(dd_file, encoding='iso-8859-1').read()
-                
-                # Regular expression finds rows with variable location details
-                p = re.compile('\n(\w+)\s+(\d+)\s+(.*?)\t+.*?(\d\d*).*?(\d\d+)')
-                
-                # Keep adjusted results for series of interest
-                dd_sel_var = [(i[0], int(i[3])-1, int(i[4])) 
-                              for i in p.findall(dd_full) if i[0] in var_int]
-                
-                # Convert raw data into a list of tuples
-                raw_tup = [tuple(int(line[i[1]:i[2]]) for i in dd_sel_var) 
-                        for line in open(inputdir + varnam +"pub.dat", 'rb')]
-                
-                # Convert to pandas dataframe, add variable ids as heading
-                df = pd.DataFrame(raw_tup, columns=[v[0] for v in dd_sel_var])
-                
-                #restrict to the civilian noninstitutional labor force
-                df = df[df['PRTAGE'] >= 16]
-                df = df[df['PRPERTYP'] == 2] #adults only, no military
-                
-                #eliminate non-responses from vacant housing units
-                df = df[df['HWHHWGT'] > 0]
-                
-                #convert weights, census implies 4 decimal places
-                df['PWSSWGT']=df['PWSSWGT']/10000
-                df['PWORWGT']=df['PWORWGT']/10000
-                df['PWVETWGT']=df['PWVETWGT']/10000
-                
-                #pretty sure the avg weekly earnings variable has implied 2 decimal places
-                df['PRERNWA']=df['PRERNWA']/100
-                
-                #add individual weight in order to calculate number of observations
-                df['individual']=1;
-                
-                #recode full and part time employment
-                df['EMP_STATUS'] = np.nan
-                df.loc[(df['PREMPNOT']==1) & (df['PRFTLF']==2),'EMP_STATUS']="Part-time"
-                df.loc[(df['PREMPNOT']==1) & (df['PRFTLF']==1),'EMP_STATUS']="Full-time"
-                
-                #age recode
-                df['age']="25 to 54"
-                df.loc[df['PRTAGE'] >= 55,'age'] = "55 and older"
-                df.loc[(16<=df['PRTAGE']) & (df['PRTAGE']<25),'age'] = "16 to 24"
-                df.loc[df['PRTAGE'] < 16,'age'] = np.nan
-                
-                df['age2']="65 and older"
-                df.loc[(16<=df['PRTAGE']) & (df['PRTAGE']<25),'age2'] = "16 to 24"
-                df.loc[(25<=df['PRTAGE']) & (df['PRTAGE']<35),'age2'] = "25 to 34"
-                df.loc[(35<=df['PRTAGE']) & (df['PRTAGE']<45),'age2'] = "35 to 44"
-                df.loc[(45<=df['PRTAGE']) & (df['PRTAGE']<55),'age2'] = "45 to 54"
-                df.loc[(55<=df['PRTAGE']) & (df['PRTAGE']<65),'age2'] = "55 to 64"
-                
-                #educational attainment recode
-                df.loc[(df['PRTAGE']>24) & (31<=df['PEEDUCA']) & (df['PEEDUCA']<=38),'EDUC']="NO HIGH SCHOOL DIPLOMA"
-                df.loc[(df['PRTAGE']>24) & (df['PEEDUCA']==39),'EDUC']="HS GRADUATE, NO COLLEGE"
-                df.loc[(df['PRTAGE']>24) & (df['PEEDUCA']==40),'EDUC']="SOME COLLEGE, NO DEGREE"
-                df.loc[(df['PRTAGE']>24) & (41<=df['PEEDUCA']) & (df['PEEDUCA']<=42),'EDUC']="ASSOCIATES DEGREE"
-                df.loc[(df['PRTAGE']>24) & (df['PEEDUCA']==43),'EDUC']="BACHELORS DEGREE"
-                df.loc[(df['PRTAGE']>24) & (44<=df['PEEDUCA']) & (df['PEEDUCA']<=46),'EDUC']="ADVANCED DEGREE"
-                
-                df.loc[(df['PRTAGE']>24) & (40<=df['PEEDUCA']) & (df['PEEDUCA']<=42),'EDUC2']="SOME COLLEGE OR ASSOCIATES"
-                df.loc[(df['PRTAGE']>24) & (43<=df['PEEDUCA']) & (df['PEEDUCA']<=46),'EDUC2']="BACHELORS OR HIGHER"
-                
-                #changed mid skilled classification for most recent update (henry's words)
-                df.loc[(df['PRTAGE']>24) & (31<=df['PEEDUCA']) & (df['PEEDUCA']<=38),'EDUC3']="NO HIGH SCHOOL DIPLOMA"
-                df.loc[(df['PRTAGE']>24) & (df['PEEDUCA']==39),'EDUC3']="HS GRADUATE OR GED"
-                df.loc[(df['PRTAGE']>24) & (40<=df['PEEDUCA']) & (df['PEEDUCA']<=42),'EDUC3']="MID-SKILLED"
-                df.loc[(df['PRTAGE']>24) & (43<=df['PEEDUCA']) & (df['PEEDUCA']<=46),'EDUC3']="BACHELORS OR HIGHER"
-                
-                #changed mid skilled classification for most recent update (henry's words)
-                df.loc[(df['PRTAGE']>24) & (31<=df['PEEDUCA']) & (df['PEEDUCA']<=38),'EDUC3']="NO HIGH SCHOOL DIPLOMA"
-                df.loc[(df['PRTAGE']>24) & (df['PEEDUCA']==39),'EDUC3']="HS GRADUATE OR GED"
-                df.loc[(df['PRTAGE']>24) & (40<=df['PEEDUCA']) & (df['PEEDUCA']<=42),'EDUC3']="MID-SKILLED"
-                
-                #occupations recode
-                df.loc[(4<=df['PRMJOCGR']) & (df['PRMJOCGR']<=5),'OCC4'] = "Farming and Construction"
-                
-                #race recode
-                df['RACE'] = "MULTI-RACIAL"
-                df.loc[df['PTDTRACE'] == 1,'RACE'] = "WHITE"
-                df.loc[df['PTDTRACE'] == 2,'RACE'] = "BLACK"
-                df.loc[df['PTDTRACE'] == 4,'RACE'] = "ASIAN"
-                df.loc[df['PTDTRACE'] == 3,'RACE'] = "INDIGENOUS" #Native american/ Native Alaskan, may have impact on states like oklahoma
-                df.loc[df['PTDTRACE'] == 5,'RACE'] = "INDIGENOUS" #Hawaiian/Pacific Islander likely to have a large impact in Hawaii, may way to break these two apart
-                                
-                #new variable for combined datasets
-                df['HRMONTH2'] = 100*year+mo
-                
-                #append data
-                dataframe=dataframe.append(df)
-                del df
-                                
-                print("==", end ="")
-        
-            except:
-                print("==", end ="")
-            
-        print("]")
-                    
-        #load data dictionary
-        nums_to_names = get_dict(dfile)
-    
-        #load in extract files for cert and lic
-        if year == 2015:
-            dict_loc = '/Certification_extract_file_{}_rec_layout.txt'.format(year)
-            dd_file = newpath + '/cps_' + str(yr) + dict_loc
-            dd_full = open(dd_file, encoding='iso-8859-1').read()
-            
-            # Regular expression finds rows with variable location details
-            p = re.compile('\n(\w+)\s+(\d+)\s+(.*?)\t+.*?(\d\d*).*?(\d\d+)')
-            
-            # Keep adjusted results for series of interest
-            dd_sel_var = [(i[0], int(i[3])-1, int(i[4])) 
-                          for i in p.findall(dd_full) if i[0] not in ['HRYEAR4','PXCERT1','PXCERT2']]
-            
-            # Convert raw data into a list of tuples
-            raw_tup = [tuple(int(line[i[1]:i[2]]) for i in dd_sel_var) 
-                    for line in open(inputdir + r'/jan15-dec15cert_ext.dat')]
-                       
-            # Convert to pandas dataframe, add variable ids as heading
-            df = pd.DataFrame(raw_tup, columns=[v[0] for v in dd_sel_var])
-            df.rename(columns={'MONTH':'HRMONTH'}, inplace=True)
-            
-            #add PECERT3 placeholder (not available in 2015)
-            df['PECERT3'] = np.nan
-            
-            #merge with total dataframe
-            dataframe = dataframe.merge(df, left_on=['QSTNUM','PULINENO','HRMONTH'], right_on=['QSTNUM','PULINENO','HRMONTH'], how='left')
-        if year == 2016:
-            dict_loc = '/Certification_extract_file_{}_rec_layout.txt'.format(year)
-            dd_file = newpath + '/cps_' + str(yr) + dict_loc
-            dd_full = open(dd_file, encoding='iso-8859-1').read()
-                        
-            # Regular expression finds rows with variable location details
-            p = re.compile('\n(\w+)\s+(\d+)\s+(.*?)\s+.*?(\d\d*).*?(\d\d+)')
-            
-            # Keep adjusted results for series of interest
-            dd_sel_var = [(i[0], int(i[3])-1, int(i[4])) 
-                          for i in p.findall(dd_full) if i[0] not in ['HRYEAR4','PXCERT1','PXCERT2','PXCERT3']]
-            
-            # Convert raw data into a list of tuples
-            raw_tup = [tuple(int(line[i[1]:i[2]]) for i in dd_sel_var) 
-                    for line in open(inputdir + r'/jan16-dec16cert_ext.dat')]
-                       
-            # Convert to pandas dataframe, add variable ids as heading
-            df = pd.DataFrame(raw_tup, columns=[v[0] for v in dd_sel_var])
-            df.rename(columns={'MONTH':'HRMONTH'}, inplace=True)
-                        
-            #merge with total dataframe
-            dataframe = dataframe.merge(df, left_on=['QSTNUM','PULINENO','HRMONTH'], right_on=['QSTNUM','PULINENO','HRMONTH'], how='left')
-        
-        dataframe.loc[dataframe['PRCIVLF'] == -1,'PRCIVLF'] = np.nan
-        dataframe.loc[dataframe['PWSSWGT'] < 0,'PWSSWGT'] = np.nan
-        dataframe.loc[dataframe['PECERT1'] < 0,'PECERT1'] = np.nan
-        dataframe.loc[dataframe['PECERT2'] < 0,'PECERT2'] = np.nan
-        
-        #finish clean, recode missing values
-        dataframe.replace(nums_to_names, inplace=True)
-
-        #industry recode
-        ind = {
-            'Agriculture':'Agriculture and related industries',
-            'Forestry, logging, fishing, and hunting':'Agriculture and related industries',
-            'Mining, quarrying, and oil and gas extraction':'Mining, quarrying, and oil and gas extraction',
-            'Construction':'Construction',
-            'Nonmetallic mineral product manufacturing':'Manufacturing',
-            'Primary metals and fabricated metal products':'Manufacturing',
-            'Machinery manufacturing':'Manufacturing',
-            'Computer and electronic product manufacturing':'Manufacturing',
-            'Electrical equipment, appliance manufacturing':'Manufacturing',
-            'Transportation equipment manufacturing':'Manufacturing',
-            'Wood products':'Manufacturing',
-            'Furniture and fixtures manufacturing':'Manufacturing',
-            'Miscellaneous and not specified manufacturing':'Manufacturing',
-            'Food manufacturing':'Manufacturing',
-            'Beverage and tobacco products':'Manufacturing',
-            'Textile, apparel, and leather manufacturing':'Manufacturing',
-            'Paper and printing':'Manufacturing',
-            'Petroleum and coal products manufacturing':'Manufacturing',
-            'Chemical manufacturing':'Manufacturing',
-            'Plastics and rubber products':'Manufacturing',
-            'Wholesale trade':'Wholesale trade',
-            'Retail trade':'Retail trade',
-            'Transportation and warehousing':'Transportation and utilities',
-            'Utilities':'Transportation and utilities',
-            'Publishing industries (except internet)':'Information',
-            'Motion picture and sound recording industries':'Information',
-            'Broadcasting (except internet)':'Information',
-            'Internet publishing and broadcasting':'Information',
-            'Telecommunications':'Information',
-            'Internet service providers and data processing services':'Information',
-            'Other information services':'Information',
-            'Finance':'Financial activities',
-            'Insurance':'Financial activities',
-            'Real estate':'Financial activities',
-            'Rental and leasing services':'Financial activities',		
-            'Professional, scientific, and technical services':'Professional and business services',
-            'Management of companies and enterprises':'Professional and business services',
-            'Administrative and support services':'Professional and business services',
-            'Waste management and remediation services':'Professional and business services',
-            'Educational services':'Education and health services',
-            'Hospitals':'Education and health services',
-            'Health care services, except hospitals':'Education and health services',
-            'Social assistance services':'Education and health services',
-            'Arts, entertainment, and recreation':'Leisure and hospitality',
-            'Accommodation':'Leisure and hospitality',
-            'Food services and drinking places':'Leisure and hospitality',
-            'Repair and maintenance':'Other services',
-            'Personal and laundry services':'Other services',
-            'Membership associations and organizations':'Other services',
-            'Private households':'Other services',
-            'Public administration':'Public administration',
-            'Armed forces':'Public administration'
-            }
+    years = list(range(int(start_year_4_dig),int(end_year_4_dig)+1))
+    
+    if parallel_years and workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            jobs = [executor.submit(clean_year, var_int, year, dfile, newpath, outputdir, 1, export_csv, force, outpath) for year in years]
+            for job in jobs:
+                job.result()
+    else:
+        for year in years:
+            clean_year(var_int, year, dfile, newpath, outputdir, workers, export_csv, force, outpath)
     
-        #replace industry variable with more complex industry taxonomy
-        dataframe['PRMJIND1'] = dataframe['PRDTIND1'].replace(ind)
-        
-        #add labor force participation variable
-        dataframe['labforce'] = 'NOT IN LABOR FORCE'
-        dataframe.loc[dataframe['PREXPLF'] == 'EMPLOYED','labforce'] = 'EMPLOYED'
-        dataframe.loc[dataframe['PREXPLF'] == 'UNEMPLOYED','labforce'] = 'UNEMPLOYED'
-        #dataframe.loc[dataframe['PEMLR'].isin(['NOT IN LABOR FORCE-RETIRED','NOT IN LABOR FORCE-DISABLED','NOT IN LABOR FORCE-OTHER']), 'labforce'] = 'NOT IN LABOR FORCE'
-
-        #full time / part time lf stat
-        dataframe['emp_stat'] = dataframe['labforce'].copy()
-        dataframe.loc[(dataframe['emp_stat'] == 'EMPLOYED') & (dataframe['PRFTLF']=='PART TIME LABOR FORCE'),'emp_stat'] = 'PART_TIME'
-        dataframe.loc[(dataframe['emp_stat'] == 'EMPLOYED') & (dataframe['PRFTLF']=='FULL TIME LABOR FORCE'),'emp_stat'] = 'FULL_TIME'
-
-        #change non responses to nan for PECERT3
-        dataframe['PECERT3'].replace({-1:np.nan},inplace=True)
-       
-        #export to .csv
-        dataframe.to_csv(outputdir + r'/cps_' + str(yr) + '.csv', index = None, header=True)
-        
-        print(str(year) + " export completed")
     print("all data cleaned and compiled, stored in " + outputdir)
 
 def create_connection(db_file):
@@ -463,12 +1432,15 @@ def create_table(conn, create_table_sql):
     except Error as e:
         print(e)
 
-def build_database(database):
+def build_database(database, encoded=False):
     '''
     constructs new database in given file path
-    creates two new tables, aggregate and microdata inside db
+    creates two new tables, aggregate and microdata inside db, plus partitions
+    recording which cleaned month partitions microdata holds
     
     :param database: path to database ex. r"/Users/gabem/Documents/pythonsqlite.db"
+    :param encoded: bool default False, store microdata text columns as integer
+        codes with their labels kept in a separate labels table
     '''
     
     sql_create_microdata_table = """ CREATE TABLE IF NOT EXISTS microdata (
@@ -502,6 +1474,22 @@ def build_database(database):
                                         HRMIS integer,
                                         emp_stat text
                                     ); """
+    
+    sql_create_partitions_table = """ CREATE TABLE IF NOT EXISTS partitions (
+                                        month integer PRIMARY KEY,
+                                        hash text
+                                    ); """
+    
+    sql_create_labels_table = """ CREATE TABLE IF NOT EXISTS labels (
+                                        variable text,
+                                        code integer,
+                                        label text,
+                                        PRIMARY KEY (variable, code)
+                                    ); """
+    
+    if encoded:
+        for c in MICRODATA_TEXT:
+            sql_create_microdata_table = re.sub(r'\b{} text'.format(c), '{} integer'.format(c), sql_create_microdata_table)
  
     sql_create_aggregate_table = """CREATE TABLE IF NOT EXISTS aggregate (
                                     id integer PRIMARY KEY,
@@ -535,7 +1523,11 @@ def build_database(database):
                                     earnings_observed_PECERT1_y integer, 
                                     earnings_observed_PECERT1_n integer,
                                     earnings_observed_PECERT2_y integer, 
-                                    earnings_observed_PECERT2_n integer
+                                    earnings_observed_PECERT2_n integer,
+                                    population_PECERT1_y_sm real,
+                                    population_PECERT1_n_sm real,
+                                    population_PECERT2_y_sm real,
+                                    population_PECERT2_n_sm real
                                 );"""
  
     # create a database connection
@@ -548,84 +1540,285 @@ def build_database(database):
  
         # create tasks table
         create_table(conn, sql_create_aggregate_table)
+        
+        # hashes of the cleaned partitions loaded into microdata
+        create_table(conn, sql_create_partitions_table)
+        
+        if encoded:
+            create_table(conn, sql_create_labels_table)
+        
+        for c in MICRODATA_INDEXES:
+            create_table(conn, 'CREATE INDEX IF NOT EXISTS microdata_{0} ON microdata({0})'.format(c))
     else:
         print("Error! cannot create the database connection.")
 
-def create_aggregate(conn, agg):
+def create_aggregate(conn, agg):
+    '''
+    instert a new row into the aggregate table
+    
+    :param conn:
+    :param project (tuple):
+    '''
+    
+    sql = ''' INSERT INTO aggregate(state,base_pop,labforce,emp_type,emp_stat,education,sex,race,age,industry,occupation,population_total,population_PECERT1_y,population_PECERT1_n,population_PECERT2_y,population_PECERT2_n,population_observed_total,population_observed_PECERT1_y,population_observed_PECERT1_n,population_observed_PECERT2_y,population_observed_PECERT2_n,median_earnings_total,median_earnings_PECERT1_y,median_earnings_PECERT1_n,median_earnings_PECERT2_y,median_earnings_PECERT2_n,earnings_observed_total,earnings_observed_PECERT1_y,earnings_observed_PECERT1_n,earnings_observed_PECERT2_y,earnings_observed_PECERT2_n)
+              VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?) '''
+    cur = conn.cursor()
+    cur.execute(sql, agg)
+    return cur.lastrowid
+
+def create_microdata(conn, micro):
+    """
+    insert a new row into the microdata table
+    
+    :param conn:
+    :param task (tuple):
+    """
+ 
+    sql = ''' INSERT INTO microdata(GESTFIPS,PESEX,RACE,PEHSPNON,age2,HRMONTH2,PWSSWGT,individual,PWORWGT,PRERNWA,PRTAGE,EDUC,PEMLR,PRCOW1,PRMJIND1,PRDTOCC1,PECERT1,PECERT2,PECERT3,labforce,PRERELG,PRCIVLF,PWVETWGT,PEAFEVER,PEAFWHN1,EDUC2,HRMIS,emp_stat)
+              VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?) '''
+    cur = conn.cursor()
+    cur.execute(sql, micro)
+    return cur.lastrowid
+
+def tune_connection(conn, journal_mode='WAL', synchronous='NORMAL', cache_mb=256):
+    '''
+    applies bulk loading pragmas to a database connection
+    
+    :param conn: Connection object
+    :param journal_mode: string default 'WAL', sqlite journal mode
+    :param synchronous: string default 'NORMAL', sqlite synchronous setting
+    :param cache_mb: int default 256, page cache size in MB
+    '''
+    conn.execute('PRAGMA journal_mode={}'.format(journal_mode))
+    conn.execute('PRAGMA synchronous={}'.format(synchronous))
+    conn.execute('PRAGMA cache_size={}'.format(-1024*int(cache_mb)))
+    conn.execute('PRAGMA temp_store=MEMORY')
+
+def sql_values(col):
+    '''
+    converts a column to a list of python values for sqlite parameters, missing
+    values and census -1 non-response codes become NULL. text is passed
+    through unchanged
+    
+    :param col: pd.Series to convert
+    '''
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        #convert each category once, then index by code, -1 codes land on the trailing None
+        lut = [None if pd.isna(v) or v in (-1, '-1') else _json_scalar(v) for v in col.cat.categories]
+        lut = np.array(lut + [None], dtype=object)
+        return(lut[col.cat.codes.to_numpy()].tolist())
+    
+    values = col.to_numpy(dtype=object, copy=True)
+    missing = pd.isna(col).to_numpy() | (values == -1) | (values == '-1')
+    values[missing] = None
+    
+    return(values.tolist())
+
+def bulk_insert(conn, table, data, batch_size=50000):
+    '''
+    inserts a dataframe into a table with parameterized executemany batches,
+    all batches share one transaction so a partition loads completely or not at all
+    
+    :param conn: Connection object
+    :param table: destination table name (str)
+    :param data: dataframe whose column names match the table columns
+    :param batch_size: int default 50000, rows passed to each executemany call
+    :return: number of rows inserted
+    '''
+    cols = list(data.columns)
+    sql = 'INSERT INTO {}({}) VALUES({})'.format(table, ','.join(cols), ','.join(['?']*len(cols)))
+    
+    values = [sql_values(data[c]) for c in cols]
+    
+    with conn:
+        for start in range(0, len(data), batch_size):
+            conn.executemany(sql, zip(*[v[start:start+batch_size] for v in values]))
+    
+    return(len(data))
+
+def read_labels(conn):
     '''
-    instert a new row into the aggregate table
+    reads the labels table of an encoded database
     
-    :param conn:
-    :param project (tuple):
+    :param conn: Connection object
+    :return: dict of variable -> {label: code}, None if the database is not encoded
     '''
+    if conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='labels'").fetchone() is None:
+        return(None)
     
-    sql = ''' INSERT INTO aggregate(state,base_pop,labforce,emp_type,emp_stat,education,sex,race,age,industry,occupation,population_total,population_PECERT1_y,population_PECERT1_n,population_PECERT2_y,population_PECERT2_n,population_observed_total,population_observed_PECERT1_y,population_observed_PECERT1_n,population_observed_PECERT2_y,population_observed_PECERT2_n,median_earnings_total,median_earnings_PECERT1_y,median_earnings_PECERT1_n,median_earnings_PECERT2_y,median_earnings_PECERT2_n,earnings_observed_total,earnings_observed_PECERT1_y,earnings_observed_PECERT1_n,earnings_observed_PECERT2_y,earnings_observed_PECERT2_n)
-              VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?) '''
-    cur = conn.cursor()
-    cur.execute(sql, agg)
-    return cur.lastrowid
+    labels = {}
+    for variable, code, label in conn.execute('SELECT variable, code, label FROM labels ORDER BY variable, code'):
+        labels.setdefault(variable, {})[label] = code
+    
+    return(labels)
 
-def create_microdata(conn, micro):
-    """
-    insert a new row into the microdata table
+def seed_labels(conn, encoding):
+    '''
+    fills the labels table from the census variable encoding so encoded
+    variables keep their census codes, the first code wins where several
+    codes share a label
     
-    :param conn:
-    :param task (tuple):
-    """
- 
-    sql = ''' INSERT INTO microdata(GESTFIPS,PESEX,RACE,PEHSPNON,age2,HRMONTH2,PWSSWGT,individual,PWORWGT,PRERNWA,PRTAGE,EDUC,PEMLR,PRCOW1,PRMJIND1,PRDTOCC1,PECERT1,PECERT2,PECERT3,labforce,PRERELG,PRCIVLF,PWVETWGT,PEAFEVER,PEAFWHN1,EDUC2,HRMIS,emp_stat)
-              VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?) '''
-    cur = conn.cursor()
-    cur.execute(sql, micro)
-    return cur.lastrowid
+    :param conn: Connection object
+    :param encoding: dict of variable -> {code: label}, see get_dict
+    '''
+    rows = []
+    for variable in MICRODATA_TEXT:
+        seen = set()
+        for code, label in encoding.get(variable, {}).items():
+            if label not in seen:
+                seen.add(label)
+                rows.append((variable, int(code), label))
+    
+    with conn:
+        conn.executemany('INSERT OR IGNORE INTO labels(variable, code, label) VALUES(?,?,?)', rows)
+
+def encode_labels(conn, data):
+    '''
+    replaces the text columns of a microdata frame with their integer codes,
+    labels not yet in the labels table are given the next free code and added
+    
+    :param conn: Connection object of an encoded database
+    :param data: dataframe of microdata
+    :return: copy of data with MICRODATA_TEXT columns as integer codes, None where missing
+    '''
+    labels = read_labels(conn)
+    out = data.copy()
+    new = []
+    
+    for c in [i for i in MICRODATA_TEXT if i in data.columns]:
+        lookup = labels.setdefault(c, {})
+        col = data[c].astype('category') if not isinstance(data[c].dtype, pd.CategoricalDtype) else data[c]
+        
+        #encode each category once, then map the codes of every row through it
+        lut = []
+        for v in col.cat.categories:
+            if v in (-1, '-1'):
+                lut.append(-1)
+                continue
+            v = _json_scalar(v)
+            if v not in lookup:
+                lookup[v] = max(lookup.values(), default=0) + 1
+                new.append((c, lookup[v], v))
+            lut.append(lookup[v])
+        
+        codes = np.array(lut + [-1], dtype=np.int64)[col.cat.codes.to_numpy()]
+        codes = codes.astype(object)
+        codes[codes == -1] = None
+        out[c] = codes
+    
+    with conn:
+        conn.executemany('INSERT INTO labels(variable, code, label) VALUES(?,?,?)', new)
+    
+    return(out)
+
+def decode_labels(df, labels, categories=False):
+    '''
+    turns integer codes read from an encoded database back into labels
+    
+    :param df: dataframe of codes, columns named after microdata columns (any case)
+    :param labels: dict returned by read_labels
+    :param categories: bool default False, return pd.Categorical columns rather than object labels
+    '''
+    lower = {k.lower():v for k, v in labels.items()}
+    
+    for c in df.columns:
+        lookup = lower.get(c.lower())
+        if lookup is None:
+            continue
+        
+        names = sorted(lookup, key=lookup.get)
+        codes = np.array([lookup[n] for n in names], dtype=np.int64)
+        
+        #position of each code in the sorted category list, unknown and null codes map to -1
+        lut = np.full(int(codes.max(initial=0)) + 2, -1, dtype=np.int64)
+        lut[codes] = np.arange(len(codes))
+        values = pd.to_numeric(df[c], errors='coerce').fillna(-1).to_numpy(dtype=np.int64, copy=True)
+        values[(values < 0) | (values >= len(lut))] = len(lut) - 1
+        
+        col = pd.Categorical.from_codes(lut[values], categories=names)
+        df[c] = col if categories else np.asarray(col, dtype=object)
+    
+    return(df)
 
-def write_to_table(data,table,database):
+def write_to_table(data,table,database,batch_size=50000,encoded=False):
     '''
-    writes a dataframe to .db by tupleizing and parsing
+    writes a dataframe to .db with the bulk loader, strings are stored exactly
+    as they appear in the dataframe
     
     :param data: dataframe to be written
     :param table: destination of data (str)
     :param database: database to be written to
+    :param batch_size: int default 50000, rows per executemany batch
+    :param encoded: bool default False, replace text columns with codes from the labels table
     '''
     # create a database connection
     conn = create_connection(database)
-    with conn:
-        # create a new project
-        data.replace(-1, np.nan, inplace=True)
-        data.replace('-1', np.nan, inplace=True)
-        data.fillna('nan',inplace=True)
-        
-        tuples = [tuple(x) for x in data.values]
-
-        if table == 'microdata':
-            for row in range(0,len(tuples)):
-                tuples[row] = str(tuples[row]).replace("d'A","dA").replace('(','').replace(')','').replace("O'B","OB").replace("y's","ys").replace("e's","es").replace(":","").replace("-"," ").replace(";","")
-                micro = eval(tuples[row])
-                create_microdata(conn, micro)
-        else:
-            for row in range(0,len(tuples)):
-                tuples[row] = str(tuples[row]).replace("d'A","dA").replace('(','').replace(')','').replace("O'B","OB").replace("y's","ys").replace("e's","es").replace(":","").replace("-"," ").replace(";","")
-                agg = eval(tuples[row])
-                create_aggregate(conn, agg)
+    tune_connection(conn)
+    
+    if encoded:
+        data = encode_labels(conn, data)
+    
+    bulk_insert(conn, table, data, batch_size)
                 
     conn.close()
 
-def combine_data(database,start_year_4_dig,end_year_4_dig):
+def load_partition(database, data, month, digest, batch_size=50000, encoded=False):
+    '''
+    replaces one month of microdata, or a whole year for month yyyy00, with
+    data and records the hash it was loaded from. the old rows are deleted in
+    the insert's transaction, so the month is never half loaded or doubled
+    
+    :param database: database to be written to
+    :param data: dataframe of microdata for the month
+    :param month: int yyyymm of the data, yyyy00 for a full year
+    :param digest: string hash of the partition data came from
+    :param batch_size: int default 50000, rows per executemany batch
+    :param encoded: bool default False, replace text columns with codes from the labels table
+    '''
+    conn = create_connection(database)
+    tune_connection(conn)
+    
+    if encoded:
+        data = encode_labels(conn, data)
+    
+    last = month + 12 if month % 100 == 0 else month
+    conn.execute('DELETE FROM microdata WHERE HRMONTH2 BETWEEN ? AND ?', (month, last))
+    bulk_insert(conn, 'microdata', data, batch_size)
+    
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO partitions(month, hash) VALUES(?,?)', (month, digest))
+    
+    conn.close()
+
+def combine_data(database,start_year_4_dig,end_year_4_dig,dfile=None,encoded=False):
     '''
-    combines datasets across selected years, combined years are writen to .db file
+    combines datasets across selected years, combined years are writen to .db file.
+    months already loaded from an identical partition are skipped, changed
+    months replace their old rows
     
     :param database: path to database
     :param start_year_4_dig: starting year to be combined (int)
     :param end_year_4_dig: ending year to be combiend (int)
+    :param dfile: string default None, cps variable encoding used to seed the labels of an encoded database
+    :param encoded: bool default False, store text columns as integer codes
     '''
     outputdir = outpath + 'cps_clean_data/combined_data'
     if not os.path.exists(outputdir):
         os.makedirs(outputdir)
     
     #build database and create tables
-    build_database(database)
+    build_database(database, encoded)
+    
+    if encoded and dfile is not None:
+        conn = create_connection(database)
+        seed_labels(conn, get_dict(dfile))
+        conn.close()
     
     inputdir = outpath + 'cps_clean_data'
+    
+    conn = create_connection(database)
+    loaded = dict(conn.execute('SELECT month, hash FROM partitions').fetchall())
+    conn.close()
         
     print("Writing microdata to database [",end="")
     
@@ -634,17 +1827,30 @@ def combine_data(database,start_year_4_dig,end_year_4_dig):
         #check year, define extension
         yr = int(str(year)[2:4])            
         
-        data = inputdir + r'/cps_' + str(yr) + '.csv'
+        cols = ['GESTFIPS', 'PESEX', 'RACE', 'PEHSPNON', 'age2', 'HRMONTH2', 'PWSSWGT', 
+                'individual', 'PWORWGT', 'PRERNWA', 'PRTAGE', 'EDUC', 'PEMLR', 
+                'PRCOW1', 'PRMJIND1', 'PRDTOCC1', 'PECERT1', 'PECERT2','PECERT3',
+                'labforce','PRERELG','PRCIVLF','PWVETWGT','PEAFEVER','PEAFWHN1','EDUC2','HRMIS','emp_stat']
         
-        df = pd.read_csv(data)
-        df = df[['GESTFIPS', 'PESEX', 'RACE', 'PEHSPNON', 'age2', 'HRMONTH2', 'PWSSWGT', 
-                 'individual', 'PWORWGT', 'PRERNWA', 'PRTAGE', 'EDUC', 'PEMLR', 
-                 'PRCOW1', 'PRMJIND1', 'PRDTOCC1', 'PECERT1', 'PECERT2','PECERT3',
-                 'labforce','PRERELG','PRCIVLF','PWVETWGT','PEAFEVER','PEAFWHN1','EDUC2','HRMIS','emp_stat']]
+        #load each month partition in its own transaction, reading only the
+        #needed columns from the columnar store
+        parts = [m for m in read_manifest(inputdir).values() if m['year'] == year]
+        for m in parts:
+            if m.get('hash') is not None and loaded.get(year*100 + m['month']) == m['hash']:
+                continue
+            df = read_partitions(inputdir, years=[year], months=[m['month']], columns=cols)
+            load_partition(database, df, year*100 + m['month'], m.get('hash'), encoded=encoded)
+            del df
         
-        write_to_table(df,'microdata',database)
+        #fall back to csv exports written before the store existed
+        data = inputdir + r'/cps_' + str(yr) + '.csv'
+        if len(parts) == 0 and os.path.exists(data):
+            digest = file_hash(data)
+            if loaded.get(year*100) != digest:
+                df = pd.read_csv(data)[cols]
+                load_partition(database, df, year*100, digest, encoded=encoded)
+                del df
         
-        del df
         print("===", end ="")
         
     print("]", end ="")
@@ -653,63 +1859,398 @@ def combine_data(database,start_year_4_dig,end_year_4_dig):
 def assign_base_pop(data):
     '''
     duplicates estimates within target base population, allows us to subset for
-    various population base age groups
+    various population base age groups. the aggregation engine does not need
+    the copies, see population_rows
     
     :param data: DataFrame to be extended, additional base populations added
     '''
-    #copy initial data
-    df = data.copy()
-    #create base population column
-    df.loc[25<=df['PRTAGE'],'base_pop'] = 'Civilian Population 25 and up'
-    data['base_pop'] = 'Civilian Population 16 and up'
+    #one tagged copy of the persons in each base population
+    parts = [data[where_mask(data, BASE_POPULATIONS[p])].assign(base_pop=p) for p in BASE_POPULATIONS]
+    
+    return(pd.concat(parts))
+
+def legacy_label(label):
+    '''
+    applies the character stripping the old row-by-row write_to_table did to
+    text, e.g. 'NON-HISPANIC' -> 'NON HISPANIC'
+    
+    :param label: label to be converted
+    '''
+    return(str(label).replace("d'A","dA").replace('(','').replace(')','').replace("O'B","OB").replace("y's","ys").replace("e's","es").replace(":","").replace("-"," ").replace(";",""))
+
+def resolve_label(col, value):
+    '''
+    finds the label in a column that a table spec value refers to. specs were
+    written against labels stored with hyphens, colons and apostrophes
+    stripped, so a value missing from the column is matched on its stripped form
+    
+    :param col: pd.Series holding the labels
+    :param value: label from a table spec
+    '''
+    labels = col.cat.categories if isinstance(col.dtype, pd.CategoricalDtype) else col.dropna().unique()
+    if value in labels:
+        return(value)
+    for label in labels:
+        if legacy_label(label) == value:
+            return(label)
+    
+    return(value)
 
-    #subset copy dataframe to 25+
-    df = df[~df['base_pop'].isna()]
+def restrict(data, restriction):
+    '''
+    subsets data to the rows matching a table spec restriction dict, values
+    prefixed with '!' exclude rather than select, lists apply each value in turn
     
-    #append to original data
-    data = data.append(df)
+    :param data: DataFrame containing microdata
+    :param restriction: dict of column -> value or list of values
+    '''
+    for r in restriction:
+        values = restriction[r] if isinstance(restriction[r], list) else [restriction[r]]
+        for r2 in values:
+            if isinstance(r2, str) and '!' in r2:
+                data = data[data[r] != resolve_label(data[r], r2.replace('!',''))]
+            else:
+                data = data[data[r] == resolve_label(data[r], r2)]
     
     return(data)
 
-def make_population_table(df, d):
+def agg_cache(cache_mb=AGG_CACHE_MB, partials=None):
     '''
-    uses commands from dictionary object to develop aggregate tables
+    empty least recently used cache for work shared between the tables of a
+    run, restricted row sets and partial sums. entries are evicted oldest use
+    first once their size passes the budget
     
-    :param df: DataFrame containing microdata
-    :param d: dictionary containing aggregation commands
+    :param cache_mb: memory budget in MB (int)
+    :param partials: tuple default None, (storedir, months) of a partials store,
+        cells missing from the cache are read from it, see update_partials
+    '''
+    return({'budget':cache_mb * 2**20, 'size':0, 'hits':0, 'misses':0, 'entries':OrderedDict(), 'partials':partials})
+
+def cache_get(cache, key):
     '''
+    looks up key, marking the entry as recently used
     
-    data = df.copy()
+    :param cache: dict returned by agg_cache, None disables caching
+    :param key: tuple identifying the entry
+    :return: cached value, None when absent
+    '''
+    if cache is None:
+        return(None)
+    if key not in cache['entries']:
+        cache['misses'] += 1
+        if key[0] == 'cells' and cache.get('partials') is not None:
+            return(cache_put(cache, key, read_partials(*cache['partials'], key)))
+        return(None)
+    
+    cache['hits'] += 1
+    cache['entries'].move_to_end(key)
+    
+    return(cache['entries'][key][0])
+
+def cache_put(cache, key, value):
+    '''
+    stores value under key then evicts the least recently used entries until
+    the cache is back under budget. values larger than the budget are not kept.
+    cached values are shared, callers must not modify them in place
+    
+    :param cache: dict returned by agg_cache, None disables caching
+    :param key: tuple identifying the entry
+    :param value: np.ndarray or DataFrame
+    :return: value
+    '''
+    if cache is None:
+        return(value)
+    
+    size = value.nbytes if isinstance(value, np.ndarray) else int(value.memory_usage(index=True).sum())
+    if size > cache['budget']:
+        return(value)
+    
+    if key in cache['entries']:
+        cache['size'] -= cache['entries'].pop(key)[1]
+    cache['entries'][key] = (value, size)
+    cache['size'] += size
+    
+    while cache['size'] > cache['budget']:
+        cache['size'] -= cache['entries'].popitem(last=False)[1][1]
+    
+    return(value)
+
+def restriction_key(restriction):
+    '''
+    normalized signature of a restriction dict. every value is applied in
+    turn, so restrictions listing the same values in any order select the
+    same rows and share a key
     
-    #check to see if any restrictions specified in the dict, if so, subset accordingly
-    if len(d['restriction']) > 0:
-        for r in d['restriction']:
-            if isinstance(d['restriction'][r], list):
-                for r2 in d['restriction'][r]:
-                    if '!' in r2:
-                        data = data[data[r] != r2.replace('!','')]
-                    else:
-                        data = data[data[r] == r2]
-            else:            
-                if '!' in d['restriction'][r] :
-                    data = data[data[r] != d['restriction'][r].replace('!','')]
+    :param restriction: dict of column -> value or list of values
+    '''
+    return(tuple(sorted(
+        (r, tuple(sorted(set(repr(v) for v in (restriction[r] if isinstance(restriction[r], list) else [restriction[r]])))))
+        for r in restriction)))
+
+def restricted_rows(data, restriction, cache=None):
+    '''
+    positions of the rows of data matching a restriction, as restrict would
+    select them. the row set and the test of each column value are cached, so
+    tables sharing a restriction or part of one do not test the rows again
+    
+    :param data: DataFrame containing microdata
+    :param restriction: dict of column -> value or list of values
+    :param cache: dict default None, see agg_cache
+    :return: np.ndarray of row positions
+    '''
+    key = ('rows', restriction_key(restriction))
+    rows = cache_get(cache, key)
+    if rows is not None:
+        return(rows)
+    
+    keep = np.ones(len(data), dtype=bool)
+    for r in restriction:
+        values = restriction[r] if isinstance(restriction[r], list) else [restriction[r]]
+        for r2 in values:
+            mask = cache_get(cache, ('mask', r, repr(r2)))
+            if mask is None:
+                if isinstance(r2, str) and '!' in r2:
+                    mask = (data[r] != resolve_label(data[r], r2.replace('!',''))).to_numpy()
                 else:
-                    data = data[data[r] == d['restriction'][r]]
+                    mask = (data[r] == resolve_label(data[r], r2)).to_numpy()
+                cache_put(cache, ('mask', r, repr(r2)), mask)
+            keep &= mask
+    
+    return(cache_put(cache, key, np.flatnonzero(keep)))
 
-    #list of commands to perform when aggregating data
-    agg_dict1 = {
-        'PWSSWGT':'sum',
-        'PWSSWGT_PECERT1_y':'sum',
-        'PWSSWGT_PECERT1_n':'sum', 
-        'PWSSWGT_PECERT2_y':'sum',
-        'PWSSWGT_PECERT2_n':'sum',
-        'individual':'sum',
-        'individual_PECERT1_y':'sum', 
-        'individual_PECERT1_n':'sum', 
-        'individual_PECERT2_y':'sum',
-        'individual_PECERT2_n':'sum'
-        }
+def population_rows(data, restriction, cache=None):
+    '''
+    row sets of each base population matching a restriction, for microdata
+    without a base_pop column. a person is counted once in every population
+    they belong to, as if assign_base_pop had duplicated them
+    
+    :param data: DataFrame containing microdata
+    :param restriction: dict of column -> value or list of values, may restrict base_pop
+    :param cache: dict default None, see agg_cache
+    :return: dict of base population label -> np.ndarray of row positions
+    '''
+    rows = restricted_rows(data, {r:restriction[r] for r in restriction if r != 'base_pop'}, cache)
+    
+    #base_pop restrictions select whole populations
+    labels = pd.DataFrame({'base_pop':list(BASE_POPULATIONS)})
+    labels = restrict(labels, {'base_pop':restriction['base_pop']})['base_pop'] if 'base_pop' in restriction else labels['base_pop']
+    
+    out = {}
+    for p in labels:
+        mask = cache_get(cache, ('population', p))
+        if mask is None:
+            mask = cache_put(cache, ('population', p), where_mask(data, BASE_POPULATIONS[p]))
+        out[p] = rows[mask[rows]]
+    
+    #no population selected, keep the label column with no rows under it
+    if len(out) == 0:
+        out[list(BASE_POPULATIONS)[0]] = rows[:0]
+    
+    return(out)
+
+def table_grain(d):
+    '''
+    finest grouping of a table spec, the union of the columns of its grouping
+    levels in order of first appearance. every level is a roll up of it
+    
+    :param d: dictionary containing aggregation commands
+    '''
+    grain = []
+    for grp in d:
+        if grp not in ['key','restriction']:
+            grain += [c for c in d[grp]['group'] if c not in grain]
+    
+    return(grain)
+
+def grain_cells(data, grain, columns):
+    '''
+    sums columns over every combination of grain values present in data.
+    missing keys are kept as their own cells so coarser levels that do not
+    group on that column still count those rows
+    
+    :param data: DataFrame containing microdata
+    :param grain: list of columns to group on, see table_grain
+    :param columns: list of columns to sum
+    '''
+    return(data.groupby(grain, dropna=False, observed=True, sort=False)[columns].sum())
+
+def roll_up(frame, keys, agg):
+    '''
+    groups frame on keys and aggregates it as DataFrame.agg(dict) would, with
+    one grouped call per function instead of one per column
+    
+    :param frame: DataFrame of cell totals
+    :param keys: list of columns or index levels to group on
+    :param agg: dict of column -> 'sum' or 'mean'
+    '''
+    by = frame.groupby(keys)
+    parts = [getattr(by[[c for c in agg if agg[c] == f]], f)() for f in dict.fromkeys(agg.values())]
+    
+    return(pd.concat(parts, axis=1)[list(agg)])
+
+def cells_key(data, restriction, grain, columns):
+    '''
+    cache key of the cells restricted_cells builds from data
+    
+    :param data: DataFrame containing microdata, only its columns are used
+    :param restriction: dict of column -> value or list of values
+    :param grain: list of columns to group on
+    :param columns: list of columns to sum
+    '''
+    if 'base_pop' not in data.columns:
+        grain = ['base_pop'] + [c for c in grain if c != 'base_pop']
+    
+    return(('cells', restriction_key(restriction), tuple(grain), tuple(columns)))
+
+def restricted_cells(data, restriction, grain, columns, cache=None):
+    '''
+    grain_cells of the rows matching a restriction. cells of the same rows
+    already cached at a finer grain are rolled up rather than reading the
+    microdata again. microdata without a base_pop column is tabulated over
+    BASE_POPULATIONS, the cells then always carry a base_pop level
+    
+    :param data: DataFrame containing microdata
+    :param restriction: dict of column -> value or list of values
+    :param grain: list of columns to group on
+    :param columns: list of columns to sum
+    :param cache: dict default None, see agg_cache
+    '''
+    virtual = 'base_pop' not in data.columns
+    key = cells_key(data, restriction, grain, columns)
+    rkey, grain = key[1], list(key[2])
+    cells = cache_get(cache, key)
+    if cells is not None:
+        return(cells)
+    
+    #smallest cached cell table that can be rolled up to this grain
+    finer = [] if cache is None else [
+        v for k, (v, _) in cache['entries'].items()
+        if k[:2] == ('cells', rkey) and k[3] == tuple(columns) and set(grain) <= set(k[2])
+        ]
+    if len(finer) > 0:
+        cells = grain_cells(min(finer, key=len), grain, columns)
+    elif virtual:
+        #cells of each base population's rows, stacked under their label
+        cells = pd.concat([
+            pd.concat({p:grain_cells(data[grain[1:] + columns].take(rows), grain[1:], columns)}, names=['base_pop'])
+            for p, rows in population_rows(data, restriction, cache).items()
+            ])
+    else:
+        rows = restricted_rows(data, restriction, cache)
+        cells = grain_cells(data[grain + columns].take(rows), grain, columns)
+    
+    return(cache_put(cache, key, cells))
+
+def pivot_cert(frame):
+    '''
+    spreads totals summed per certification segment, the cert index level,
+    into a total column and one column per CERT_COLUMNS flag, ex. PWSSWGT
+    becomes PWSSWGT, PWSSWGT_PECERT1_y, ... PWSSWGT_PECERT2_n
+    
+    :param frame: DataFrame of segment totals indexed by keys + ['cert']
+    '''
+    segments = list(CERT_SEGMENTS)
+    wide = frame.unstack('cert', fill_value=0).reindex(
+        columns=pd.MultiIndex.from_product([frame.columns, segments]), fill_value=0)
+    
+    out = {}
+    for m in frame.columns:
+        seg = wide[m].to_numpy()
+        out[m] = seg.sum(axis=1)
+        for c in CERT_COLUMNS:
+            out['{}_{}'.format(m, c)] = seg[:, [segments.index(i) for i in CERT_COLUMNS[c]]].sum(axis=1)
+    
+    return(pd.DataFrame(out, index=wide.index))
+
+def has_earnings(d):
+    '''
+    whether a table reports earnings, groups restricted to the unemployed or
+    persons not in the labor force are not eligible to report income
+    
+    :param d: dictionary containing aggregation commands
+    '''
+    return(not ('labforce' in d['restriction'] and any(x in d['restriction']['labforce'] for x in ['UNEMPLOYED','NOT IN LABOR FORCE'])))
+
+def cell_specs(d):
+    '''
+    the cells the population and earnings tables of a spec are rolled up
+    from, every cell holds one month
+    
+    :param d: dictionary containing aggregation commands
+    :return: list of (restriction, grain, columns) passed to restricted_cells,
+        population cells then earnings cells
+    '''
+    grain = table_grain(d)
+    
+    # earnings restricts to employed, outgoing groups, on top of any PRERELG
+    # restriction of the spec, values of a list are each applied
+    earnings = dict(d['restriction'])
+    if 'PRERELG' in earnings:
+        earnings['PRERELG'] = (earnings['PRERELG'] if isinstance(earnings['PRERELG'], list) else [earnings['PRERELG']]) + [1]
+    else:
+        earnings['PRERELG'] = 1
+    
+    return([(d['restriction'], grain+['HRMONTH2','cert'], ['PWSSWGT','individual']),
+            (earnings, grain+['HRMONTH2','PRERNWA','cert'], ['PWORWGT','individual'])])
+
+def months_key(restriction, group, agg):
+    '''
+    cache key of the monthly totals of one grouping level, see level_months
+    
+    :param restriction: dict of column -> value or list of values
+    :param group: list of columns of the grouping level
+    :param agg: dict of summed columns
+    '''
+    return(('months', restriction_key(restriction), tuple(group), tuple(agg)))
+
+def level_months(df, d, spec, by=(), cache=None):
+    '''
+    monthly totals of every grouping level of a table, the partial sums the
+    tables average across months. months never mix, so the totals of any
+    set of months are the stacked totals of each. cells are only built when
+    a level is not already cached
+    
+    :param df: DataFrame containing microdata
+    :param d: dictionary containing aggregation commands
+    :param spec: tuple (restriction, grain, columns) of the cells, see cell_specs
+    :param by: list default (), index levels kept next to the month, ex. ['PRERNWA']
+        keeps a weighted earnings histogram per month
+    :param cache: dict default None, see agg_cache
+    :return: dict of grouping level -> (cache key, DataFrame indexed by group + HRMONTH2 + by)
+    '''
+    #each summed column and its certification columns, as pivot_cert orders them
+    agg = {c:'sum' for m in spec[2] for c in [m] + ['{}_{}'.format(m, k) for k in CERT_COLUMNS]}
+    
+    cells = None
+    out = {}
+    for grp in d:
+        if grp not in ['key','restriction']:
+            
+            #shared by tables with the same restriction and group
+            key = months_key(spec[0], d[grp]['group'], agg)
+            temp = cache_get(cache, key)
+            if temp is None:
+                if cells is None:
+                    cells = pivot_cert(restricted_cells(df, *spec, cache))[list(agg)]
+                temp = roll_up(cells, d[grp]['group']+['HRMONTH2']+list(by), agg)
+                temp.replace(0,np.nan,inplace=True)
+                cache_put(cache, key, temp)
+            
+            out[grp] = (key, temp)
+    
+    return(out)
 
+def make_population_table(df, d, cache=None):
+    '''
+    uses commands from dictionary object to develop aggregate tables
+    
+    :param df: DataFrame containing microdata
+    :param d: dictionary containing aggregation commands
+    :param cache: dict default None, restricted rows and partial sums shared with
+        other tables, see agg_cache
+    '''
+    
+    #list of commands to perform when aggregating monthly totals, see level_months
     agg_dict2 = {
         'PWSSWGT':'mean',
         'PWSSWGT_PECERT1_y':'mean',
@@ -725,22 +2266,152 @@ def make_population_table(df, d):
 
     h = {}
     
+    #monthly totals of each grouping level, rolled up from (finest key, month,
+    #certification segment) cells of the restricted rows
+    months = level_months(df, d, cell_specs(d)[0], cache=cache)
+    
     #loop through each table in the dictionary, ignoring key and restriction fields
     #aggregate as specified in dictionary
-    for grp in d:   
-        if grp not in ['key','restriction']:
-            
-            temp = pd.DataFrame(data.groupby(d[grp]['group']+['HRMONTH2']).agg(agg_dict1))
-            temp.replace(0,np.nan,inplace=True)
+    for grp in months:
+        temp = months[grp][1]
         
-            h[grp] = pd.DataFrame(temp.groupby(d[grp]['group']).agg(agg_dict2)).reset_index()
+        h[grp] = roll_up(temp, d[grp]['group'], agg_dict2).reset_index()
+
+        for item in d[grp]['fill']:
+            h[grp][item] = d[grp]['fill'][item]
+    
+    #stack grouping levels in one pass
+    out = pd.concat(list(h.values())) if len(h) > 0 else pd.DataFrame()
+    
+    #rename columns
+    out.rename(columns={
+        'PWSSWGT':'population_total',
+        'PWSSWGT_PECERT1_y':'population_PECERT1_y',
+        'PWSSWGT_PECERT1_n':'population_PECERT1_n', 
+        'PWSSWGT_PECERT2_y':'population_PECERT2_y',
+        'PWSSWGT_PECERT2_n':'population_PECERT2_n',
+        'individual':'population_observed_total',
+        'individual_PECERT1_y':'population_observed_PECERT1_y', 
+        'individual_PECERT1_n':'population_observed_PECERT1_n', 
+        'individual_PECERT2_y':'population_observed_PECERT2_y',
+        'individual_PECERT2_n':'population_observed_PECERT2_n'
+        }, inplace=True)
+    
+    return(out)
+
+def cert_flags(labels=None):
+    '''
+    sql expressions for the boolean certification variables built in get_microdata
+    
+    :param labels: dict returned by read_labels, None for text databases
+    :return: dict of flag name -> sql expression evaluating to 0 or 1
+    '''
+    def test(col, answer):
+        if labels is None:
+            return("COALESCE(UPPER({}) = '{}', 0)".format(col, answer))
+        lookup = {k.lower():v for k, v in labels.items()}.get(col.lower(), {})
+        codes = [str(v) for k, v in lookup.items() if str(k).upper() == answer]
+        return('COALESCE({} IN ({}), 0)'.format(col, ','.join(codes)) if len(codes) > 0 else '0')
+    
+    flags = {
+        'PECERT1_y':test('PECERT1','YES'),
+        'PECERT1_n':test('PECERT1','NO')
+        }
+    flags['PECERT2_y'] = '({} * {})'.format(flags['PECERT1_y'], test('PECERT2','YES'))
+    flags['PECERT2_n'] = '({} * {})'.format(flags['PECERT1_y'], test('PECERT2','NO'))
+    
+    return(flags)
+
+def population_base(conn, table='microdata', start_month=None, end_month=None, states=None):
+    '''
+    materializes the microdata as get_microdata prepares it, base populations
+    stacked and certification measures split out, into the temp table
+    population_base read by make_population_table_sql
+    
+    :param conn: Connection object
+    :param table: string default 'microdata' table name containing microdata
+    :param start_month end_month: int default None, inclusive yyyymm bounds, see get_microdata
+    :param states: list default None, states to keep, see get_microdata
+    :return: labels of the population_base columns, None for text databases
+    '''
+    labels = read_labels(conn)
+    text = [i for i in MICRODATA_FIELDS if MICRODATA_FIELDS[i] in MICRODATA_TEXT or MICRODATA_FIELDS[i].upper() in MICRODATA_TEXT]
+    
+    where, params, remaining = microdata_filter(conn, MICRODATA_FIELDS, table, start_month, end_month, states, None, labels)
+    
+    #user friendly columns, older text databases hold 'nan' for missing labels
+    select = ', '.join(
+        ["NULLIF({}, 'nan') AS {}".format(MICRODATA_FIELDS[i], i) if labels is None and i in text else '{} AS {}'.format(MICRODATA_FIELDS[i], i) for i in MICRODATA_FIELDS]
+        )
+    base = '''SELECT {0}, 'Civilian Population 16 and up' AS base_pop FROM {1}{2}
+              UNION ALL
+              SELECT {0}, 'Civilian Population 25 and up' AS base_pop FROM {1}{3}'''.format(
+              select, table, where, (where + ' AND' if where else ' WHERE') + ' 25 <= PRTAGE')
+    
+    #weights and observation counts split by certification, as built in get_microdata
+    flags = cert_flags(labels)
+    measures = {}
+    for m, expr in [('PWSSWGT','PWSSWGT'), ('individual','COALESCE(month = 4, 0)')]:
+        measures[m] = expr
+        for f in flags:
+            measures['{}_{}'.format(m, f)] = '{} * {}'.format(expr, flags[f])
+    
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('DROP TABLE IF EXISTS temp.population_base')
+    conn.execute('CREATE TEMP TABLE population_base AS SELECT {}, base_pop, HRMONTH2, {} FROM ({})'.format(
+        ', '.join(text), ', '.join(['{} AS {}'.format(measures[m], m) for m in measures]), base), params * 2)
+    
+    if labels is None:
+        return(None)
+    
+    #key the labels by user friendly name
+    lower = {k.lower():v for k, v in labels.items()}
+    
+    return({i:lower[MICRODATA_FIELDS[i].lower()] for i in text if MICRODATA_FIELDS[i].lower() in lower})
 
+def make_population_table_sql(conn, d, labels=None):
+    '''
+    database backed version of make_population_table, each grouping level is
+    compiled into GROUP BY queries against the population_base temp table so
+    only the aggregates are read into python. returns the same frame as
+    make_population_table(get_microdata(database, ...), d)
+    
+    :param conn: Connection object on which population_base has been run
+    :param d: dictionary containing aggregation commands
+    :param labels: dict returned by population_base
+    '''
+    cols = [i[1] for i in conn.execute('PRAGMA temp.table_info(population_base)')]
+    order = cols[cols.index('HRMONTH2')+1:]
+    
+    #check to see if any restrictions specified in the dict, matched as restrict matches them
+    where, params, remaining = microdata_filter(conn, {i:i for i in cols}, 'population_base', restriction=d['restriction'], labels=labels)
+    
+    h = {}
+    
+    for grp in d:
+        if grp not in ['key','restriction']:
+            g = d[grp]['group']
+            
+            #groupby drops rows with a missing key, months summing to zero count as missing
+            monthly = 'SELECT {0}, HRMONTH2, {1} FROM population_base{2} {3} {4} GROUP BY {0}, HRMONTH2'.format(
+                ', '.join(g), ', '.join(['TOTAL({0}) AS {0}'.format(i) for i in order]), where,
+                'AND' if where else 'WHERE', ' AND '.join(['{} IS NOT NULL'.format(i) for i in g + ['HRMONTH2']]))
+            means = ['AVG(NULLIF({0}, 0)) AS {0}'.format(i) if 'PWSSWGT' in i else 'TOTAL(NULLIF({0}, 0)) AS {0}'.format(i) for i in order]
+            sql = 'SELECT {0}, {1} FROM ({2}) GROUP BY {0}'.format(', '.join(g), ', '.join(means), monthly)
+            
+            out = pd.DataFrame(conn.execute(sql, params).fetchall(), columns=g + order)
+            out[order] = out[order].astype('float64')
+            
+            if labels is not None:
+                out = decode_labels(out, labels)
+            
+            h[grp] = out.sort_values(g).reset_index(drop=True)
+            
             for item in d[grp]['fill']:
                 h[grp][item] = d[grp]['fill'][item]
     
-    out = pd.DataFrame()
-    for dat in h:
-        out = out.append(h[dat])
+    #stack grouping levels in one pass
+    out = pd.concat(list(h.values())) if len(h) > 0 else pd.DataFrame()
     
     #rename columns
     out.rename(columns={
@@ -758,36 +2429,60 @@ def make_population_table(df, d):
     
     return(out)
 
-def make_earnings_table(df, d):
+def weighted_quantiles(groups, values, weights, q=(0.5,)):
+    '''
+    weighted quantiles of values within groups for several weight columns in
+    one pass. rows are sorted by group and value once, weights are summed
+    cumulatively within each group and a quantile is the first value whose
+    cumulative weight reaches q times the group total. missing weights never
+    reach the cutoff, a group in which no value does returns its lowest value
+    
+    :param groups: np.ndarray of integer group ids
+    :param values: np.ndarray of values
+    :param weights: 2d np.ndarray with a column per weight, nan where missing
+    :param q: sequence of quantiles between 0 and 1, default (0.5,)
+    :return: tuple of (sorted group ids, dict of quantile -> 2d np.ndarray of groups x weights)
+    '''
+    order = np.lexsort((values, groups))
+    g = groups[order]
+    v = values[order]
+    w = weights[order]
+    
+    if len(g) == 0:
+        return(g, {p:np.empty((0, w.shape[1])) for p in q})
+    
+    starts = np.flatnonzero(np.r_[True, g[1:] != g[:-1]])
+    sizes = np.diff(np.r_[starts, len(g)])
+    
+    #segmented sums over integer ids, pandas' grouped kernels use compensated
+    #summation so totals and running sums match the groupby results exactly
+    by = pd.DataFrame(w).groupby(g, sort=False)
+    cumsum = by.cumsum().to_numpy()
+    totals = by.sum().to_numpy()
+    
+    rows = np.arange(len(g))[:, None]
+    out = {}
+    for p in q:
+        cutoff = np.repeat(totals * p, sizes, axis=0)
+        #first row of each group at or above its cutoff, the group's first row if none is
+        first = np.minimum.reduceat(np.where(cumsum >= cutoff, rows, len(g)), starts, axis=0)
+        first = np.where(first == len(g), starts[:, None], first)
+        out[p] = v[first]
+    
+    return(g[starts], out)
+
+def make_earnings_table(df, d, quantiles=None, cache=None):
     '''
     uses commands from dictionary object to develop aggregate tables
     
     :param df: DataFrame containing microdata
     :param d: dictionary containing aggregation commands
+    :param quantiles: list default None, extra earnings quantiles to report next to the
+        median, ex. [0.1, 0.25, 0.75, 0.9] adds p10_earnings_total, p25_earnings_total...
+    :param cache: dict default None, restricted rows and partial sums shared with
+        other tables, see agg_cache
     '''
     
-    data = df.copy()
-    
-    data = data[data['PRERELG']==1] # restricts to employed, outgoing groups
-    
-    if len(d['restriction']) > 0:
-        for r in d['restriction']:
-            if isinstance(d['restriction'][r], list):
-                for r2 in d['restriction'][r]:
-                    if '!' in r2:
-                        data = data[data[r] != r2.replace('!','')]
-                    else:
-                        data = data[data[r] == r2]
-            else:            
-                if '!' in d['restriction'][r] :
-                    data = data[data[r] != d['restriction'][r].replace('!','')]
-                else:
-                    data = data[data[r] == d['restriction'][r]]
-
-
-    obs_col = [i for i in data.columns if 'individual' in i]
-    weight_col = [i for i in data.columns if 'PWORWGT' in i]
-
     agg_dict1 = {
         'PWORWGT':'sum',
         'PWORWGT_PECERT1_y':'sum',
@@ -814,42 +2509,42 @@ def make_earnings_table(df, d):
         'individual_PECERT2_n':'sum'
         }
 
+    obs_col = [i for i in agg_dict1 if 'individual' in i]
+    weight_col = [i for i in agg_dict1 if 'PWORWGT' in i]
+
     h = {}
     
-    for grp in d:   
-        if grp not in ['key','restriction']:
-            
-            temp = pd.DataFrame(data.groupby(d[grp]['group']+['HRMONTH2','PRERNWA']).agg(agg_dict1))
-            temp.replace(0,np.nan,inplace=True)
-            
-            temp2 = pd.DataFrame(temp.groupby(d[grp]['group']+['PRERNWA']).agg(agg_dict2))
-            #sum total observations
-            obs = temp2[obs_col].groupby(d[grp]['group'])[obs_col].agg('sum')
-            
-            temp2.drop(obs_col, axis=1, inplace=True)
-            #determine cuttoff for each earnings column
-            cutoff = temp2.groupby(d[grp]['group'])[weight_col].agg('sum') / 2.0
-            #cumulatively sum down each column
-            cumsum = temp2.groupby(d[grp]['group'])[weight_col].cumsum()
-            #determine the boundary limit for each column
-            boundary = cumsum.ge(cutoff).reset_index()
-            boundary['PRERNWA'] = boundary['PRERNWA'].astype('str')
-            #find the first observation in each group which surpases or equals the boundary for that group
-            median = boundary.set_index('PRERNWA').groupby(d[grp]['group'])[weight_col].apply(pd.DataFrame.idxmax).astype('float64')
-            #address cells with no observations (these columns will just return the lowest listed earnings amount, we want it to be null)
-            nanframe = obs.replace(0,np.nan)
-            nanframe = np.where((obs > 0),1,nanframe)
-            
-            median *= nanframe
-            
-            h[grp] = median.join(obs,how='outer').reset_index()
+    #monthly earnings histogram of each grouping level, rolled up from (finest
+    #key, month, earnings, certification segment) cells of employed, outgoing rows
+    months = level_months(df, d, cell_specs(d)[1], ['PRERNWA'], cache)
+    
+    for grp in months:
+        temp = months[grp][1]
+        
+        temp2 = roll_up(temp, d[grp]['group']+['PRERNWA'], agg_dict2)
+        #sum total observations
+        obs = temp2[obs_col].groupby(d[grp]['group'])[obs_col].agg('sum')
+        
+        #weighted median (and quantiles) of earnings for every group and weight column at once
+        ids = temp2.groupby(d[grp]['group']).ngroup().to_numpy()
+        earnings = temp2.index.get_level_values('PRERNWA').to_numpy(dtype=np.float64)
+        keys, q = weighted_quantiles(ids, earnings, temp2[weight_col].to_numpy(dtype=np.float64), [0.5] + list(quantiles or []))
+        
+        #address cells with no observations (these would return the lowest listed earnings amount, we want it to be null)
+        nanframe = np.where(obs.to_numpy() > 0, 1, np.nan)
+        
+        median = pd.DataFrame(q[0.5] * nanframe, index=obs.index, columns=weight_col)
+        for p in quantiles or []:
+            median = median.join(pd.DataFrame(q[p] * nanframe, index=obs.index,
+                                              columns=['p{:g}_{}'.format(100*p, c) for c in weight_col]))
+        
+        h[grp] = median[weight_col].join(obs,how='outer').join(median.drop(weight_col, axis=1)).reset_index()
 
-            for item in d[grp]['fill']:
-                h[grp][item] = d[grp]['fill'][item]
-                
-    out = pd.DataFrame()
-    for dat in h:
-        out = out.append(h[dat])
+        for item in d[grp]['fill']:
+            h[grp][item] = d[grp]['fill'][item]
+            
+    #stack grouping levels in one pass
+    out = pd.concat(list(h.values())) if len(h) > 0 else pd.DataFrame()
     
     out.rename(columns={
         'PWORWGT':'median_earnings_total',
@@ -864,6 +2559,10 @@ def make_earnings_table(df, d):
         'individual_PECERT2_n':'earnings_observed_PECERT2_n'
         }, inplace=True)
     
+    #quantile columns follow the median naming, ex. p10_PWORWGT -> p10_earnings_total
+    out.rename(columns=lambda c: c if not c.startswith('p') or '_PWORWGT' not in c else
+               c.replace('_PWORWGT_', '_earnings_').replace('_PWORWGT', '_earnings_total'), inplace=True)
+    
     return(out)
 
 def suppress_output(df,key,sup_val=30):
@@ -922,93 +2621,206 @@ def suppress_output(df,key,sup_val=30):
     
     return(out)
 
-def get_microdata(database, table='microdata'):
+def filter_value(conn, table, col, value, labels=None):
+    '''
+    translates a label used in a filter into the value stored in the database,
+    legacy spellings from the table specs are resolved as in restrict
+    
+    :param conn: Connection object
+    :param table: string table name containing microdata
+    :param col: string database column
+    :param value: label or number to match
+    :param labels: dict returned by read_labels, None for text databases
+    :return: stored value, None if no row can match
+    '''
+    if not isinstance(value, str):
+        return(value)
+    
+    if labels is not None:
+        lookup = {k.lower():v for k, v in labels.items()}.get(col.lower())
+        if lookup is None:
+            return(value)
+        available = list(lookup)
+    elif conn.execute('SELECT 1 FROM {} WHERE {} = ? LIMIT 1'.format(table, col), (value,)).fetchone() is not None:
+        return(value)
+    else:
+        available = [i[0] for i in conn.execute('SELECT DISTINCT {} FROM {}'.format(col, table)) if i[0] is not None]
+    
+    label = resolve_label(pd.Series(available, dtype=object), value)
+    if label not in available:
+        return(None)
+    
+    return(label if labels is None else lookup[label])
+
+def microdata_filter(conn, fields, table='microdata', start_month=None, end_month=None, states=None, restriction=None, labels=None):
+    '''
+    builds a WHERE clause for a microdata read
+    
+    :param conn: Connection object
+    :param fields: dict of user friendly name -> database column
+    :param table: string default 'microdata' table name containing microdata
+    :param start_month end_month: int default None, inclusive HRMONTH2 bounds as yyyymm
+    :param states: list default None, state labels to keep
+    :param restriction: dict default None, table spec style restriction on user friendly names
+    :param labels: dict returned by read_labels, None for text databases
+    :return: tuple of (sql clause, parameters, restrictions that could not be pushed down)
+    '''
+    clauses = []
+    params = []
+    remaining = {}
+    
+    if start_month is not None:
+        clauses.append('HRMONTH2 >= ?')
+        params.append(int(start_month))
+    if end_month is not None:
+        clauses.append('HRMONTH2 <= ?')
+        params.append(int(end_month))
+    if states is not None:
+        codes = [filter_value(conn, table, 'GESTFIPS', i, labels) for i in states]
+        codes = [i for i in codes if i is not None]
+        clauses.append('GESTFIPS IN ({})'.format(','.join(['?']*len(codes))) if len(codes) > 0 else '0 = 1')
+        params += codes
+    
+    for r in (restriction or {}):
+        #derived columns like base_pop are filtered in pandas after they are built
+        if r not in fields:
+            remaining[r] = restriction[r]
+            continue
+        
+        values = restriction[r] if isinstance(restriction[r], list) else [restriction[r]]
+        for r2 in values:
+            negate = isinstance(r2, str) and '!' in r2
+            v = filter_value(conn, table, fields[r], r2.replace('!','') if negate else r2, labels)
+            if v is None:
+                #a label absent from the data excludes nothing when negated and everything otherwise
+                if not negate:
+                    clauses.append('0 = 1')
+            elif negate:
+                #IS NOT keeps missing values, as != does in restrict
+                clauses.append('{} IS NOT ?'.format(fields[r]))
+                params.append(v)
+            else:
+                clauses.append('{} = ?'.format(fields[r]))
+                params.append(v)
+    
+    sql = ' WHERE ' + ' AND '.join(clauses) if len(clauses) > 0 else ''
+    
+    return(sql, params, remaining)
+
+def upper_text(col):
+    '''
+    upper cases the text of a column as str(value).upper() would, each
+    distinct label is converted once. missing values become 'NAN'
+    
+    :param col: pd.Series of labels
+    :return: np.ndarray of upper case text
+    '''
+    codes, uniques = pd.factorize(col)
+    upper = np.array([str(u).upper() for u in uniques] + ['NAN'], dtype=object)
+    
+    return(upper[codes])
+
+def read_microdata(conn, sql, params=(), columns=None, text=None, chunk_rows=100000):
+    '''
+    streams a query into typed numpy columns chunk_rows rows at a time, the
+    columns are allocated once at the row count of the query. text columns
+    are filled into object arrays with the 'nan' text of older databases
+    made missing, the rest are read as float64 and narrowed to int64 when
+    every value is a whole number, as pandas would infer them
+    
+    :param conn: Connection object
+    :param sql: string select query
+    :param params: query parameters
+    :param columns: list of names of the selected columns, default the query's own
+    :param text: list default None, which of columns hold text
+    :param chunk_rows: int default 100000, rows fetched at a time
+    :return: dict of column -> np.ndarray
+    '''
+    rows = conn.execute('SELECT COUNT(*) FROM ({})'.format(sql), params).fetchone()[0]
+    
+    cur = conn.execute(sql, params)
+    columns = columns or [c[0] for c in cur.description]
+    text = set(text or [])
+    out = {c:np.empty(rows, dtype=object if c in text else np.float64) for c in columns}
+    
+    start = 0
+    while True:
+        chunk = cur.fetchmany(chunk_rows)
+        if len(chunk) == 0:
+            break
+        for c, values in zip(columns, zip(*chunk)):
+            out[c][start:start + len(chunk)] = np.array(values, dtype=out[c].dtype)
+        start += len(chunk)
+    
+    for c in columns:
+        v = out[c]
+        if c in text:
+            v[v == 'nan'] = np.nan
+        elif not np.isnan(v).any() and np.array_equal(v, np.trunc(v)):
+            out[c] = v.astype(np.int64)
+    
+    return(out)
+
+def get_microdata(database, table='microdata', categories=False, start_month=None, end_month=None, states=None, restriction=None, columns=None, base_pop=True):
     '''     
-    retrieves microdata from database and cleans it for use in table aggregation
+    retrieves microdata from database and cleans it for use in table aggregation,
+    encoded databases are decoded through their labels table
     
     :param database: string file path to databse
     :param table: string default 'microdata' table name containing microdata
+    :param categories: bool default False, return decoded text columns as pd.Categorical
+    :param start_month end_month: int default None, inclusive HRMONTH2 bounds as yyyymm
+    :param states: list default None, state labels to keep, ex. ['CA','NV']
+    :param restriction: dict default None, table spec style restriction keyed by user friendly name
+    :param columns: list default None, user friendly columns to read, columns needed for
+        the derived variables below are always read
+    :param base_pop: bool default True, add the base_pop column by duplicating persons into
+        each base population they belong to. False leaves one row per person for the
+        aggregation engine, see BASE_POPULATIONS, unless restriction filters on base_pop
     '''
-    #database column names
-    cols = [
-        'GESTFIPS',
-        'labforce',
-        'PRCOW1',
-        'emp_stat',
-        'EDUC',
-        'EDUC2',
-        'PESEX',
-        'race',
-        'age2',
-        'PEHSPNON',
-        'PRMJIND1',
-        'PRDTOCC1',#'soc_2dig',
-        'PRTAGE',
-        'HRMONTH2',
-        'PWSSWGT',
-        'PWORWGT',
-        'individual',
-        'PRERNWA',
-        'PRERELG',
-        'PECERT1',
-        'PECERT2',
-        'HRMIS'
-        ]
-    
-    #user friendly names
-    names = [
-        'state',
-        'labforce',
-        'emp_type',
-        'emp_stat',
-        'education',
-        'EDUC2',
-        'sex',
-        'race',
-        'age',
-        'hispanic',
-        'industry',
-        'occupation',
-        'PRTAGE',
-        'HRMONTH2',
-        'PWSSWGT',
-        'PWORWGT',
-        'individual',
-        'PRERNWA',
-        'PRERELG',
-        'PECERT1',
-        'PECERT2',
-        'month'
-        ]
+    #database column names and user friendly names
+    cols = list(MICRODATA_FIELDS.values())
+    names = list(MICRODATA_FIELDS)
+    fields = dict(MICRODATA_FIELDS)
+    
+    #project to the requested columns plus the ones used below
+    if columns is not None:
+        keep = set(columns) | {'PRTAGE','month','PWSSWGT','PWORWGT','individual','PECERT1','PECERT2'}
+        names = [i for i in names if i in keep]
+        cols = [fields[i] for i in names]
 
     #read in data    
     conn = sqlite3.connect(database)
-    cur = conn.cursor()
-    df = pd.DataFrame(cur.execute("SELECT {} FROM {}".format(', '.join(cols),table)).fetchall())
-    df.replace({'nan':np.nan},inplace=True)    
+    labels = read_labels(conn)
+    where, params, remaining = microdata_filter(conn, fields, table, start_month, end_month, states, restriction, labels)
+    
+    #typed columns straight from the query, text columns as declared by the table
+    declared = {r[1].lower():r[2].lower() for r in conn.execute('PRAGMA table_info({})'.format(table))}
+    text = [c for c in cols if declared.get(c.lower()) == 'text']
+    df = pd.DataFrame(read_microdata(conn, "SELECT {} FROM {}{}".format(', '.join(cols),table,where), params, cols, text), copy=False)
+    
+    if labels is not None:
+        df = decode_labels(df, labels, categories)
+    conn.close()
     
     df.columns = names
 
     #create a base population variable for education comparisons
-    df = assign_base_pop(df)
+    if base_pop or 'base_pop' in remaining:
+        df = assign_base_pop(df)
+    df = restrict(df, remaining)
 
     #relable individual observations, count only those persons in month 4 of the survey for suppression
-    df['individual'] = [1 if i == 4 else 0 for i in df['month']] 
-
-    #create boolean certification variables
-    df['PECERT1_y'] = [str(i).upper()=='YES' for i in df['PECERT1']]
-    df['PECERT1_n'] = [str(i).upper()=='NO' for i in df['PECERT1']]
-    df['PECERT2_y'] = [str(i).upper()=='YES' for i in df['PECERT2']]
-    df['PECERT2_y'] = df['PECERT1_y'] & df['PECERT2_y']
-    df['PECERT2_n'] = [str(i).upper()=='NO' for i in df['PECERT2']]
-    df['PECERT2_n'] = df['PECERT1_y'] & df['PECERT2_n']
-    
-    #expand data using boolean columns
-    for col in ['PWSSWGT', 'individual', 'PWORWGT']:
-        df['{}_PECERT1_y'.format(col)] = df[col] * df['PECERT1_y']
-        df['{}_PECERT1_n'.format(col)] = df[col] * df['PECERT1_n']
-        df['{}_PECERT2_y'.format(col)] = df[col] * df['PECERT2_y']
-        df['{}_PECERT2_n'.format(col)] = df[col] * df['PECERT2_n']
+    df['individual'] = (df['month'] == 4).to_numpy().astype(np.int64)
+
+    #certification segment of each person, see CERT_SEGMENTS. the aggregation
+    #engine splits weights and counts on it, see pivot_cert
+    cert1 = upper_text(df['PECERT1'])
+    cert2 = upper_text(df['PECERT2'])
+    holder = cert1 == 'YES'
+    df['cert'] = np.select(
+        [cert1 == 'NO', holder & (cert2 == 'YES'), holder & (cert2 == 'NO'), holder],
+        [1, 2, 3, 4], 0).astype(np.int8)
             
     return(df)
 
@@ -1058,102 +2870,752 @@ def assign_base_values(df,key):
     return(data)
 
 
-def generate_tables(df, d, database, fname, table_out = 'aggregate'):
+def make_table(df, spec, cache=None, pop=None):
+    '''
+    builds one aggregate table, the population and earnings tables merged with
+    base values assigned and columns in output order
+    
+    :param df: DataFrame containing microdata
+    :param spec: dictionary containing aggregation commands for the table
+    :param cache: dict default None, restricted rows and partial sums shared with
+        other tables, see agg_cache
+    :param pop: DataFrame default None, population table already built for spec,
+        ex. by make_population_table_sql
+    '''
+    if pop is None:
+        pop = make_population_table(df,spec,cache)
+    
+    earn_cols = [i for i in AGGREGATE_COLUMNS if 'earnings' in i]
+    
+    #if labforce is specified as a group not eligible to report income, create null earnings table
+    if not has_earnings(spec):
+        for e in earn_cols:
+            pop[e] = np.nan
+        out = pop.copy()
+    else:
+        earn = make_earnings_table(df,spec,cache=cache)
+            
+        out = pop.merge(earn,on=spec['key'],how='outer')        
+    
+    #labels grouped as categoricals, ex. in table workers, are written as plain text
+    for c in out.columns:
+        if isinstance(out[c].dtype, pd.CategoricalDtype):
+            out[c] = out[c].astype(object)
+    
+    #suppress values
+#    out = suppress_output(out, spec['key'])
+    
+    #relable EDUC2 variable for lumina tables
+    out.rename(columns={'EDUC2':'education'},inplace=True)
+    spec['key'] = [i.replace('EDUC2','education') for i in spec['key']]
+
+    #assign base population values
+    out = assign_base_values(out,spec['key'])
+    
+    #properly order columns
+    return(out[AGGREGATE_COLUMNS])
+
+def share_microdata(df, storedir):
+    '''
+    writes microdata to a single partition of a columnar store so table worker
+    processes can memory map it instead of each receiving a copy. text columns
+    are stored as codes of their sorted labels, so workers group them in the
+    same order as the text
+    
+    :param df: DataFrame containing microdata
+    :param storedir: string directory of the store, ex. under /dev/shm to keep it in memory
+    '''
+    data = {}
+    for c in df.columns:
+        if df[c].dtype == object or pd.api.types.is_string_dtype(df[c].dtype):
+            data[c] = pd.Categorical(df[c])
+        else:
+            data[c] = df[c]
+    
+    write_partition(pd.DataFrame(data, copy=False), storedir, 0, 0)
+
+def _init_table_worker(storedir, cache_mb):
+    '''
+    table worker initializer, maps the shared microdata
+    '''
+    global _table_data, _table_cache_mb
+    _table_data = read_partitions(storedir, mmap=True)
+    _table_cache_mb = cache_mb
+
+def _table_worker(specs):
+    '''
+    builds a batch of tables in a worker process on a cache of their own, see make_table
+    '''
+    cache = agg_cache(_table_cache_mb) if _table_cache_mb else None
+    
+    return([make_table(_table_data, spec, cache) for spec in specs])
+
+def aggregate_sink(fname, target='csv', database=None, table='aggregate', rtol=1e-12):
+    '''
+    output for aggregate tables as they are produced. rows are checked for
+    duplicates against earlier rows as they arrive, using a hash of their
+    labels, smoothed and held until close_sink writes them in one go. a row
+    repeating earlier labels is dropped when its measures are equal to within
+    rtol, tables rolled up from different grains sum the same cells in a
+    different order so shared rows can differ in the last bits
+    
+    :param fname: string file path written to, unused for sqlite
+    :param target: string default 'csv', 'csv', 'parquet' or 'sqlite'
+    :param database: string default None, database written to for sqlite
+    :param table: string default 'aggregate', table written to for sqlite
+    :param rtol: relative tolerance measures are compared at (float)
+    '''
+    if target not in ['csv','parquet','sqlite']:
+        raise ValueError("unknown output target {}".format(target))
+    
+    #fail before the tables are built rather than when they are written
+    if target == 'parquet' and importlib.util.find_spec('pyarrow') is None:
+        raise ImportError("parquet output requires pyarrow")
+    
+    return({
+        'fname':fname,
+        'target':target,
+        'database':database,
+        'table':table,
+        'rtol':rtol,
+        #label hash -> row of reps holding the first measures seen with those labels
+        'first':{},
+        'reps':np.zeros((1024, len(AGGREGATE_COLUMNS) - len(OUTPUT_KEYS))),
+        'n':0,
+        #label hash -> other measures kept with the same labels
+        'extra':{},
+        'parts':[],
+        'dropped':0
+        })
+
+def sink_write(sink, out):
+    '''
+    adds one aggregate table to a sink, dropping rows without a state and
+    duplicates of rows already written
+    
+    :param sink: dict returned by aggregate_sink
+    :param out: DataFrame with AGGREGATE_COLUMNS, ex. from make_table
+    '''
+    out = out[out['state'].notna()]
+    
+    keys = out[OUTPUT_KEYS].astype(object)
+    h = pd.util.hash_pandas_object(keys.where(keys.notna(), None), index=False).to_numpy()
+    vals = out[AGGREGATE_COLUMNS[len(OUTPUT_KEYS):]].to_numpy(dtype=float)
+    
+    #first rows of labels not seen before are kept and become the rows later ones are compared to
+    first = sink['first']
+    keep = ~pd.Series(h).duplicated().to_numpy() & np.array([i not in first for i in h], dtype=bool)
+    new = np.flatnonzero(keep)
+    n = sink['n']
+    while n + len(new) > len(sink['reps']):
+        sink['reps'] = np.concatenate([sink['reps'], np.zeros_like(sink['reps'])])
+    sink['reps'][n:n+len(new)] = vals[new]
+    first.update(zip(h[new].tolist(), range(n, n + len(new))))
+    sink['n'] = n + len(new)
+    
+    rest = np.flatnonzero(~keep)
+    if len(rest):
+        reps = sink['reps'][[first[i] for i in h[rest].tolist()]]
+        same = np.isclose(vals[rest], reps, rtol=sink['rtol'], atol=0, equal_nan=True).all(axis=1)
+        
+        #labels repeated with different measures, compared to every row kept with them
+        for i in rest[~same]:
+            others = sink['extra'].setdefault(h[i], [])
+            if not any(np.isclose(vals[i], o, rtol=sink['rtol'], atol=0, equal_nan=True).all() for o in others):
+                others.append(vals[i])
+                keep[i] = True
+    
+    sink['dropped'] += int((~keep).sum())
+    
+    out = out[keep].copy()
+    smooth_data(out)
+    sink['parts'].append(out[OUTPUT_COLUMNS])
+
+def close_sink(sink):
+    '''
+    writes everything added to a sink to its target in one go, files are
+    written through a temporary file and a sqlite table is replaced in one
+    transaction
+    
+    :param sink: dict returned by aggregate_sink
+    :return: number of rows written
+    '''
+    df = pd.concat(sink['parts'], ignore_index=True) if len(sink['parts']) else pd.DataFrame(columns=OUTPUT_COLUMNS)
+    sink['parts'] = []
+    
+    if sink['target'] == 'sqlite':
+        conn = create_connection(sink['database'])
+        tune_connection(conn)
+        
+        #tables created before the smoothed columns were added get them now
+        cols = [i[1] for i in conn.execute('PRAGMA table_info({})'.format(sink['table']))]
+        for c in [i for i in OUTPUT_COLUMNS if i not in cols]:
+            conn.execute('ALTER TABLE {} ADD COLUMN {} real'.format(sink['table'], c))
+        
+        conn.execute('DELETE FROM {}'.format(sink['table']))
+        bulk_insert(conn, sink['table'], df)
+        conn.close()
+    else:
+        tmp_file = sink['fname'] + '.tmp'
+        if sink['target'] == 'parquet':
+            df.to_parquet(tmp_file, index=False)
+        else:
+            df.to_csv(tmp_file, index=False, header=True)
+        os.replace(tmp_file, sink['fname'])
+    
+    print('{} rows written, {} duplicates dropped'.format(len(df), sink['dropped']))
+    
+    return(len(df))
+
+def generate_tables(df, d, database, fname, table_out = 'aggregate', engine='pandas', benchmark=False, filters=None, cache_mb=AGG_CACHE_MB, workers=1, shared_dir=None, target='csv', partials=None):
     '''
-    uses dictionary to generate aggregate tables and write them to file
+    uses dictionary to generate aggregate tables and write them to file,
+    duplicate rows are dropped and smoothed columns added as tables are made
+    and the output is written once at the end, see aggregate_sink
     
     :param df: DataFrame containing microdata
     :param d: dictionary containing table creation commands
     :param database: string file path to database for optional output method
-    :param fname: string file name of output file
-    :param table_out: string default 'aggregate', optional table name for data to be written to
-    '''
-    data = df.copy()    
-    
-    col_order = [
-        'state', 
-        'base_pop', 
-        'labforce',
-        'emp_type', 
-        'emp_stat',
-        'education', 
-        'sex', 
-        'race',
-        'age', 
-        'industry', 
-        'occupation',
-        'population_total',
-        'population_PECERT1_y',
-        'population_PECERT1_n', 
-        'population_PECERT2_y', 
-        'population_PECERT2_n',
-        'population_observed_total',
-        'population_observed_PECERT1_y', 
-        'population_observed_PECERT1_n',
-        'population_observed_PECERT2_y', 
-        'population_observed_PECERT2_n',
-        'median_earnings_total',
-        'median_earnings_PECERT1_y', 
-        'median_earnings_PECERT1_n',
-        'median_earnings_PECERT2_y', 
-        'median_earnings_PECERT2_n',
-        'earnings_observed_total',
-        'earnings_observed_PECERT1_y', 
-        'earnings_observed_PECERT1_n',
-        'earnings_observed_PECERT2_y', 
-        'earnings_observed_PECERT2_n'
-        ]
+    :param fname: string file name of output file, written to outpath as {fname}.csv
+        or {fname}.parquet
+    :param table_out: string default 'aggregate', table name for data to be written to with sqlite
+    :param engine: string default 'pandas', 'sql' builds population tables inside the database
+    :param benchmark: bool default False, build population tables with both engines,
+        check they match and print their run times
+    :param filters: dict default None, start_month, end_month and states df was read with
+    :param cache_mb: int default AGG_CACHE_MB, memory budget for restricted rows and
+        partial sums reused across tables, 0 disables the cache
+    :param workers: int default 1, number of processes tables are built on with the
+        pandas engine. tables are still written in the order of d
+    :param shared_dir: string default None, directory the microdata is shared with workers
+        through, a temporary directory by default. /dev/shm keeps it in memory
+    :param target: string default 'csv', output written, 'csv', 'parquet' or 'sqlite'
+    :param partials: tuple default None, (storedir, months) table cells are read from
+        instead of being summed from df, see update_partials. tables are built serially
+    '''
+    sink = aggregate_sink('{}{}.{}'.format(outpath, fname, target), target, database, table_out)
+    
+    if workers > 1 and engine == 'pandas' and not benchmark and partials is None:
+        generate_tables_parallel(df, d, sink, cache_mb, workers, shared_dir)
+        close_sink(sink)
+        return
+    
+    cache = agg_cache(cache_mb, partials) if cache_mb or partials else None
+    
+    if engine == 'sql' or benchmark:
+        conn = sqlite3.connect(database)
+        labels = population_base(conn, **(filters or {}))
+    timings = []
     
-    earn_cols = [i for i in col_order if 'earnings' in i]
-
     for tab in d:
         print('current table: {}'.format(tab))
         #generate population and earnings tables
-        pop = make_population_table(data,d[tab])
-        
-        #if labforce is specified as a group not eligible to report income, create null earnings table
-        if 'labforce' in d[tab]['restriction'] and any(x in d[tab]['restriction']['labforce'] for x in ['UNEMPLOYED','NOT IN LABOR FORCE']):
-            for e in earn_cols:
-                pop[e] = np.nan
-            out = pop.copy()
+        if benchmark:
+            t = time.perf_counter()
+            pop_pd = make_population_table(df,d[tab],cache)
+            t_pd = time.perf_counter() - t
+            
+            t = time.perf_counter()
+            pop_sql = make_population_table_sql(conn,d[tab],labels)
+            t_sql = time.perf_counter() - t
+            
+            try:
+                pd.testing.assert_frame_equal(pop_pd.reset_index(drop=True), pop_sql.reset_index(drop=True), check_exact=False)
+                match = True
+            except AssertionError:
+                match = False
+            timings.append({'table':tab, 'pandas':t_pd, 'sql':t_sql, 'match':match})
+            print('pandas {:.3f}s, sql {:.3f}s, match {}'.format(t_pd, t_sql, match))
+            
+            pop = pop_sql if engine == 'sql' else pop_pd
+        elif engine == 'sql':
+            pop = make_population_table_sql(conn,d[tab],labels)
         else:
-            earn = make_earnings_table(data,d[tab])
+            pop = None
+        
+        out = make_table(df,d[tab],cache,pop)
+        
+        #write to table
+        sink_write(sink, out)
+        
+        print('{} written to file'.format(tab))
+    
+    if engine == 'sql' or benchmark:
+        conn.close()
+    
+    close_sink(sink)
+    
+    if cache is not None:
+        print('aggregation cache: {} hits, {} misses, {:.1f} MB held'.format(cache['hits'], cache['misses'], cache['size'] / 2**20))
+    
+    if benchmark:
+        timings = pd.DataFrame(timings).set_index('table')
+        print('population tables, pandas {:.3f}s, sql {:.3f}s, {} of {} match'.format(
+            timings['pandas'].sum(), timings['sql'].sum(), timings['match'].sum(), len(timings)))
+        
+        return(timings)
+        
+def table_batches(d, workers, split=TABLE_BATCH_SPLIT):
+    '''
+    splits the tables of d into batches for worker processes. tables with the
+    same restriction are kept together so they share cached work, unless
+    their estimated cost is over a share of the total, then they are split
+    into consecutive runs under that share so one restriction does not hold
+    up the pool. a table's cost is estimated from its grouping levels,
+    doubled when it reports earnings
+    
+    :param d: dictionary containing table creation commands
+    :param workers: int number of worker processes
+    :param split: int default TABLE_BATCH_SPLIT, batches per worker the total cost is divided into
+    :return: list of lists of table names, costliest batch first
+    '''
+    cost = {tab:(len(d[tab]) - 2) * (2 if has_earnings(d[tab]) else 1) for tab in d}
+    limit = max(max(cost.values(), default=0), sum(cost.values()) / (workers * split))
+    
+    groups = {}
+    for tab in d:
+        groups.setdefault(restriction_key(d[tab]['restriction']), []).append(tab)
+    
+    batches = []
+    for tabs in groups.values():
+        batches.append([0, []])
+        for tab in tabs:
+            if batches[-1][0] + cost[tab] > limit and len(batches[-1][1]) > 0:
+                batches.append([0, []])
+            batches[-1][0] += cost[tab]
+            batches[-1][1].append(tab)
+    
+    #costliest first, so the longest batch is not the one left running at the end
+    return([tabs for _, tabs in sorted(batches, key=lambda x: -x[0])])
+
+def generate_tables_parallel(df, d, sink, cache_mb=AGG_CACHE_MB, workers=2, shared_dir=None):
+    '''
+    builds the tables of d on a pool of worker processes. the microdata is
+    shared once through a memory mapped columnar store, see share_microdata.
+    tables are built in batches that share cached work, see table_batches,
+    and are written in the order of d as they finish
+    
+    :param df: DataFrame containing microdata
+    :param d: dictionary containing table creation commands
+    :param sink: dict returned by aggregate_sink, tables are written to it
+    :param cache_mb: int default AGG_CACHE_MB, memory budget of each worker's cache
+    :param workers: int default 2, number of worker processes
+    :param shared_dir: string default None, directory the shared store is created in
+    '''
+    batches = table_batches(d, workers)
+    
+    with tempfile.TemporaryDirectory(dir=shared_dir) as storedir:
+        share_microdata(df, storedir)
+        
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_table_worker, initargs=(storedir, cache_mb)) as executor:
+            jobs = {}
+            for tabs in batches:
+                job = executor.submit(_table_worker, [d[tab] for tab in tabs])
+                for i, tab in enumerate(tabs):
+                    jobs[tab] = (job, i)
+            
+            #batches finish in any order, tables are written in the order of d
+            for tab in d:
+                job, i = jobs[tab]
+                sink_write(sink, job.result()[i])
                 
-            out = pop.merge(earn,on=d[tab]['key'],how='outer')        
+                print('{} written to file'.format(tab))
+
+def partial_file(storedir, month, key):
+    '''
+    file holding one month of the cells with a given cache key
+    
+    :param storedir: string directory of the partials store
+    :param month: int yyyymm
+    :param key: tuple cache key, see cells_key
+    '''
+    return(os.path.join(storedir, str(month), hashlib.sha1(repr(key).encode()).hexdigest() + '.pkl'))
+
+def read_partials(storedir, months, key):
+    '''
+    stacks the cells of one table spec across months, every cell holds one month
+    
+    :param storedir: string directory of the partials store
+    :param months: list of int yyyymm
+    :param key: tuple cache key, see cells_key
+    '''
+    return(pd.concat([pd.read_pickle(partial_file(storedir, m, key)) for m in months]))
+
+def store_months(database, start_month=None, end_month=None, states=None):
+    '''
+    months of microdata between the bounds and the hash of the partition each
+    was loaded from, stores of monthly sums are kept up to date against them
+    
+    :param database: string file path to database containing microdata
+    :param start_month end_month: int default None, inclusive yyyymm bounds
+    :param states: list default None, states the months must hold
+    :return: tuple of (sorted list of int yyyymm, dict of yyyymm -> partition hash),
+        months loaded with their whole year (yyyy00, see combine_data) have the year's hash
+    '''
+    conn = create_connection(database)
+    where, params, _ = microdata_filter(conn, MICRODATA_FIELDS, 'microdata', start_month, end_month, states, None, read_labels(conn))
+    months = sorted(i[0] for i in conn.execute('SELECT DISTINCT HRMONTH2 FROM microdata' + where, params))
+    try:
+        loaded = dict(conn.execute('SELECT month, hash FROM partitions').fetchall())
+    except sqlite3.Error:
+        loaded = {}
+    conn.close()
+    
+    return(months, {m:loaded.get(m, loaded.get(m // 100 * 100)) for m in months})
+
+def update_partials(database, d, storedir, start_month=None, end_month=None, states=None, cache_mb=AGG_CACHE_MB):
+    '''
+    keeps a store of monthly partials in {storedir}/{yyyymm}/, the cells
+    every table of d is rolled up from, see cell_specs: each month's weighted
+    sums and observations at the table's finest grain and, for earnings, per
+    PRERNWA value. grouping levels are rolled up from them when tables are
+    built. only months without partials, or whose microdata partition or
+    table instructions changed since, are read from the database
+    
+    :param database: string file path to database containing microdata
+    :param d: dictionary containing table creation commands
+    :param storedir: string directory of the partials store
+    :param start_month end_month: int default None, inclusive yyyymm bounds on the months kept up to date
+    :param states: list default None, states aggregated, partials of other states are replaced
+    :param cache_mb: int default AGG_CACHE_MB, memory budget for work shared between tables
+    :return: list of the months in the database between the bounds
+    '''
+    months, loaded = store_months(database, start_month, end_month, states)
+    
+    tables = hashlib.sha1(repr(d).encode()).hexdigest()
+    for m in months:
+        monthdir = os.path.join(storedir, str(m))
+        meta_file = os.path.join(monthdir, 'partials.json')
+        meta = {'version':PARTIALS_VERSION, 'hash':loaded.get(m), 'states':states, 'tables':tables}
+        if os.path.exists(meta_file):
+            with open(meta_file) as f:
+                if json.load(f) == meta:
+                    continue
+        
+        print('computing partials for {}'.format(m))
+        retire_partials(storedir, [m])
+        os.makedirs(monthdir)
         
-        #suppress values
-#        out = suppress_output(out, d[tab]['key'])
+        data = get_microdata(database, base_pop=False, start_month=m, end_month=m, states=states)
+        cache = agg_cache(cache_mb) if cache_mb else None
+        written = set()
+        for tab in d:
+            specs = cell_specs(d[tab])
+            for spec in specs if has_earnings(d[tab]) else specs[:1]:
+                key = cells_key(data, *spec)
+                if key not in written:
+                    pd.to_pickle(restricted_cells(data, *spec, cache), partial_file(storedir, m, key))
+                    written.add(key)
+        del data
         
-        #relable EDUC2 variable for lumina tables
-        out.rename(columns={'EDUC2':'education'},inplace=True)
-        d[tab]['key'] = [i.replace('EDUC2','education') for i in d[tab]['key']]
+        #written last, a month interrupted part way is computed again
+        with open(meta_file, 'w') as f:
+            json.dump(meta, f)
+    
+    return(months)
+
+def retire_partials(storedir, months):
+    '''
+    removes months from the partials store, ex. months that left a rolling window
+    
+    :param storedir: string directory of the partials store
+    :param months: list of int yyyymm
+    '''
+    for m in months:
+        monthdir = os.path.join(storedir, str(m))
+        if os.path.exists(monthdir):
+            for f in os.listdir(monthdir):
+                os.remove(os.path.join(monthdir, f))
+            os.rmdir(monthdir)
+
+def histogram_file(storedir, month, grouping):
+    '''
+    file holding one month's histogram of a dimension grouping
+    
+    :param storedir: string directory of the histogram store
+    :param month: int yyyymm
+    :param grouping: list of columns, see QUERY_GROUPINGS
+    '''
+    return(os.path.join(storedir, str(month), '-'.join(grouping) + '.pkl'))
 
-        #assign base population values
-        out = assign_base_values(out,d[tab]['key'])
+def update_histograms(database, storedir, start_month=None, end_month=None, states=None,
+                      groupings=QUERY_GROUPINGS, bucket=QUERY_EARNINGS_BUCKET):
+    '''
+    keeps the store cross-tabs are answered from, {storedir}/{yyyymm}/ holds
+    for each dimension grouping the month's weighted sums and observations
+    per combination of its labels, base population, earnings eligibility,
+    weekly earnings bucket and certification segment present. earnings are
+    only kept for persons eligible to report them, everyone else collapses
+    into one cell per combination of labels. a bucket holds the earnings from
+    its value up to the next bucket's. only months without histograms, or
+    whose microdata partition or groupings changed since, are read from the
+    database
+    
+    :param database: string file path to database containing microdata
+    :param storedir: string directory of the histogram store
+    :param start_month end_month: int default None, inclusive yyyymm bounds on the months kept up to date
+    :param states: list default None, states tabulated, histograms of other states are replaced
+    :param groupings: list default QUERY_GROUPINGS, dimension groupings kept
+    :param bucket: number default QUERY_EARNINGS_BUCKET, width of the earnings buckets in dollars
+    :return: list of the months in the database between the bounds
+    '''
+    months, loaded = store_months(database, start_month, end_month, states)
+    
+    for m in months:
+        monthdir = os.path.join(storedir, str(m))
+        meta_file = os.path.join(monthdir, 'histogram.json')
+        meta = {'version':STORE_VERSION, 'hash':loaded.get(m), 'states':states,
+                'groupings':[list(g) for g in groupings], 'bucket':bucket}
+        if os.path.exists(meta_file):
+            with open(meta_file) as f:
+                if json.load(f) == meta:
+                    continue
         
-        #properly order columns
-        out = out[col_order]
+        print('computing histogram for {}'.format(m))
+        retire_partials(storedir, [m])
+        os.makedirs(monthdir)
         
-        #write to table
-        with open('{}{}.csv'.format(outpath,fname), 'a', newline='') as f:
-            out.to_csv(f, mode='a', header=f.tell()==0)
-        #write_to_table(out,table_out,database)
+        data = get_microdata(database, base_pop=False, start_month=m, end_month=m, states=states)
+        data['PRERNWA'] = (np.floor(data['PRERNWA'] / bucket) * bucket).where(data['PRERELG'] == 1)
         
-        print('{} written to file'.format(tab))
+        #the rows of each base population are found once for every grouping
+        cache = agg_cache()
+        for g in groupings:
+            cells = restricted_cells(data, {}, list(g) + ['PRERELG','PRERNWA','HRMONTH2','cert'],
+                                     ['PWSSWGT','PWORWGT','individual'], cache).reset_index()
+            
+            #labels repeat across cells, stored once per month as categories
+            for c in ['base_pop'] + list(g):
+                cells[c] = cells[c].astype('category')
+            pd.to_pickle(cells, histogram_file(storedir, m, g))
+        del data, cache
         
-def create_aggregate_table(database,metadata,fname):
+        #written last, a month interrupted part way is computed again
+        with open(meta_file, 'w') as f:
+            json.dump(meta, f)
+    
+    return(months)
+
+def histogram_months(storedir, start_month=None, end_month=None):
+    '''
+    months of the histogram store between the bounds, with what each was
+    computed from so answers from a month updated since are not reused
+    
+    :param storedir: string directory of the histogram store, see update_histograms
+    :param start_month end_month: int default None, inclusive yyyymm bounds
+    :return: tuple of (int yyyymm, string histogram.json contents)
+    '''
+    months = []
+    for m in sorted(os.listdir(storedir)) if os.path.exists(storedir) else []:
+        meta_file = os.path.join(storedir, m, 'histogram.json')
+        if not m.isdigit() or not os.path.exists(meta_file):
+            continue
+        if (start_month is not None and int(m) < start_month) or (end_month is not None and int(m) > end_month):
+            continue
+        with open(meta_file) as f:
+            months.append((int(m), f.read()))
+    
+    if len(months) == 0:
+        raise ValueError("no histograms between {} and {} in {}".format(start_month, end_month, storedir))
+    
+    return(tuple(months))
+
+def read_histograms(storedir, months, grouping, cache=None):
+    '''
+    stacks the monthly histograms of one dimension grouping, months share label categories
+    
+    :param storedir: string directory of the histogram store, see update_histograms
+    :param months: tuple returned by histogram_months
+    :param grouping: list of columns, one of the groupings the store keeps
+    :param cache: dict default None, see agg_cache
+    :return: DataFrame of cells, see update_histograms
+    '''
+    key = ('histograms', storedir, months, tuple(grouping))
+    cells = cache_get(cache, key)
+    if cells is not None:
+        return(cells)
+    
+    cells = pd.concat([pd.read_pickle(histogram_file(storedir, m, grouping)) for m, _ in months], ignore_index=True)
+    
+    #months with different labels stack as plain text
+    for c in ['base_pop'] + list(grouping):
+        if not isinstance(cells[c].dtype, pd.CategoricalDtype):
+            cells[c] = cells[c].astype('category')
+    
+    return(cache_put(cache, key, cells))
+
+def query_crosstab(storedir, group, restriction=None, start_month=None, end_month=None, quantiles=None, cache=None):
+    '''
+    population totals, observations and median earnings of a cross-tab of
+    base_pop and the columns of any one dimension grouping of the store, ex.
+    a group and restriction no table spec has. computed from the smallest
+    grouping holding the group and restriction columns as make_population_table
+    and make_earnings_table compute a table with the same group and
+    restriction from microdata. populations and observations are the same,
+    earnings quantiles are those of microdata with earnings rounded down to
+    their bucket, see update_histograms. answers are cached by their arguments
+    and the months they were computed from
+    
+    :param storedir: string directory of the histogram store, see update_histograms
+    :param group: list of columns to group on
+    :param restriction: dict default None, column -> value or list of values, as in table specs
+    :param start_month end_month: int default None, inclusive yyyymm bounds on the months averaged
+    :param quantiles: list default None, extra earnings quantiles, see make_earnings_table
+    :param cache: dict default None, holds histograms and answers, see agg_cache
+    :return: DataFrame of the group columns then the population and earnings
+        columns of AGGREGATE_COLUMNS, a row per group
+    '''
+    group = list(group)
+    restriction = restriction or {}
+    if len(group) == 0:
+        raise ValueError("a cross-tab groups on at least one column")
+    unknown = [c for c in group + list(restriction) if c not in ['base_pop'] + QUERY_DIMENSIONS]
+    if len(unknown) > 0:
+        raise ValueError("cannot group or restrict on {}".format(', '.join(unknown)))
+    
+    months = histogram_months(storedir, start_month, end_month)
+    
+    #every month was built with the same groupings, the fewest columns is the fewest cells
+    groupings = [json.loads(meta)['groupings'] for _, meta in months]
+    if any(g != groupings[0] for g in groupings):
+        raise ValueError("months between {} and {} were built with different groupings".format(start_month, end_month))
+    needed = set(group + list(restriction)) - {'base_pop'}
+    fits = [g for g in groupings[0] if needed <= set(g)]
+    if len(fits) == 0:
+        raise ValueError("no grouping holds {}, groupings are {}".format(', '.join(sorted(needed)), groupings[0]))
+    grouping = min(fits, key=len)
+    
+    key = ('crosstab', tuple(group), restriction_key(restriction), tuple(quantiles or []), storedir, months)
+    out = cache_get(cache, key)
+    if out is not None:
+        return(out)
+    
+    cells = read_histograms(storedir, months, grouping, cache)
+    
+    #a table spec with one grouping level, its cells are summed from the histogram
+    #cells rather than from microdata
+    d = {'key':group, 'restriction':restriction, 'crosstab':{'group':group, 'fill':{}}}
+    out = make_population_table(cells, d)
+    
+    if has_earnings(d):
+        out = out.merge(make_earnings_table(cells, d, quantiles), on=group, how='outer')
+    else:
+        for e in [i for i in AGGREGATE_COLUMNS if 'earnings' in i]:
+            out[e] = np.nan
+    
+    for c in group:
+        if isinstance(out[c].dtype, pd.CategoricalDtype):
+            out[c] = out[c].astype(object)
+    
+    return(cache_put(cache, key, out.reset_index(drop=True)))
+
+def parse_crosstab(query):
+    '''
+    arguments of query_crosstab from the query string of a cross-tab request,
+    ex. group=state,sex&restriction={"labforce":"EMPLOYED"}&start_month=201601&quantiles=0.1,0.9
+    
+    :param query: string url query
+    :return: dict of keyword arguments
+    '''
+    params = {k:v[-1] for k, v in parse_qs(query).items()}
+    
+    if 'group' not in params:
+        raise ValueError("group is required")
+    unknown = [i for i in params if i not in ['group','restriction','start_month','end_month','quantiles']]
+    if len(unknown) > 0:
+        raise ValueError("unknown parameters {}".format(', '.join(unknown)))
+    
+    kwargs = {'group':[i for i in params['group'].split(',') if i != '']}
+    if 'restriction' in params:
+        kwargs['restriction'] = json.loads(params['restriction'])
+        if not isinstance(kwargs['restriction'], dict):
+            raise ValueError("restriction must be a json object")
+    for b in ['start_month','end_month']:
+        if b in params:
+            kwargs[b] = int(params[b])
+    if 'quantiles' in params:
+        kwargs['quantiles'] = [float(i) for i in params['quantiles'].split(',') if i != '']
+    
+    return(kwargs)
+
+def serve_crosstab(storedir, host='127.0.0.1', port=QUERY_PORT, cache_mb=QUERY_CACHE_MB):
+    '''
+    answers cross-tab requests over http until interrupted, ex.
+    GET /crosstab?group=state,sex&restriction={"labforce":"EMPLOYED"} returns the
+    rows of query_crosstab as a json list of records, see parse_crosstab.
+    requests are answered one at a time from one cache
+    
+    :param storedir: string directory of the histogram store, see update_histograms
+    :param host: string default '127.0.0.1', address listened on
+    :param port: int default QUERY_PORT, port listened on
+    :param cache_mb: int default QUERY_CACHE_MB, memory budget for histograms and answers
+    '''
+    cache = agg_cache(cache_mb)
+    
+    class CrosstabHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != '/crosstab':
+                status, body = 404, json.dumps({'error':'unknown path {}'.format(url.path)})
+            else:
+                try:
+                    status, body = 200, query_crosstab(storedir, cache=cache, **parse_crosstab(url.query)).to_json(orient='records')
+                except (ValueError, TypeError) as e:
+                    status, body = 400, json.dumps({'error':str(e)})
+                #a failed query is answered rather than dropping the connection
+                except Exception as e:
+                    status, body = 500, json.dumps({'error':'{}: {}'.format(type(e).__name__, e)})
+            
+            body = body.encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+    
+    server = HTTPServer((host, port), CrosstabHandler)
+    print('serving cross-tabs on http://{}:{}/crosstab'.format(*server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def create_aggregate_table(database,metadata,fname,start_month=None,end_month=None,states=None,engine='pandas',benchmark=False,workers=1,target='csv',partials_dir=None):
     '''
     entry point for aggregate table creation process
     
     :param database: string file path to database containing microdata
     :param metadata: string file path to dictionary containing table creation commands
     :param fname: string output table name
+    :param start_month end_month: int default None, inclusive yyyymm bounds on the months aggregated
+    :param states: list default None, states to aggregate, 'US' rows then cover only these states
+    :param engine: string default 'pandas', 'sql' builds population tables inside the database
+    :param benchmark: bool default False, time the pandas and sql engines against each other
+    :param workers: int default 1, number of processes tables are built on, see generate_tables
+    :param target: string default 'csv', output written, 'csv', 'parquet' or the aggregate
+        table of database with 'sqlite'
+    :param partials_dir: string default None, directory of monthly partials. when given
+        only months without partials are read from the database, the tables combine the
+        partials of the months between start_month and end_month, see update_partials
     '''
     
     d = get_dict(metadata)
-    data = get_microdata(database)
+    filters = {'start_month':start_month, 'end_month':end_month, 'states':states}
+    
+    if partials_dir is not None and engine == 'pandas' and not benchmark:
+        months = update_partials(database, d, partials_dir, **filters)
+        if len(months) == 0:
+            raise ValueError("no microdata between {} and {}".format(start_month, end_month))
+        
+        #every monthly total is read from the store, so no microdata is needed
+        return(generate_tables(pd.DataFrame(), d, database, fname, target=target, partials=(partials_dir, months)))
+    
+    #base populations are tabulated by the engine, not duplicated
+    data = get_microdata(database, base_pop=False, **filters)
 
-    generate_tables(data, d, database, fname)
+    return(generate_tables(data, d, database, fname, engine=engine, benchmark=benchmark, filters=filters, workers=workers, target=target))
     
         
 def smooth_data(df):
@@ -1172,7 +3634,7 @@ def smooth_data(df):
         s_n = '{}_sh'.format(small)
 
         df[s_n] = df[small].fillna(0) / (df[small].fillna(0)+df[large].fillna(0))
-        df[s_n].fillna(0,inplace=True)
+        df[s_n] = df[s_n].fillna(0)
 
     get_shares(df,'population_PECERT1_y','population_PECERT1_n')        
     get_shares(df,'population_PECERT2_y','population_PECERT2_n')
@@ -1190,9 +3652,37 @@ def smooth_data(df):
     
     df.drop(['population_PECERT1_y_sh','population_PECERT2_y_sh'],axis=1,inplace=True)
 
+def drop_near_duplicates(df, rtol=1e-12):
+    '''
+    drops rows repeating an earlier row's labels with measures equal to within
+    rtol. tables rolled up from different grains sum the same cells in a
+    different order, so a row shared by two tables can differ in the last bits
+    
+    :param df: DataFrame of aggregate output
+    :param rtol: relative tolerance measures are compared at (float)
+    '''
+    measures = list(df.select_dtypes('number').columns)
+    keys = [c for c in df.columns if c not in measures]
+    
+    #compare each repeated row to the first of its labels, rows that differ
+    #go around again so they are compared among themselves
+    drop = []
+    rest = df[df.duplicated(keys, keep=False)]
+    while len(rest):
+        later = rest.duplicated(keys).to_numpy()
+        ids = rest.groupby(keys, dropna=False, sort=False).ngroup().to_numpy()
+        vals = rest[measures].to_numpy(dtype=float)
+        first = vals[~later][ids]
+        same = later & np.isclose(vals, first, rtol=rtol, atol=0, equal_nan=True).all(axis=1)
+        drop.extend(rest.index[same])
+        rest = rest[later & ~same]
+    
+    return(df.drop(drop))
+
 def convert(fname):
     '''
-    smooths and drop duplicates from .csv output file
+    smooths and drop duplicates from .csv output file appended to table by
+    table, output written by aggregate_sink is already smoothed and deduplicated
     
     :param fname: string file path to .csv file containing aggregate output
     '''
@@ -1211,57 +3701,39 @@ def convert(fname):
     df = df[~df['state'].isna()]
     
     #drop duplicates
-    df.drop_duplicates(inplace=True)
-    
-    col_order = [
-        'state', 
-        'base_pop', 
-        'labforce',
-        'emp_type', 
-        'emp_stat',
-        'education', 
-        'sex', 
-        'race',
-        'age', 
-        'industry', 
-        'occupation',
-        'population_total',
-        'population_PECERT1_y',
-        'population_PECERT1_n', 
-        'population_PECERT2_y', 
-        'population_PECERT2_n',
-        'population_observed_total',
-        'population_observed_PECERT1_y', 
-        'population_observed_PECERT1_n',
-        'population_observed_PECERT2_y', 
-        'population_observed_PECERT2_n',
-        'median_earnings_total',
-        'median_earnings_PECERT1_y', 
-        'median_earnings_PECERT1_n',
-        'median_earnings_PECERT2_y', 
-        'median_earnings_PECERT2_n',
-        'earnings_observed_total',
-        'earnings_observed_PECERT1_y', 
-        'earnings_observed_PECERT1_n',
-        'earnings_observed_PECERT2_y', 
-        'earnings_observed_PECERT2_n',
-        'population_PECERT1_y_sm',
-        'population_PECERT1_n_sm',
-        'population_PECERT2_y_sm',
-        'population_PECERT2_n_sm'
-        ]
+    df = drop_near_duplicates(df)
     
     dataframe = df.copy()
-    dataframe = dataframe[col_order]
+    dataframe = dataframe[OUTPUT_COLUMNS]
 
     dataframe.to_csv(fname, index=False, header=True)
 
-def main(var_int, outpath, start_year, end_year):
+def database_signature(database, metadata):
+    '''
+    hash of the partitions loaded into microdata and of the table instructions,
+    aggregate tables built from the same signature are unchanged
+    
+    :param database: string file path to database containing microdata
+    :param metadata: string file path to dictionary containing table creation commands
+    '''
+    conn = create_connection(database)
+    loaded = conn.execute('SELECT month, hash FROM partitions ORDER BY month').fetchall()
+    conn.close()
+    
+    return(input_signature([metadata], loaded))
+
+def main(var_int, outpath, start_year, end_year, workers=1, refresh=False, partials=False, crosstab=False):
     '''
-    coordinates order of functions above
+    coordinates order of functions above, each stage only redoes the months
+    whose inputs changed since the last run
     :param database: path to database file (str)
     :param var_int: variables of interest to restrict dataframes in cleaning step (list[str])
     :param start_year end_year: starting and ending years to be observed (int)
+    :param workers: number of worker processes used when cleaning data and building tables (int)
+    :param refresh: ask census whether downloaded files were revised, only changed files are downloaded again (bool)
+    :param partials: build tables from monthly partials kept in outpath, only new or changed
+        months are read but tables are built serially, see update_partials (bool)
+    :param crosstab: keep the histograms serve_crosstab answers from in outpath, see update_histograms (bool)
     '''
     #define file path to database
     database = outpath + 'FILE PATH TO DATABASE'
@@ -1272,11 +3744,27 @@ def main(var_int, outpath, start_year, end_year):
     variable_encoding = "FILE PATH TO CPS DICTIONARY"
 
     #get data and build aggregate file
-    get_raw_data(start_year,end_year)
-    clean_data(var_int,start_year,end_year,variable_encoding)
+    get_raw_data(start_year,end_year,refresh=refresh)
+    clean_data(var_int,start_year,end_year,variable_encoding,workers=workers)
     combine_data(database,start_year,end_year)
-    create_aggregate_table(database,metadata,'cps_aggregate_database_{}_{}'.format(start_year,end_year))
-    convert('{}cps_aggregate_database_{}_{}.csv'.format(outpath,start_year,end_year))
+    
+    #histograms cross-tabs outside the table specs are answered from, see serve_crosstab
+    if crosstab:
+        update_histograms(database, outpath + 'cps_crosstab_histograms')
+    
+    #aggregate tables are only rebuilt when microdata changed
+    fname = '{}cps_aggregate_database_{}_{}.csv'.format(outpath,start_year,end_year)
+    manifest = read_pipeline()
+    signature = database_signature(database, metadata)
+    if os.path.exists(fname) and manifest.get('aggregate', {}).get(fname) == signature:
+        print("aggregate tables are up to date")
+        return
+    
+    create_aggregate_table(database,metadata,'cps_aggregate_database_{}_{}'.format(start_year,end_year),workers=workers,
+                           partials_dir=outpath + 'cps_aggregate_partials' if partials else None)
+    
+    manifest.setdefault('aggregate', {})[fname] = signature
+    write_pipeline(manifest)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,640 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the CPS microdata compiler
+
+@author: Gabriel Moss
+"""
+import pandas as pd
+import numpy as np
+import os
+import sys
+import json
+import time
+import pickle
+import zipfile
+import sqlite3
+import queue as queues
+import platform
+import multiprocessing
+import tracemalloc
+import cps_aggregate_table as cat
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+#variables written to synthetic raw files, the variables of interest main cleans
+SYNTHETIC_VARIABLES = ['QSTNUM', 'PULINENO', 'OCCURNUM', 'HURESPLI', 'HUFINAL', 'HWHHWGT', 'HRMONTH', 'HEFAMINC', 
+           'PRCIVLF', 'PREMPNOT', 'PWSSWGT', 'PEEDUCA', 'PEAFNOW', 'PEIO1COW', 'PEIO2COW', 
+           'PRCOW1', 'PRCOW2', 'PRDTOCC1', 'PRDTOCC2', 'PREMP', 'PRMJIND1', 'PRMJIND2', 
+           'PRMJOCC1', 'PRMJOCC2', 'PEIO1OCD', 'PEIO2ICD', 'PEIO2OCD', 'PEHRFTPT', 'PEMLR', 
+           'PRTAGE', 'PRTFAGE', 'PESEX', 'PTDTRACE', 'PRDTHSP', 'PEHSPNON', 'PRERNWA', 
+           'PTWK', 'GEREG', 'PECERT1', 'PECERT2', 'PECERT3', 'PREXPLF', 'PRFTLF', 'PRHRUSL', 'PRPTHRS', 
+           'PRPTREA', 'PRWKSTAT', 'PRDTIND1', 'GESTFIPS', 'GTCBSA', 'GTCO', 'GTCBSAST', 
+           'GTMETSTA', 'GTINDVPC', 'GTCBSASZ', 'GTCSA', 'PRMJOCGR', 'PEERNLAB', 'PRCITSHP', 
+           'PRERNHLY', 'PEERNCOV', 'PWORWGT', 'HRYEAR4','PRERELG','PRPERTYP','PWVETWGT','PEAFEVER','PEAFWHN1','HRMIS']
+
+#field widths of synthetic records as in the census layouts, other fields are 2 wide
+SYNTHETIC_WIDTHS = {'HRHHID':15, 'QSTNUM':5, 'HWHHWGT':10, 'PWSSWGT':10, 'PWORWGT':10, 'PWVETWGT':10,
+                    'PRERNWA':6, 'GTCBSA':5, 'PEIO1OCD':4, 'PEIO2ICD':4, 'PEIO2OCD':4, 'HRYEAR4':4,
+                    'PRERNHLY':4, 'GTCO':3, 'GTCSA':3, 'HUFINAL':3, 'PRTAGE':2}
+
+#pipeline stages benchmarked by bench_pipeline, in the order main runs them
+BENCH_STAGES = ['clean_data', 'combine_data', 'get_microdata', 'generate_tables']
+
+def peak_rss_mb():
+    '''
+    peak resident set size of the current process in MB, None where the
+    resource module is unavailable (windows)
+    '''
+    if resource is None:
+        return(None)
+
+    #linux reports kilobytes, macos bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return(peak / 2.0**20 if sys.platform == 'darwin' else peak / 1024.0)
+
+def child_result(proc, queue, timeout=None, poll=1.0):
+    '''
+    waits for the result a benchmark child process puts on queue and joins
+    it. a child that exits without a result, ex. after an exception, or that
+    runs past timeout is reported rather than waited on forever
+    
+    :param proc: started multiprocessing.Process
+    :param queue: multiprocessing.Queue the child puts its result on
+    :param timeout: float default None, seconds to wait, None waits while the child runs
+    :param poll: float default 1.0, seconds between checks that the child is alive
+    :return: tuple of (result, None) or (None, string reason the child failed)
+    '''
+    start = time.perf_counter()
+    while True:
+        wait = poll if timeout is None else max(0.0, min(poll, timeout - (time.perf_counter() - start)))
+        try:
+            result = queue.get(timeout=wait)
+            proc.join()
+            return(result, None)
+        except queues.Empty:
+            pass
+        
+        if not proc.is_alive():
+            #a result put just before exiting may still be in flight
+            try:
+                result = queue.get(timeout=poll)
+                proc.join()
+                return(result, None)
+            except queues.Empty:
+                proc.join()
+                return(None, 'exited with code {}'.format(proc.exitcode))
+        if timeout is not None and time.perf_counter() - start >= timeout:
+            proc.terminate()
+            proc.join()
+            return(None, 'timed out after {}s'.format(timeout))
+
+def synthetic_month(rows, mo, seed=0):
+    '''
+    builds a columnar month shaped like the output of load_month, 69 integer
+    variables plus the weight and recode columns added during cleaning
+
+    :param rows: number of records in the month (int)
+    :param mo: month number (int)
+    :param seed: random seed (int)
+    '''
+    rng = np.random.default_rng(seed + mo)
+
+    out = {'V{}'.format(i):rng.integers(-1, 100, rows).astype(np.int32) for i in range(65)}
+    for c in ['QSTNUM','HWHHWGT','PWVETWGT','GTCBSA']:
+        out[c] = rng.integers(0, 10**8, rows)
+    for c in ['PWSSWGT','PWORWGT','PRERNWA']:
+        out[c] = rng.random(rows) * 10000
+    out['individual'] = np.ones(rows, dtype=np.int64)
+    for c, labels in [('EMP_STATUS',['Full-time','Part-time',np.nan]),
+                      ('age',['16 to 24','25 to 54','55 and older']),
+                      ('age2',['16 to 24','25 to 34','35 to 44','45 to 54','55 to 64','65 and older']),
+                      ('EDUC',['NO HIGH SCHOOL DIPLOMA','BACHELORS DEGREE',np.nan]),
+                      ('EDUC2',['SOME COLLEGE OR ASSOCIATES','BACHELORS OR HIGHER',np.nan]),
+                      ('EDUC3',['MID-SKILLED','HS GRADUATE OR GED',np.nan]),
+                      ('OCC4',['Farming and Construction',np.nan]),
+                      ('RACE',['WHITE','BLACK','ASIAN','INDIGENOUS','MULTI-RACIAL'])]:
+        out[c] = np.array(labels, dtype=object)[rng.integers(0, len(labels), rows)]
+    out['HRMONTH2'] = np.full(rows, 202000 + mo, dtype=np.int64)
+
+    return(out)
+
+def assemble_append(parts):
+    '''
+    the pre-concat assembly, growing the year one month at a time. each step
+    copies everything accumulated so far, as DataFrame.append did
+
+    :param parts: list of columnar month dicts
+    '''
+    dataframe = pd.DataFrame()
+    for p in parts:
+        dataframe = pd.concat([dataframe, pd.DataFrame(p)])
+
+    return(dataframe)
+
+def assemble_concat(parts):
+    '''
+    single allocation assembly used by clean_year
+
+    :param parts: list of columnar month dicts
+    '''
+    return(cat.concat_columns(parts))
+
+def _run_assembly(method, rows, queue):
+    '''
+    child process body for bench_year_assembly, builds the months, records the
+    resident size, then assembles the year and reports the peak. tracemalloc
+    stands in for rss where the resource module is unavailable, it slows the
+    run down so it is only used there
+    '''
+    parts = [synthetic_month(rows, mo) for mo in range(1, 13)]
+    before = peak_rss_mb()
+    if before is None:
+        tracemalloc.start()
+
+    t = time.perf_counter()
+    df = {'append':assemble_append, 'concat':assemble_concat}[method](parts)
+    elapsed = time.perf_counter() - t
+
+    if before is None:
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    else:
+        peak = peak_rss_mb() - before
+
+    queue.put({
+        'method':method,
+        'rows':len(df),
+        'seconds':elapsed,
+        'peak_growth_mb':peak
+        })
+
+def bench_year_assembly(rows=130000):
+    '''
+    compares peak memory and time of month-by-month append against the
+    single concat when assembling a full year (12 months) in clean_data.
+    each method runs in a fresh process so peak rss is not shared
+
+    :param rows: records per month, a full cps month is roughly 130k (int)
+    '''
+    results = []
+    for method in ['append','concat']:
+        queue = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=_run_assembly, args=(method, rows, queue))
+        proc.start()
+        result, error = child_result(proc, queue)
+        results.append(result if error is None else {'method':method, 'error':error})
+
+    out = pd.DataFrame(results).set_index('method')
+    print(out.to_string())
+
+    return(out)
+
+def bench_population_engines(database, metadata, fname='cps_engine_benchmark'):
+    '''
+    builds every population table with the pandas and sql engines and reports
+    the time each took and whether the outputs match
+
+    :param database: string file path to database containing microdata
+    :param metadata: string file path to dictionary containing table creation commands
+    :param fname: string name of the aggregate csv written to outpath while benchmarking
+    '''
+    timings = cat.create_aggregate_table(database, metadata, fname, benchmark=True)
+    print(timings.to_string())
+
+    return(timings)
+
+def load_fetchall(database, table='microdata'):
+    '''
+    the loader get_microdata used before reading in typed chunks, one python
+    tuple per row then derived columns built row by row. text databases only
+
+    :param database: string file path to database containing microdata
+    :param table: string default 'microdata' table name containing microdata
+    '''
+    conn = sqlite3.connect(database)
+    df = pd.DataFrame(conn.execute('SELECT {} FROM {}'.format(', '.join(cat.MICRODATA_FIELDS.values()), table)).fetchall(),
+                      columns=list(cat.MICRODATA_FIELDS))
+    conn.close()
+
+    df.replace({'nan':np.nan}, inplace=True)
+    df['individual'] = [1 if i == 4 else 0 for i in df['month']]
+    df['PECERT1_y'] = [str(i).upper()=='YES' for i in df['PECERT1']]
+    df['PECERT1_n'] = [str(i).upper()=='NO' for i in df['PECERT1']]
+    df['PECERT2_y'] = df['PECERT1_y'] & np.array([str(i).upper()=='YES' for i in df['PECERT2']])
+    df['PECERT2_n'] = df['PECERT1_y'] & np.array([str(i).upper()=='NO' for i in df['PECERT2']])
+
+    return(df)
+
+def bench_microdata_loader(database, repeat=3):
+    '''
+    rows per second of the row by row fetchall loader against the chunked,
+    typed loader of get_microdata, best of repeat runs each. both read one
+    row per person (no base population copies)
+
+    :param database: string file path to a text database containing microdata,
+        several years of it to be representative
+    :param repeat: int default 3, runs of each loader
+    '''
+    loaders = {
+        'fetchall':lambda: load_fetchall(database),
+        'chunked':lambda: cat.get_microdata(database, base_pop=False)
+        }
+
+    results = []
+    for name in loaders:
+        best = None
+        for _ in range(repeat):
+            t = time.perf_counter()
+            rows = len(loaders[name]())
+            elapsed = time.perf_counter() - t
+            best = elapsed if best is None else min(best, elapsed)
+        results.append({'loader':name, 'rows':rows, 'seconds':best, 'rows_per_sec':rows / best})
+
+    out = pd.DataFrame(results).set_index('loader')
+    print(out.to_string())
+
+    return(out)
+
+def synthetic_layout(variables):
+    '''
+    record layout of synthetic raw files, the household id followed by each
+    variable at its census width
+    
+    :param variables: list of variable names
+    :return: list of (name, width, start, end) tuples, 1 based inclusive positions
+    '''
+    rows = []
+    pos = 1
+    for c in ['HRHHID'] + list(variables):
+        w = SYNTHETIC_WIDTHS.get(c, 2)
+        rows.append((c, w, pos, pos + w - 1))
+        pos += w
+    
+    return(rows)
+
+def write_layout(fname, rows):
+    '''
+    writes a record layout text file in the census format get_layout parses
+    
+    :param fname: string file path written to
+    :param rows: list of (name, width, start, end) tuples, see synthetic_layout
+    '''
+    with open(fname, 'w', encoding='iso-8859-1') as f:
+        f.write('Record layout\nNAME\tSIZE\tDESCRIPTION\t\tLOCATION\n')
+        for c, w, a, b in rows:
+            f.write('{}\t{}\tITEM DESCRIPTION\t\t{} - {}\n'.format(c, w, a, b))
+
+def synthetic_values(c, rows, rng, encoding, year, mo):
+    '''
+    raw census codes of one variable for a month of synthetic records. encoded
+    variables draw from their codes with some non responses (-1), others
+    follow the ranges the cleaning steps filter and recode on
+    
+    :param c: variable name
+    :param rows: number of records (int)
+    :param rng: np.random.Generator
+    :param encoding: dict of variable -> code -> label
+    :param year: 4 digit year (int)
+    :param mo: month number (int)
+    '''
+    if c in encoding:
+        codes = np.array(sorted(encoding[c]))
+        return(np.where(rng.random(rows) < 0.05, -1, rng.choice(codes, rows)))
+    
+    #two persons per household, in line number order
+    if c in ['QSTNUM','HRHHID']:
+        return(np.arange(rows) // 2 + 1)
+    if c == 'PULINENO':
+        return(np.arange(rows) % 2 + 1)
+    if c == 'HRMONTH':
+        return(np.full(rows, mo))
+    if c == 'HRYEAR4':
+        return(np.full(rows, year))
+    
+    #some children, armed forces and vacant units for load_month to drop
+    if c == 'PRTAGE':
+        return(rng.integers(0, 86, rows))
+    if c == 'PRPERTYP':
+        return(rng.choice([1,2,2,2,2,3], rows))
+    if c == 'HWHHWGT':
+        return(np.where(rng.random(rows) < 0.05, 0, rng.integers(1, 10**8, rows)))
+    
+    #weights with 4 implied decimals, earnings with 2 for about half the persons
+    if c in ['PWSSWGT','PWORWGT','PWVETWGT']:
+        return(np.where(rng.random(rows) < 0.02, 0, rng.integers(10**6, 10**8, rows)))
+    if c == 'PRERNWA':
+        return(np.where(rng.random(rows) < 0.5, -1, rng.integers(1, 2885, rows) * 100))
+    if c == 'PRERELG':
+        return(rng.integers(0, 2, rows))
+    if c == 'HRMIS':
+        return(rng.integers(1, 9, rows))
+    if c == 'PEEDUCA':
+        return(rng.integers(31, 47, rows))
+    if c == 'PRMJOCGR':
+        return(rng.integers(1, 8, rows))
+    
+    return(rng.integers(-1, 10, rows))
+
+def fixed_width(values, width):
+    '''
+    formats integers as fixed-width fields, zero padded, negative values right
+    aligned after spaces as census files write them, ex. -1 -> ' -1'
+    
+    :param values: np.ndarray of integers
+    :param width: field width (int)
+    :return: np.ndarray of uint8, a row of ascii characters per value
+    '''
+    v = np.asarray(values, dtype=np.int64)
+    a = np.abs(v)
+    out = (a[:, None] // 10**np.arange(width - 1, -1, -1, dtype=np.int64) % 10 + ord('0')).astype(np.uint8)
+    
+    neg = np.flatnonzero(v < 0)
+    if len(neg):
+        digits = np.floor(np.log10(np.maximum(a[neg], 1))).astype(np.int64) + 1
+        out[neg] = np.where(np.arange(width)[None, :] < (width - digits)[:, None], ord(' '), out[neg])
+        out[neg, width - digits - 1] = ord('-')
+    
+    return(out)
+
+def write_records(fname, columns, rows, zipped=False):
+    '''
+    writes fixed-width records, a line per record, as a .dat file or a zip
+    holding one as census downloads do
+    
+    :param fname: string file path without extension
+    :param columns: dict of name -> np.ndarray of codes
+    :param rows: list of (name, width, start, end) tuples, see synthetic_layout
+    :param zipped: bool default False, write {fname}.zip instead of {fname}.dat
+    '''
+    n = len(next(iter(columns.values())))
+    buf = np.hstack([fixed_width(columns[c], w) for c, w, a, b in rows] + [np.full((n, 1), ord('\n'), dtype=np.uint8)])
+    
+    if zipped:
+        with zipfile.ZipFile(fname + '.zip', 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr(os.path.basename(fname) + '.dat', buf.tobytes())
+    else:
+        buf.tofile(fname + '.dat')
+
+def write_synthetic_cps(root, start_month=201601, months=12, rows=130000, tables=10, seed=0,
+                        zipped=False, encoding_file=None, tables_file=None):
+    '''
+    writes synthetic raw census files for benchmarking the pipeline without
+    downloading them, laid out as the pipeline expects with root as both
+    newpath and outpath: fixed-width monthly files, the record layouts of
+    LAYOUT_SCHEDULE, certification extracts for 2015 and 2016, and small
+    encoding and table instruction files holding only what the run needs
+    
+    :param root: string directory written to
+    :param start_month: int default 201601, first yyyymm written, 2015 or later
+    :param months: int default 12, number of months written, 1 to 240 (20 years)
+    :param rows: int default 130000, records per month, a full cps month is roughly 130k
+    :param tables: int default 10, number of table specs kept in the table instructions
+    :param seed: int default 0, random seed
+    :param zipped: bool default False, write monthly files as zips in cps_{yy}_ziped,
+        as downloaded, rather than extracted .dat files in cps_{yy}
+    :param encoding_file: string default None, encoding the codes are drawn from,
+        cps_variable_encoding.json next to the compiler
+    :param tables_file: string default None, table instructions the specs are taken
+        from, cps_aggregate_tables.json next to the compiler
+    :return: dict describing the synthetic data, see bench_pipeline
+    '''
+    if months < 1 or start_month < cat.LAYOUT_SCHEDULE[0][0]:
+        raise ValueError("synthetic data starts at {} or later and covers at least a month".format(cat.LAYOUT_SCHEDULE[0][0]))
+    
+    here = os.path.dirname(os.path.abspath(cat.__file__))
+    encoding = cat.get_dict(encoding_file or os.path.join(here, 'cps_variable_encoding.json'))
+    d = cat.get_dict(tables_file or os.path.join(here, 'cps_aggregate_tables.json'))
+    
+    root = os.path.join(root, '')
+    os.makedirs(root, exist_ok=True)
+    
+    #encoding of the synthetic variables only and the first table specs
+    dfile = root + 'cps_variable_encoding.json'
+    metadata = root + 'cps_aggregate_tables.json'
+    with open(dfile, 'wb') as f:
+        pickle.dump({c:encoding[c] for c in encoding if c in SYNTHETIC_VARIABLES}, f)
+    with open(metadata, 'wb') as f:
+        pickle.dump({k:d[k] for k in list(d)[:tables]}, f)
+    
+    #certification questions were released separately until 2017
+    layouts = {}
+    for start, loc in cat.LAYOUT_SCHEDULE:
+        os.makedirs(os.path.dirname(root + loc.lstrip('/')), exist_ok=True)
+        layouts[loc] = synthetic_layout([c for c in SYNTHETIC_VARIABLES if start >= 201701 or not c.startswith('PECERT')])
+        write_layout(root + loc.lstrip('/'), layouts[loc])
+    
+    rng = np.random.default_rng(seed)
+    first = (start_month // 100) * 12 + start_month % 100 - 1
+    written = [((first + i) // 12, (first + i) % 12 + 1) for i in range(months)]
+    for year, mo in written:
+        yr = str(year)[2:4]
+        layout = layouts[cat.layout_file(year, mo)]
+        outdir = root + ('cps_{}_ziped'.format(yr) if zipped else 'cps_{}'.format(yr))
+        os.makedirs(outdir, exist_ok=True)
+        
+        columns = {c:synthetic_values(c, rows, rng, encoding, year, mo) for c, w, a, b in layout}
+        write_records(os.path.join(outdir, cat.month_switch(mo) + yr + 'pub'), columns, layout, zipped)
+    
+    #one extract per year holding every month's certification answers
+    for year in sorted(set(y for y, mo in written if y in [2015, 2016])):
+        yr = str(year)[2:4]
+        extract = ['QSTNUM','PULINENO','MONTH','HRYEAR4','PECERT1','PECERT2','PXCERT1','PXCERT2'] + (['PECERT3','PXCERT3'] if year == 2016 else [])
+        layout = synthetic_layout(extract)
+        os.makedirs(root + 'cps_' + yr, exist_ok=True)
+        write_layout(root + 'cps_{}/Certification_extract_file_{}_rec_layout.txt'.format(yr, year), layout)
+        
+        columns = {c:[] for c, w, a, b in layout}
+        for mo in range(1, 13):
+            for c in columns:
+                columns[c].append(np.full(rows, mo) if c == 'MONTH' else
+                                  synthetic_values(c, rows, rng, {}, year, mo) if c in ['HRHHID','QSTNUM','PULINENO','HRYEAR4'] else
+                                  rng.choice([-1, 1, 2], rows))
+        outdir = root + ('cps_{}_ziped'.format(yr) if zipped else 'cps_{}'.format(yr))
+        os.makedirs(outdir, exist_ok=True)
+        write_records(os.path.join(outdir, 'jan{0}-dec{0}cert_ext'.format(yr)), {c:np.concatenate(columns[c]) for c in columns}, layout, zipped)
+    
+    synthetic = {
+        'root':root,
+        'dfile':dfile,
+        'metadata':metadata,
+        'database':root + 'cps_benchmark.db',
+        'variables':list(SYNTHETIC_VARIABLES),
+        'start_month':100 * written[0][0] + written[0][1],
+        'end_month':100 * written[-1][0] + written[-1][1],
+        'months':months,
+        'rows':rows,
+        'records':months * rows,
+        'tables':min(tables, len(d)),
+        'seed':seed,
+        'zipped':zipped
+        }
+    with open(root + 'synthetic.json', 'w') as f:
+        json.dump(synthetic, f, indent=1)
+    
+    return(synthetic)
+
+def stage_clean_data(synthetic, workers=1):
+    '''
+    clean_data of every synthetic month, forced so earlier runs are not reused.
+    rows are the raw records read
+    '''
+    years = [synthetic['start_month'] // 100, synthetic['end_month'] // 100]
+    def run():
+        cat.clean_data(synthetic['variables'], years[0], years[1], synthetic['dfile'], workers=workers, force=True)
+        return(synthetic['records'])
+    
+    return(run)
+
+def stage_combine_data(synthetic, workers=1):
+    '''
+    combine_data into a new database, every month is written with the bulk
+    loader that replaced write_to_table. rows are the microdata rows written
+    '''
+    if os.path.exists(synthetic['database']):
+        os.remove(synthetic['database'])
+    def run():
+        cat.combine_data(synthetic['database'], synthetic['start_month'] // 100, synthetic['end_month'] // 100)
+        conn = sqlite3.connect(synthetic['database'])
+        rows = conn.execute('SELECT COUNT(*) FROM microdata').fetchone()[0]
+        conn.close()
+        return(rows)
+    
+    return(run)
+
+def stage_get_microdata(synthetic, workers=1):
+    '''
+    get_microdata of the whole database as generate_tables reads it. rows are
+    the microdata rows read
+    '''
+    def run():
+        return(len(cat.get_microdata(synthetic['database'], base_pop=False)))
+    
+    return(run)
+
+def stage_generate_tables(synthetic, workers=1):
+    '''
+    generate_tables of the synthetic table instructions from microdata read
+    beforehand. rows are the microdata rows aggregated
+    '''
+    data = cat.get_microdata(synthetic['database'], base_pop=False)
+    d = cat.get_dict(synthetic['metadata'])
+    def run():
+        cat.generate_tables(data, d, synthetic['database'], 'cps_benchmark_tables', workers=workers)
+        return(len(data))
+    
+    return(run)
+
+def _run_stage(stage, synthetic, workers, queue):
+    '''
+    child process body for bench_pipeline, prepares a stage, then times it and
+    reports its peak memory. as in _run_assembly tracemalloc stands in for rss
+    where the resource module is unavailable
+    '''
+    cat.newpath = synthetic['root']
+    cat.outpath = synthetic['root']
+    run = {'clean_data':stage_clean_data, 'combine_data':stage_combine_data,
+           'get_microdata':stage_get_microdata, 'generate_tables':stage_generate_tables}[stage](synthetic, workers)
+    
+    before = peak_rss_mb()
+    if before is None:
+        tracemalloc.start()
+    
+    t = time.perf_counter()
+    rows = run()
+    elapsed = time.perf_counter() - t
+    
+    if before is None:
+        peak = growth = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    else:
+        peak = peak_rss_mb()
+        growth = peak - before
+    
+    queue.put({
+        'stage':stage,
+        'rows':int(rows),
+        'seconds':elapsed,
+        'rows_per_sec':rows / elapsed if elapsed > 0 else None,
+        'peak_rss_mb':peak,
+        'peak_growth_mb':growth
+        })
+
+def bench_pipeline(synthetic, stages=BENCH_STAGES, workers=1, fname=None, timeout=None):
+    '''
+    runs pipeline stages over synthetic data in order, each in a fresh process
+    so peak rss is its own, and reports wall time, rows per second and peak
+    memory of each. results are saved as json so runs, ex. before and after a
+    change or at different scales, can be compared with compare_benchmarks
+    
+    :param synthetic: dict returned by write_synthetic_cps, or the path of its synthetic.json
+    :param stages: list default BENCH_STAGES, stages run, later stages read what earlier ones wrote
+    :param workers: int default 1, worker processes of clean_data and generate_tables
+    :param fname: string default None, json file written, bench_{time}.json in the synthetic root
+    :param timeout: float default None, seconds a stage may run before it is stopped and
+        recorded as failed. stages after a failed one are not run
+    :return: DataFrame of results indexed by stage
+    '''
+    if isinstance(synthetic, str):
+        with open(synthetic) as f:
+            synthetic = json.load(f)
+    
+    results = []
+    for stage in stages:
+        queue = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=_run_stage, args=(stage, synthetic, workers, queue))
+        proc.start()
+        result, error = child_result(proc, queue, timeout)
+        if error is not None:
+            print('{} failed, {}'.format(stage, error))
+            results.append({'stage':stage, 'error':error})
+            break
+        results.append(result)
+    
+    run = {
+        'time':time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python':platform.python_version(),
+        'pandas':pd.__version__,
+        'numpy':np.__version__,
+        'machine':platform.platform(),
+        'cpus':os.cpu_count(),
+        'workers':workers,
+        'synthetic':synthetic,
+        'stages':results
+        }
+    
+    fname = fname or os.path.join(synthetic['root'], 'bench_{}.json'.format(time.strftime('%Y%m%d_%H%M%S')))
+    with open(fname, 'w') as f:
+        json.dump(run, f, indent=1)
+    
+    out = pd.DataFrame(results).set_index('stage')
+    print(out.to_string())
+    print('results saved to {}'.format(fname))
+    
+    return(out)
+
+def compare_benchmarks(base, other):
+    '''
+    compares two saved bench_pipeline runs stage by stage, ratios above 1
+    mean other took longer or used more memory than base. stages that failed
+    in either run have no measures
+    
+    :param base: string path of the json of the reference run
+    :param other: string path of the json of the run compared
+    '''
+    runs = []
+    for fname in [base, other]:
+        with open(fname) as f:
+            runs.append(pd.DataFrame(json.load(f)['stages']).set_index('stage').reindex(columns=['seconds','rows_per_sec','peak_rss_mb']))
+    
+    out = runs[0].join(runs[1], lsuffix='_base', rsuffix='_other', how='inner')
+    out['seconds_ratio'] = out['seconds_other'] / out['seconds_base']
+    out['peak_rss_ratio'] = out['peak_rss_mb_other'] / out['peak_rss_mb_base']
+    print(out.to_string())
+    
+    return(out)
+
+if __name__ == '__main__':
+    bench_year_assembly()